@@ -1,16 +1,35 @@
 import os
 import json
 import smtplib
-from datetime import datetime
+from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
+from email.header import Header
+from email import policy
+from email.charset import Charset, QP
 from dotenv import load_dotenv
-import google.generativeai as genai
-from typing import List, Dict, Optional
-import gspread
-from google.oauth2.service_account import Credentials
+from typing import List, Dict, Optional, Iterable, Iterator, Callable, Set, Tuple
 import ssl
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import hashlib
+import sqlite3
+import re
+import random
+import itertools
+import struct
+import socket
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from contextlib import nullcontext, contextmanager
+from functools import lru_cache, wraps
+import inspect
+import bisect
+from html import escape
+from string import Template
 
 # --- Configuración ---
 load_dotenv()
@@ -22,16 +41,84 @@ EMAIL_SENDER = os.getenv("EMAIL_SENDER")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SMTP_PASS = os.getenv("SMTP_PASS")
+# Conexiones SMTP simultáneas y mensajes por sesión antes de reconectar
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 4))
+SMTP_MAX_PER_SESSION = int(os.getenv("SMTP_MAX_PER_SESSION", 100))
+# Modo por lotes: destinatarios por sobre SMTP (RCPT TO) compartiendo un solo DATA. 1 = desactivado
+SMTP_BATCH_SIZE = int(os.getenv("SMTP_BATCH_SIZE", 1))
+BATCH_TO_HEADER = "undisclosed-recipients:;"
+# Ritmo de envío (mensajes/seg; 0 = sin límite) por dominio y global. Desactivado por defecto: un
+# límite general frena las listas concentradas en un proveedor (10/s son ~83 min para 50k de gmail).
+# Para limitar sólo a los proveedores que lo piden, usar SMTP_DOMAIN_RATES, p. ej. "gmail.com=5,outlook.com=2"
+SMTP_RATE_PER_DOMAIN = float(os.getenv("SMTP_RATE_PER_DOMAIN", 0))
+SMTP_RATE_GLOBAL = float(os.getenv("SMTP_RATE_GLOBAL", 0))
+SMTP_DOMAIN_RATES = os.getenv("SMTP_DOMAIN_RATES", "")
+# Reintentos ante rechazos temporales (4xx), con pausa exponencial por dominio (segundos)
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", 4))
+SMTP_BACKOFF_BASE = float(os.getenv("SMTP_BACKOFF_BASE", 5))
+SMTP_BACKOFF_MAX = float(os.getenv("SMTP_BACKOFF_MAX", 300))
+# Destino de los correos: "smtp" (pool SMTP), "maildir" (spool en DELIVERY_SPOOL_DIR para un MTA, con
+# el sobre aparte en envelope/; ver MaildirBackend) o "null"
+DELIVERY_BACKEND = os.getenv("DELIVERY_BACKEND", "smtp").lower()
+DELIVERY_SPOOL_DIR = os.getenv("DELIVERY_SPOOL_DIR", "outbox")
+# URL (o mailto:) de baja; {email} se reemplaza por el correo del destinatario
+LIST_UNSUBSCRIBE_URL = os.getenv("LIST_UNSUBSCRIBE_URL")
 
-# Configurar el cliente de Gemini
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-1.5-flash"
+# Caché persistente de respuestas de Gemini (clave: hash de modelo + prompt)
+GEMINI_CACHE_FILE = "gemini_cache.sqlite3"
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", 7 * 24 * 3600))  # segundos
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", 200))
+GEMINI_CACHE_BYPASS = os.getenv("GEMINI_CACHE_BYPASS", "0") == "1"
+# Límite de llamadas a Gemini (por minuto, compartido entre hilos) y generaciones simultáneas
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", 15))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 3))
+# Tiempo máximo (segundos) para generar un newsletter; al agotarse se usa la plantilla de respaldo
+GEMINI_GENERATION_BUDGET = float(os.getenv("GEMINI_GENERATION_BUDGET", 90))
 
 # Archivos y Configuración de Google Sheets
 WEEKLY_PRODUCTS_FILE = "weekly_products.json"
+# Newsletters de la semana generados por adelantado el lunes, indexados por producto
+WEEKLY_NEWSLETTERS_FILE = "weekly_newsletters.json"
 GOOGLE_SHEET_NAME = "Suscriptores BB Beauty Bot"
+# Abrir por clave evita la búsqueda por nombre en Drive; si no está configurada se usa el nombre
+GOOGLE_SHEET_KEY = os.getenv("GOOGLE_SHEET_KEY")
 CREDENTIALS_FILE = "credentials.json"
-HISTORY_FILE = "product_history.json"
+# Copia local de los suscriptores: se usa directamente si tiene menos de SUBSCRIBERS_CACHE_TTL segundos,
+# se actualiza leyendo sólo las filas nuevas y se relee completa cada SUBSCRIBERS_FULL_REFRESH_DAYS días
+SUBSCRIBERS_DB_FILE = "subscribers.sqlite3"
+SUBSCRIBERS_CACHE_TTL = int(os.getenv("SUBSCRIBERS_CACHE_TTL", 3600))
+SUBSCRIBERS_FULL_REFRESH_DAYS = int(os.getenv("SUBSCRIBERS_FULL_REFRESH_DAYS", 7))
+SHEETS_TIMEOUT = int(os.getenv("SHEETS_TIMEOUT", 15))  # segundos
+# Filas leídas por petición al recorrer la hoja
+SUBSCRIBERS_PAGE_SIZE = int(os.getenv("SUBSCRIBERS_PAGE_SIZE", 1000))
+# Campañas: varias listas (planillas, pestañas o segmentos) que reciben el newsletter en la misma ejecución.
+# Si el archivo no existe se usa una sola lista, la de GOOGLE_SHEET_KEY / GOOGLE_SHEET_NAME
+CAMPAIGNS_FILE = os.getenv("CAMPAIGNS_FILE", "campaigns.json")
+HISTORY_FILE = "product_history.json"  # Formato antiguo; se migra automáticamente a HISTORY_DB_FILE
+HISTORY_DB_FILE = "product_history.sqlite3"
+# Detección de casi-duplicados (MinHash + LSH sobre trigramas de marca y nombre)
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0.8))
+# Búsqueda adaptativa: productos extra pedidos por intento y cuántos del historial se excluyen en el prompt
+SEARCH_OVERSAMPLE = int(os.getenv("SEARCH_OVERSAMPLE", 1))
+SEARCH_EXCLUDE_LIMIT = int(os.getenv("SEARCH_EXCLUDE_LIMIT", 60))
+# Diario de entregas: un archivo JSON Lines por día con el estado de cada destinatario
+DELIVERY_JOURNAL_DIR = "delivery_journal"
+JOURNAL_FSYNC_EVERY = int(os.getenv("JOURNAL_FSYNC_EVERY", 200))
+JOURNAL_RETENTION_DAYS = 14
+# BBBOT_ASYNC=1 ejecuta el flujo diario con etapas concurrentes (main_async)
+BBBOT_ASYNC = os.getenv("BBBOT_ASYNC", "0") == "1"
+# Estado de las ejecuciones por semana ISO y día: etapas terminadas (búsqueda, generación, envío) y sus artefactos
+RUN_STATE_FILE = "run_state.json"
+RUN_STATE_WEEKS = 8  # semanas que se conservan
+# BBBOT_CATCH_UP=1 también envía los días hábiles de la semana que quedaron sin enviar (p. ej. tras una caída)
+BBBOT_CATCH_UP = os.getenv("BBBOT_CATCH_UP", "0") == "1"
+# Informe de cada ejecución (JSON) y, opcionalmente, métricas para el textfile collector de Prometheus
+RUN_REPORT_DIR = "run_reports"
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")
+DAY_NAMES = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"]
 
 # --- Utilidades ---
 def log(msg: str, level: str = "info"):
@@ -39,68 +126,994 @@ def log(msg: str, level: str = "info"):
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     print(f"[{timestamp}] [{level.upper()}] {msg}")
 
+class TokenBucket:
+    """
+    Limitador de tasa thread-safe: `rate` fichas por segundo con ráfagas de hasta `capacity`.
+    Una tasa <= 0 significa sin límite.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Suma las fichas acumuladas desde la última consulta (llamar con el bloqueo tomado)."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self) -> float:
+        """Segundos hasta que haya una ficha disponible, sin tomarla."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def available(self) -> float:
+        """Fichas enteras disponibles ahora, sin tomarlas (infinitas si no hay límite)."""
+        if self.rate <= 0:
+            return float("inf")
+        with self._lock:
+            self._refill()
+            return float(int(self._tokens))
+
+    def try_acquire(self, count: int = 1) -> float:
+        """Toma `count` fichas si las hay. Retorna 0 si las obtuvo o los segundos a esperar si no."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            if self._tokens >= count:
+                self._tokens -= count
+                return 0.0
+            return (count - self._tokens) / self.rate
+
+    def acquire(self):
+        """Bloquea hasta obtener una ficha."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+# --- Métricas de Ejecución ---
+class LatencyHistogram:
+    """Histograma acumulativo al estilo Prometheus (límites superiores en segundos)."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # el último es +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float, times: int = 1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += times
+        self.count += times
+        self.sum += value * times
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimación por el límite superior del bucket que contiene el cuantil."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        cumulative = list(itertools.accumulate(self.counts))
+        return {
+            "count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6),
+            "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99),
+            "buckets": {**{str(b): c for b, c in zip(self.buckets, cumulative)}, "+Inf": cumulative[-1]},
+        }
+
+
+class RunMetrics:
+    """
+    Métricas de una ejecución, seguras entre hilos: duración acumulada por etapa (`stages`),
+    duración de las fases del flujo asíncrono (`phases`), contadores (llamadas a APIs, tokens,
+    reintentos, correos) e histogramas de latencia.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_phase(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = seconds
+
+    def incr(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def counter(self, name: str) -> float:
+        return self.counters.get(name, 0)
+
+    def observe(self, name: str, value: float, times: int = 1):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.observe(value, times)
+
+    def report(self, status: str = "ok") -> Dict:
+        with self._lock:
+            wall = time.perf_counter() - self._start
+            send_seconds = self.stages.get("send", {}).get("seconds", 0)
+            sent = self.counters.get("emails_sent", 0)
+            return {
+                "started_at": self.started_at.isoformat(timespec='seconds'),
+                "status": status,
+                "wall_seconds": round(wall, 3),
+                "stages": {name: {"seconds": round(v["seconds"], 3), "calls": v["calls"]}
+                           for name, v in self.stages.items()},
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "counters": dict(self.counters),
+                "histograms": {name: h.to_dict() for name, h in self.histograms.items()},
+                "throughput_emails_per_second": round(sent / send_seconds, 2) if send_seconds else 0.0,
+            }
+
+    def write_report(self, directory: str = RUN_REPORT_DIR, status: str = "ok",
+                     textfile: Optional[str] = None) -> str:
+        """Guarda el informe JSON de la ejecución (y el textfile de Prometheus si se indica). Retorna la ruta."""
+        report = self.report(status)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"run_{self.started_at.strftime('%Y-%m-%dT%H%M%S')}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        if textfile:
+            _write_atomically(textfile, self.prometheus(report))
+        return path
+
+    @staticmethod
+    def prometheus(report: Dict) -> str:
+        """Formato de exposición de texto de Prometheus para el informe dado."""
+        def label(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"')
+
+        lines = [
+            "# TYPE bbbot_run_wall_seconds gauge",
+            f"bbbot_run_wall_seconds {report['wall_seconds']}",
+            "# TYPE bbbot_run_success gauge",
+            f"bbbot_run_success {int(report['status'] == 'ok')}",
+            "# TYPE bbbot_run_timestamp_seconds gauge",
+            f"bbbot_run_timestamp_seconds {int(datetime.fromisoformat(report['started_at']).timestamp())}",
+            "# TYPE bbbot_stage_seconds gauge",
+        ]
+        lines += [f'bbbot_stage_seconds{{stage="{label(n)}"}} {v["seconds"]}' for n, v in report["stages"].items()]
+        lines.append("# TYPE bbbot_phase_seconds gauge")
+        lines += [f'bbbot_phase_seconds{{phase="{label(n)}"}} {v}' for n, v in report["phases"].items()]
+        for name, value in report["counters"].items():
+            lines += [f"# TYPE bbbot_{name}_total counter", f"bbbot_{name}_total {value}"]
+        for name, histogram in report["histograms"].items():
+            lines.append(f"# TYPE bbbot_{name} histogram")
+            lines += [f'bbbot_{name}_bucket{{le="{bound}"}} {count}' for bound, count in histogram["buckets"].items()]
+            lines += [f"bbbot_{name}_sum {histogram['sum']}", f"bbbot_{name}_count {histogram['count']}"]
+        lines.append(f"bbbot_throughput_emails_per_second {report['throughput_emails_per_second']}")
+        return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path: str, content: str):
+    """Escribe en un temporal y renombra, para que el lector nunca vea un archivo a medias."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# Métricas de la ejecución en curso
+metrics = RunMetrics()
+
+
+def instrumented(stage: str):
+    """
+    Decorador: acumula en `metrics` el tiempo pasado dentro de la función bajo `stage`.
+    En generadores sólo cuenta el tiempo de producir cada elemento, no el de quien los consume.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                elapsed = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    generator.close()
+                    metrics.add_stage(stage, elapsed)
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- Cliente de Gemini ---
+class ResponseCache:
+    """
+    Caché de respuestas de Gemini en SQLite, con expiración (TTL) y expulsión LRU
+    cuando se superan `max_entries` entradas. Lleva contadores de aciertos y fallos.
+    """
+
+    def __init__(self, path: str = GEMINI_CACHE_FILE, ttl: int = GEMINI_CACHE_TTL,
+                 max_entries: int = GEMINI_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, accessed_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        key = self.key(model, prompt)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+
+    def put(self, model: str, prompt: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                               (self.key(model, prompt), model, response, now, now))
+            # Expulsar las entradas usadas hace más tiempo por encima del límite
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def _response_cache() -> ResponseCache:
+    return ResponseCache()
+
+
+_gemini_rate_limiter = TokenBucket(GEMINI_REQUESTS_PER_MINUTE / 60, capacity=GEMINI_MAX_CONCURRENCY)
+
+
+@lru_cache(maxsize=None)
+def _genai():
+    """
+    Importa y configura el SDK de Gemini la primera vez que se usa: cargarlo toma alrededor de
+    medio segundo, que una ejecución sin nada que generar (fin de semana, contenido ya en caché)
+    no tiene por qué pagar.
+    """
+    import google.generativeai as genai
+    if GEMINI_API_KEY:
+        genai.configure(api_key=GEMINI_API_KEY)
+    return genai
+
+@lru_cache(maxsize=None)
+def _get_model(name: str = GEMINI_MODEL):
+    """Reutiliza la instancia del modelo en vez de crear una por llamada."""
+    return _genai().GenerativeModel(name)
+
+
+def _record_usage(api_calls: int = 0, tokens: int = 0):
+    """Suma llamadas a la API y tokens consumidos a las métricas de la ejecución."""
+    if api_calls:
+        metrics.incr("gemini_api_calls", api_calls)
+    if tokens:
+        metrics.incr("gemini_tokens", tokens)
+
+
+def _stream_content(prompt: str) -> Iterable[str]:
+    """
+    Llama a Gemini en modo streaming y produce el texto de cada fragmento.
+    Si quien consume deja de iterar, el resto de la respuesta no se descarga.
+    """
+    _gemini_rate_limiter.acquire()
+    _record_usage(api_calls=1)
+    counted = 0
+    try:
+        chunks = _get_model(GEMINI_MODEL).generate_content(prompt, stream=True)
+    except Exception:
+        metrics.incr("gemini_errors")
+        raise
+    for chunk in chunks:
+        # El uso de tokens llega acumulado en cada fragmento: sumar sólo la diferencia
+        total = getattr(getattr(chunk, 'usage_metadata', None), 'total_token_count', 0) or 0
+        if total > counted:
+            _record_usage(tokens=total - counted)
+            counted = total
+        yield chunk.text
+
+
+def _generate_content(prompt: str, use_cache: bool = True, budget: Optional[float] = None,
+                      validate: Optional[Callable[[str, bool], Optional[bool]]] = None) -> str:
+    """
+    Llama a Gemini en streaming y retorna el texto completo de la respuesta. Si `use_cache` es True
+    (y no se activó GEMINI_CACHE_BYPASS), una respuesta previa para el mismo modelo y prompt se reutiliza.
+
+    `validate(texto, completo)` revisa el texto parcial a medida que llega (None = aún no se sabe)
+    y el texto final; si lo rechaza, se corta la respuesta y se lanza ValueError. Si la respuesta no
+    termina en `budget` segundos se abandona y se lanza TimeoutError. Sólo se guardan en caché las
+    respuestas completas y válidas.
+    """
+    cache = _response_cache() if use_cache and not GEMINI_CACHE_BYPASS else None
+    if cache:
+        cached = cache.get(GEMINI_MODEL, prompt)
+        if cached is not None:
+            log(f"Respuesta de Gemini tomada de la caché (aciertos: {cache.hits}, fallos: {cache.misses}).", "info")
+            metrics.incr("gemini_cache_hits")
+            return cached
+        metrics.incr("gemini_cache_misses")
+
+    # El stream se consume en otro hilo para poder dejar de esperarlo al agotarse el presupuesto
+    chunks: "queue.Queue" = queue.Queue()
+    cancel = threading.Event()
+    done = object()
+
+    def produce():
+        stream = _stream_content(prompt)
+        try:
+            for text in stream:
+                if cancel.is_set():
+                    return
+                chunks.put(text)
+            chunks.put(done)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            stream.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    start = time.perf_counter()
+    deadline = start + budget if budget else None
+    parts: List[str] = []
+    checked = validate is None
+    while True:
+        try:
+            item = chunks.get(timeout=max(0.0, deadline - time.perf_counter()) if deadline else None)
+        except queue.Empty:
+            cancel.set()
+            metrics.incr("gemini_timeouts")
+            raise TimeoutError(f"Gemini no terminó de responder en {budget:.0f}s")
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        if not parts:
+            ttft = time.perf_counter() - start
+            metrics.observe("gemini_ttft_seconds", ttft)
+            log(f"Primer fragmento de Gemini en {ttft:.2f}s.", "info")
+        parts.append(item)
+        if not checked:
+            verdict = validate("".join(parts), False)
+            if verdict is False:
+                cancel.set()
+                raise ValueError("La respuesta de Gemini no tiene la estructura esperada")
+            checked = verdict is True
+
+    text = "".join(parts)
+    if validate and not validate(text, True):
+        raise ValueError("La respuesta de Gemini no tiene la estructura esperada")
+    if cache:
+        cache.put(GEMINI_MODEL, prompt, text)
+    return text
+
+# --- Campañas ---
+_CAMPAIGN_NAME = re.compile(r"^[a-z0-9_]+$")
+_COLUMN = re.compile(r"^[A-Z]{1,2}$")
+
+def _column_index(column: str) -> int:
+    """Índice (desde 0) de una columna en notación A1: A -> 0, B -> 1, AA -> 26."""
+    index = 0
+    for char in column:
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index - 1
+
+class Campaign:
+    """
+    Una lista de suscriptores: planilla (por clave o por nombre), pestaña y columna de correos,
+    con un filtro opcional por otra columna (p. ej. la de tipo de piel). Sin planilla propia se usa
+    la configurada por entorno. Cuando varias campañas comparten el envío, `weight` es la parte del
+    ritmo que le toca a cada una. Cada campaña guarda su propia copia local de suscriptores.
+    """
+
+    def __init__(self, name: str = "default", sheet_key: Optional[str] = None, sheet_name: Optional[str] = None,
+                 worksheet: str = "Hoja 1", email_column: str = "B", segment_column: Optional[str] = None,
+                 segment_values: Optional[List[str]] = None, weight: float = 1.0):
+        if not _CAMPAIGN_NAME.match(name):
+            raise ValueError(f"Nombre de campaña inválido: {name!r} (sólo minúsculas, dígitos y _)")
+        for column in filter(None, (email_column, segment_column)):
+            if not _COLUMN.match(column):
+                raise ValueError(f"Columna inválida en la campaña '{name}': {column!r}")
+        if bool(segment_column) != bool(segment_values):
+            raise ValueError(f"La campaña '{name}' debe indicar segment_column y segment_values juntos.")
+        if weight <= 0:
+            raise ValueError(f"El peso de la campaña '{name}' debe ser positivo.")
+        self.name = name
+        self.sheet_key = sheet_key
+        self.sheet_name = sheet_name
+        self.worksheet = worksheet
+        self.email_column = email_column
+        self.segment_column = segment_column
+        self.segment_values = {value.strip().casefold() for value in segment_values or []}
+        self.weight = float(weight)
+
+    @property
+    def db_file(self) -> str:
+        """Copia local: la de siempre para la campaña por defecto, una por nombre para las demás."""
+        if self.name == "default":
+            return SUBSCRIBERS_DB_FILE
+        root, ext = os.path.splitext(SUBSCRIBERS_DB_FILE)
+        return f"{root}.{self.name}{ext}"
+
+    def open_worksheet(self, client):
+        if self.sheet_key or self.sheet_name:
+            spreadsheet = client.open_by_key(self.sheet_key) if self.sheet_key else client.open(self.sheet_name)
+        else:
+            spreadsheet = client.open_by_key(GOOGLE_SHEET_KEY) if GOOGLE_SHEET_KEY else client.open(GOOGLE_SHEET_NAME)
+        return spreadsheet.worksheet(self.worksheet) # Es más seguro abrir la pestaña por nombre
+
+    def _columns(self) -> List[str]:
+        return sorted(filter(None, (self.email_column, self.segment_column)), key=_column_index)
+
+    def sheet_range(self, start: int, end: int) -> str:
+        """Rango A1 de las filas `start`..`end` con las columnas que usa la campaña."""
+        columns = self._columns()
+        return f"{columns[0]}{start}:{columns[-1]}{end}"
+
+    def select(self, rows: List[List[str]]) -> List[List[str]]:
+        """
+        Reduce las filas leídas con `sheet_range` a [correo], o a [] si la fila no pertenece al
+        segmento. Se conserva una entrada por fila para no perder la numeración de la hoja.
+        """
+        offset = _column_index(self._columns()[0])
+        email_at = _column_index(self.email_column) - offset
+        segment_at = _column_index(self.segment_column) - offset if self.segment_column else None
+        selected = []
+        for cells in rows:
+            email = cells[email_at] if len(cells) > email_at else ""
+            if segment_at is not None:
+                segment = cells[segment_at] if len(cells) > segment_at else ""
+                if segment.strip().casefold() not in self.segment_values:
+                    email = ""
+            selected.append([email] if email else [])
+        return selected
+
+def load_campaigns(path: Optional[str] = None) -> List[Campaign]:
+    """
+    Lee las campañas de CAMPAIGNS_FILE: una lista JSON de objetos con los campos de Campaign, p. ej.
+    [{"name": "piel_grasa", "segment_column": "C", "segment_values": ["Grasa", "Mixta"], "weight": 2}].
+    Sin archivo se usa una sola campaña con la lista de siempre. Lanza ValueError si es inválido.
+    """
+    path = path or CAMPAIGNS_FILE
+    if not os.path.exists(path):
+        return [Campaign()]
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Se esperaba una lista no vacía de campañas.")
+    try:
+        campaigns = [Campaign(**entry) for entry in entries]
+    except TypeError as e:
+        raise ValueError(f"Campaña mal definida: {e}") from e
+    names = [campaign.name for campaign in campaigns]
+    if len(set(names)) != len(names):
+        raise ValueError("Hay campañas con el mismo nombre.")
+    return campaigns
+
 # --- Lector de Google Sheets ---
+def _cells_digest(cells: List[str]) -> int:
+    """Huella de 48 bits de una fila (cabe sin pérdida en la columna REAL de `meta`)."""
+    return int.from_bytes(hashlib.blake2b("\x1f".join(cells).encode('utf-8'), digest_size=6).digest(), "big")
+
+class SubscriberSnapshot:
+    """
+    Copia local (SQLite) de la columna de correos de la hoja, con el número de fila de cada uno.
+    Permite actualizarla leyendo sólo las filas nuevas y servir de respaldo si Sheets falla.
+    Una actualización queda en una transacción hasta `finish_refresh`; si falla a medias,
+    `rollback` restaura la copia anterior.
+    """
+
+    def __init__(self, path: str = SUBSCRIBERS_DB_FILE):
+        # El generador de suscriptores puede continuar en otro hilo (modo asíncrono); el uso es secuencial
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS subscribers (row INTEGER PRIMARY KEY, email TEXT);"
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL);")
+        self._conn.commit()
+
+    def _meta(self, name: str, default: float = 0.0) -> float:
+        row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, **values: float):
+        self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", values.items())
+
+    @property
+    def last_row(self) -> int:
+        """Última fila de la hoja ya leída (la fila 1 es el encabezado)."""
+        return int(self._meta("last_row", 1))
+
+    def is_fresh(self, ttl: int) -> bool:
+        return time.time() - self._meta("fetched_at") < ttl
+
+    def needs_full_refresh(self, days: int) -> bool:
+        return time.time() - self._meta("full_refresh_at") >= days * 86400
+
+    def begin_full_refresh(self):
+        self._conn.execute("DELETE FROM subscribers")
+        self._set_meta(last_row=1)
+
+    def append_rows(self, start_row: int, rows: List[List[str]], last_cells: Optional[List[str]] = None):
+        """
+        Guarda las filas leídas a partir de `start_row` (cada fila es una lista de celdas).
+        `last_cells` son las celdas tal como vienen de la hoja en la última fila (por defecto, `rows[-1]`),
+        para comprobar después con `matches_last_row` que sigue en su sitio.
+        """
+        self._conn.executemany("INSERT OR REPLACE INTO subscribers VALUES (?, ?)",
+                               [(start_row + i, cells[0]) for i, cells in enumerate(rows) if cells and cells[0]])
+        if rows:
+            # Sheets omite las filas vacías del final: la próxima lectura retoma desde la última con datos
+            self._set_meta(last_row=start_row - 1 + len(rows),
+                           last_row_digest=_cells_digest(rows[-1] if last_cells is None else last_cells))
+
+    def matches_last_row(self, cells: List[str]) -> bool:
+        """Si la última fila leída sigue igual; si no, se borraron o insertaron filas por encima de ella."""
+        return self._meta("last_row_digest") == _cells_digest(cells)
+
+    def finish_refresh(self, full: bool):
+        now = time.time()
+        self._set_meta(fetched_at=now, **({"full_refresh_at": now} if full else {}))
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def emails(self) -> Iterator[str]:
+        return (email for (email,) in self._conn.execute("SELECT email FROM subscribers ORDER BY row"))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _sheets_client():
+    """Cliente autenticado de gspread con la cuenta de servicio."""
+    # Importación diferida: sólo se paga cuando la copia local no basta y hay que leer la hoja
+    import gspread
+    from google.oauth2.service_account import Credentials
+    # Definir los scopes necesarios. Necesitamos leer hojas de cálculo.
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets.readonly",
+        "https://www.googleapis.com/auth/drive.readonly"
+    ]
+    creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=scopes)
+    client = gspread.authorize(creds)
+    if hasattr(client, "set_timeout"):
+        client.set_timeout(SHEETS_TIMEOUT)
+    return client
+
+def _stream_sheet_pages(snapshot: SubscriberSnapshot, page_size: int, campaign: Campaign) -> Iterator[str]:
+    """
+    Recorre la hoja por rangos de `page_size` filas, guardando cada página en la copia local
+    y produciendo sus correos en cuanto llega. En una actualización incremental primero se
+    producen los correos ya guardados y luego sólo se leen las filas nuevas.
+
+    La primera página incremental empieza en la última fila ya leída: si esa fila cambió, se
+    borraron o insertaron filas por encima (p. ej. una baja seguida de un alta) y los números de
+    fila guardados ya no valen, así que se lee la hoja completa. Las celdas editadas sin mover
+    filas se recogen en la lectura completa periódica (SUBSCRIBERS_FULL_REFRESH_DAYS).
+    """
+    worksheet = campaign.open_worksheet(_sheets_client())
+    full = snapshot.needs_full_refresh(SUBSCRIBERS_FULL_REFRESH_DAYS)
+    # Por defecto los correos están en la columna 2 (B). La primera fila es el encabezado.
+    start, page = snapshot.last_row + 1, None
+    if not full and start > 2:
+        end = start + page_size - 2
+        page = worksheet.get(campaign.sheet_range(start - 1, end))
+        metrics.incr("sheets_api_calls")
+        if page and snapshot.matches_last_row(page[0]):
+            page = page[1:]
+        else:
+            log("La hoja cambió por encima de la última fila leída; se leerá completa.", "warning")
+            full, page = True, None
+    if full:
+        snapshot.begin_full_refresh()
+        start = 2
+    else:
+        yield from snapshot.emails()
+    first = start
+    while start <= worksheet.row_count:
+        if page is None:
+            end = start + page_size - 1
+            page = worksheet.get(campaign.sheet_range(start, end))
+            metrics.incr("sheets_api_calls")
+        raw, page = page, None
+        rows = campaign.select(raw)
+        snapshot.append_rows(start, rows, raw[-1] if raw else None)
+        for cells in rows:
+            if cells and cells[0]:
+                yield cells[0]
+        start = end + 1
+    snapshot.finish_refresh(full)
+    log(f"Copia local de suscriptores actualizada ({'completa' if full else f'desde la fila {first}'}).", "info")
+
+_EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s.]+$")
+
+def _clean_subscribers(emails: Iterable[str], seen: Set[bytes]) -> Iterator[str]:
+    """Normaliza, valida y descarta repetidos sobre la marcha. `seen` guarda un hash corto por correo."""
+    for raw in emails:
+        email = raw.strip().lower()
+        if not _EMAIL_PATTERN.match(email):
+            continue
+        digest = hashlib.blake2b(email.encode('utf-8'), digest_size=8).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        yield email
+
+@instrumented("sheets")
+def iter_subscribers(campaign: Optional[Campaign] = None, page_size: int = SUBSCRIBERS_PAGE_SIZE) -> Iterator[str]:
+    """
+    Produce los correos de los suscriptores de la `campaign` (por defecto, la lista de siempre),
+    normalizados, válidos y sin repetir, a medida que se leen: desde la copia local o página a
+    página desde Google Sheets. Si Sheets falla, se descarta la actualización parcial y se
+    completa desde la última copia.
+    """
+    campaign = campaign or Campaign()
+    seen: Set[bytes] = set()
+    with SubscriberSnapshot(campaign.db_file) as snapshot:
+        source = "la copia local"
+        if snapshot.is_fresh(SUBSCRIBERS_CACHE_TTL):
+            log("Usando la copia local reciente de suscriptores.", "info")
+        else:
+            log("Accediendo a Google Sheets para obtener suscriptores...", "info")
+            try:
+                import gspread  # Diferida, como en _sheets_client: una copia local reciente no la necesita
+                yield from _clean_subscribers(_stream_sheet_pages(snapshot, page_size, campaign), seen)
+                source = "la hoja de cálculo"
+            except ImportError as e:
+                # Antes que la cláusula de gspread: si falló su importación, el nombre no existe
+                log(f"Error: no se pudo cargar el cliente de Google Sheets: {e}", "error")
+            except FileNotFoundError:
+                log(f"Error: El archivo de credenciales '{CREDENTIALS_FILE}' no fue encontrado.", "error")
+            except gspread.exceptions.WorksheetNotFound:
+                log(f"Error: La pestaña '{campaign.worksheet}' no fue encontrada. Asegúrate de que el nombre sea correcto.", "error")
+            except Exception as e:
+                log(f"Error al conectar con Google Sheets: {e}", "error")
+            if source == "la copia local":
+                metrics.incr("sheets_fallbacks")
+                snapshot.rollback()
+                log("Se usará la última copia local de suscriptores disponible.", "warning")
+
+        if source == "la copia local":
+            # Los ya producidos desde la hoja quedan en `seen` y no se repiten
+            yield from _clean_subscribers(snapshot.emails(), seen)
+        label = "" if campaign.name == "default" else f" (campaña '{campaign.name}')"
+        log(f"Se encontraron {len(seen)} correos válidos en {source}{label}.", "info")
+
 def get_subscribers_from_sheet() -> List[str]:
     """
-    Se conecta a Google Sheets y obtiene la lista de correos de los suscriptores.
+    Obtiene la lista completa de correos de los suscriptores.
     Retorna una lista de strings con los correos.
     """
-    log("Accediendo a Google Sheets para obtener suscriptores...", "info")
-    try:
-        # Definir los scopes necesarios. Necesitamos leer hojas de cálculo.
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets.readonly",
-            "https://www.googleapis.com/auth/drive.readonly"
-        ]
-        creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=scopes)
-        client = gspread.authorize(creds)
-        
-        spreadsheet = client.open(GOOGLE_SHEET_NAME)
-        worksheet = spreadsheet.worksheet("Hoja 1") # Es más seguro abrir la pestaña por nombre
-        
-        # Asume que los correos están en la columna 2 (B). Omite la primera fila (encabezado).
-        emails = worksheet.col_values(2)[1:]
-        
-        valid_emails = [email for email in emails if '@' in email]
-        log(f"Se encontraron {len(valid_emails)} correos válidos en la hoja de cálculo.", "info")
-        return valid_emails
-    except FileNotFoundError:
-        log(f"Error: El archivo de credenciales '{CREDENTIALS_FILE}' no fue encontrado.", "error")
-        return []
-    except gspread.exceptions.WorksheetNotFound:
-        log("Error: La pestaña 'Hoja 1' no fue encontrada. Asegúrate de que el nombre sea correcto.", "error")
-        return []
-    except Exception as e:
-        log(f"Error al conectar con Google Sheets: {e}", "error")
-        return []
+    return list(iter_subscribers())
 
-# --- Agente de Búsqueda con Gemini ---
-def find_products_with_gemini() -> bool:
+def _peek(iterator: Iterator[str]) -> Optional[Iterator[str]]:
+    """Espera el primer elemento: retorna None si no hay ninguno o un iterador equivalente al original."""
+    first = next(iterator, None)
+    return None if first is None else itertools.chain([first], iterator)
+
+# --- Historial de Productos ---
+# Parámetros de seguimiento/campaña: no identifican el producto (el resto, p. ej. ?id=, sí)
+_TRACKING_PARAM = re.compile(r"^(utm(_\w+)?|gclid|gbraid|wbraid|fbclid|msclkid|dclid|yclid|igshid|srsltid"
+                             r"|mc_cid|mc_eid|_ga|_gl|ref|ref_src|spm)$", re.IGNORECASE)
+
+def _normalize_url(url: str) -> str:
     """
-    Usa Gemini para encontrar 5 productos de skincare innovadores y los guarda en un archivo JSON.
-    Retorna True si la operación fue exitosa, False en caso contrario.
+    Host + ruta en minúsculas, sin esquema, 'www.', fragmento ni barra final. De la consulta se
+    conservan los parámetros que no son de seguimiento, ordenados: '?id=1' y '?id=2' son productos distintos.
     """
-    if not GEMINI_API_KEY:
-        log("GEMINI_API_KEY no está configurada. No se puede realizar la búsqueda.", "error")
-        return False
+    parts = urlsplit(url.strip() if "://" in url else "//" + url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    params = sorted(p for p in parse_qsl(parts.query, keep_blank_values=True) if not _TRACKING_PARAM.match(p[0]))
+    query = f"?{urlencode(params)}" if params else ""
+    return f"{host}{parts.path.rstrip('/').lower()}{query}"
 
-    model = genai.GenerativeModel('gemini-1.5-flash')
+def _normalize_name(name: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", name.casefold()).split())
 
-    # Cargar historial previo para no repetir productos
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as hf:
-            history: List[Dict] = json.load(hf)
-    else:
-        history = []
+# Segmento inicial de idioma/país en la ruta: /en-us/, /es_cl/, /es/...
+_LOCALE_SEGMENT = re.compile(r"^[a-z]{2}(?:[-_][a-z]{2,3})?$")
 
-    seen_keys = {p.get('url') or p.get('nombre') for p in history}
+def _canonical_url(url: str) -> str:
+    """URL normalizada y sin el segmento de idioma, para reconocer el mismo producto en otra región."""
+    address, query, params = _normalize_url(url).partition("?")
+    host, _, path = address.partition("/")
+    segments = [s for s in path.split("/") if s]
+    if segments and _LOCALE_SEGMENT.match(segments[0]):
+        segments = segments[1:]
+    return "/".join([host] + segments) + query + params
 
-    prompt = """
-    Eres un experto en investigación de mercado de skincare de lujo.
-    Realiza una investigación profunda y encuentra los 5 productos de skincare más innovadores y prometedores del último año (2024-2025).
-    Prioriza productos con ingredientes patentados, tecnología novedosa o resultados clínicos demostrables.
+def _display_name(product: Dict) -> str:
+    return " ".join(filter(None, [product.get('marca'), product.get('nombre')]))
+
+def _history_key(product: Dict) -> Optional[str]:
+    """Clave de deduplicación: la URL normalizada o, si no hay, el nombre normalizado."""
+    url = product.get('url')
+    if url and url != '#':
+        return "url:" + _normalize_url(url)
+    name = product.get('nombre')
+    if name:
+        return "nombre:" + _normalize_name(name)
+    return None
+
+_MINHASH_PRIME = (1 << 61) - 1
+# Semilla fija: las firmas se guardan en disco y deben ser comparables entre ejecuciones
+_minhash_rng = random.Random(1729)
+_MINHASH_PARAMS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+                   for _ in range(MINHASH_PERMUTATIONS)]
+_LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+
+def _stable_hash(data: bytes, size: int = 8) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=size).digest(), 'big')
+
+def _shingles(product: Dict) -> Set[str]:
+    """Trigramas de caracteres de 'marca nombre' normalizado."""
+    text = _normalize_name(f"{product.get('marca') or ''} {product.get('nombre') or ''}")
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def _minhash(product: Dict) -> Optional[Tuple[int, ...]]:
+    hashes = [_stable_hash(s.encode('utf-8')) for s in _shingles(product)]
+    if not hashes:
+        return None
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
+
+def _lsh_buckets(signature: Tuple[int, ...]) -> List[Tuple[int, int]]:
+    """(banda, cubeta) de la firma. Dos productos parecidos coinciden en al menos una banda con alta probabilidad."""
+    buckets = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * _LSH_ROWS:(band + 1) * _LSH_ROWS]
+        # 7 bytes: cabe en un INTEGER con signo de SQLite
+        buckets.append((band, _stable_hash(struct.pack(f">{_LSH_ROWS}Q", *rows), size=7)))
+    return buckets
+
+def _similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """Estimación de la similitud de Jaccard a partir de dos firmas MinHash."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+class NearDuplicateIndex:
+    """
+    Índice en memoria de casi-duplicados: clave exacta, URL canónica y cubetas LSH.
+    Se usa para los productos de la búsqueda en curso, que aún no están en el historial.
+    """
+
+    def __init__(self):
+        self._keys: Set[str] = set()
+        self._urls: Set[str] = set()
+        self._buckets: Dict[Tuple[int, int], List[Tuple[str, Tuple[int, ...]]]] = {}
+
+    def add(self, product: Dict):
+        key = _history_key(product)
+        if key:
+            self._keys.add(key)
+        if product.get('url'):
+            self._urls.add(_canonical_url(product['url']))
+        signature = _minhash(product)
+        if signature:
+            for bucket in _lsh_buckets(signature):
+                self._buckets.setdefault(bucket, []).append((key, signature))
+
+    def find(self, product: Dict) -> Optional[str]:
+        """Retorna la clave del producto parecido ya indexado, o None."""
+        key = _history_key(product)
+        if key in self._keys:
+            return key
+        if product.get('url') and _canonical_url(product['url']) in self._urls:
+            return _canonical_url(product['url'])
+        signature = _minhash(product)
+        if signature:
+            for bucket in _lsh_buckets(signature):
+                for other_key, other in self._buckets.get(bucket, ()):
+                    if _similarity(signature, other) >= NEAR_DUPLICATE_THRESHOLD:
+                        return other_key
+        return None
+
+class ProductHistory:
+    """
+    Historial de productos ya enviados, en SQLite e indexado por clave normalizada.
+    Las comprobaciones de pertenencia son búsquedas por índice y los productos nuevos
+    se agregan de forma incremental, sin reescribir el historial completo.
+    Además guarda la URL canónica y la firma MinHash de cada producto, con sus cubetas
+    LSH indexadas, para detectar casi-duplicados sin recorrer todo el historial.
+    """
+
+    def __init__(self, path: str = HISTORY_DB_FILE, legacy_json: Optional[str] = HISTORY_FILE):
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS products ("
+            " key TEXT PRIMARY KEY, nombre TEXT, marca TEXT, url TEXT, data TEXT, added_at TEXT);"
+            "CREATE TABLE IF NOT EXISTS product_signatures ("
+            " key TEXT PRIMARY KEY, canonical_url TEXT, signature BLOB);"
+            "CREATE INDEX IF NOT EXISTS signatures_url ON product_signatures (canonical_url);"
+            "CREATE TABLE IF NOT EXISTS lsh_buckets (band INTEGER, bucket INTEGER, key TEXT);"
+            "CREATE INDEX IF NOT EXISTS lsh_lookup ON lsh_buckets (band, bucket);")
+        self._conn.commit()
+        if legacy_json and os.path.exists(legacy_json):
+            self.migrate_json(legacy_json)
+        self._index_missing_signatures()
+
+    def _index_missing_signatures(self):
+        """Calcula firmas para filas anteriores al índice de casi-duplicados."""
+        rows = self._conn.execute(
+            "SELECT p.key, p.data FROM products p LEFT JOIN product_signatures s ON s.key = p.key"
+            " WHERE s.key IS NULL").fetchall()
+        for key, data in rows:
+            self._index(key, json.loads(data))
+        if rows:
+            self._conn.commit()
+
+    def _index(self, key: str, product: Dict):
+        signature = _minhash(product)
+        url = product.get('url')
+        self._conn.execute("INSERT OR REPLACE INTO product_signatures VALUES (?, ?, ?)",
+                           (key, _canonical_url(url) if url else None,
+                            struct.pack(f">{MINHASH_PERMUTATIONS}Q", *signature) if signature else None))
+        if signature:
+            self._conn.executemany("INSERT INTO lsh_buckets VALUES (?, ?, ?)",
+                                   [(band, bucket, key) for band, bucket in _lsh_buckets(signature)])
+
+    def find_duplicate(self, product: Dict) -> Optional[str]:
+        """
+        Retorna la clave del producto del historial que coincide con `product`: misma clave,
+        misma URL canónica o firma MinHash con similitud >= NEAR_DUPLICATE_THRESHOLD.
+        """
+        key = _history_key(product)
+        if key and self.contains_key(key):
+            return key
+        url = product.get('url')
+        if url:
+            row = self._conn.execute("SELECT key FROM product_signatures WHERE canonical_url = ?",
+                                     (_canonical_url(url),)).fetchone()
+            if row:
+                return row[0]
+        signature = _minhash(product)
+        if not signature:
+            return None
+        candidates = set()
+        for band, bucket in _lsh_buckets(signature):
+            candidates.update(k for (k,) in self._conn.execute(
+                "SELECT key FROM lsh_buckets WHERE band = ? AND bucket = ?", (band, bucket)))
+        for candidate in candidates:
+            row = self._conn.execute("SELECT signature FROM product_signatures WHERE key = ?", (candidate,)).fetchone()
+            if row and row[0] and _similarity(signature, struct.unpack(f">{MINHASH_PERMUTATIONS}Q", row[0])) \
+                    >= NEAR_DUPLICATE_THRESHOLD:
+                return candidate
+        return None
+
+    def migrate_json(self, path: str) -> int:
+        """Importa un product_history.json antiguo y lo renombra a *.migrated para no releerlo."""
+        with open(path, 'r', encoding='utf-8') as f:
+            products: List[Dict] = json.load(f)
+        added = self.add_many(products)
+        os.replace(path, path + ".migrated")
+        log(f"Historial migrado desde '{path}': {added} productos importados.", "info")
+        return added
+
+    def contains(self, product: Dict) -> bool:
+        key = _history_key(product)
+        return key is not None and self.contains_key(key)
+
+    def contains_key(self, key: str) -> bool:
+        return self._conn.execute("SELECT 1 FROM products WHERE key = ?", (key,)).fetchone() is not None
+
+    def add_many(self, products: Iterable[Dict]) -> int:
+        """Agrega los productos que aún no están en el historial. Retorna cuántos se agregaron."""
+        now = datetime.now().isoformat(timespec='seconds')
+        added = 0
+        for product in products:
+            key = _history_key(product)
+            if not key:
+                continue
+            row = (key, product.get('nombre'), product.get('marca'), product.get('url'),
+                   json.dumps(product, ensure_ascii=False), now)
+            if self._conn.execute("INSERT OR IGNORE INTO products VALUES (?, ?, ?, ?, ?, ?)", row).rowcount:
+                self._index(key, product)
+                added += 1
+        self._conn.commit()
+        return added
+
+    def recent_names(self, limit: int) -> List[str]:
+        """'Marca Nombre' de los `limit` productos agregados más recientemente."""
+        rows = self._conn.execute(
+            "SELECT marca, nombre FROM products ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
+        return [_display_name({"marca": marca, "nombre": nombre}) for marca, nombre in rows]
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
 
-    Para cada producto, proporciona la información en un objeto JSON con esta estructura exacta:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- Agente de Búsqueda con Gemini ---
+PRODUCT_SCHEMA_PROMPT = """
     {
       "nombre": "string",
       "marca": "string",
@@ -113,62 +1126,254 @@ def find_products_with_gemini() -> bool:
       "tipo_piel": "string",
       "estudios_clinicos": "string (resumen breve si aplica)",
       "sostenibilidad": "string (detalles sobre empaque o ingredientes si aplica)"
-    }
-    Devuelve SÓLO un array JSON que contenga 5 de estos objetos. No incluyas "```json" ni nada más que el array.
+    }"""
+
+def _build_search_prompt(count: int, exclude: List[str]) -> str:
+    """Prompt de búsqueda que pide exactamente `count` productos y lista los que ya no sirven."""
+    exclusions = ""
+    if exclude:
+        exclusions = ("\n    NO incluyas ninguno de estos productos (ya fueron enviados o elegidos): "
+                      + "; ".join(exclude) + ".\n")
+    return f"""
+    Eres un experto en investigación de mercado de skincare de lujo.
+    Realiza una investigación profunda y encuentra los {count} productos de skincare más innovadores y prometedores del último año (2024-2025).
+    Prioriza productos con ingredientes patentados, tecnología novedosa o resultados clínicos demostrables.
+    {exclusions}
+    Para cada producto, proporciona la información en un objeto JSON con esta estructura exacta:{PRODUCT_SCHEMA_PROMPT}
+    Devuelve SÓLO un array JSON que contenga {count} de estos objetos. No incluyas "```json" ni nada más que el array.
     """
-    
+
+# Campos del esquema pedido en el prompt: texto o lista de textos
+PRODUCT_SCHEMA = {field: list if isinstance(example, list) else str
+                  for field, example in json.loads(PRODUCT_SCHEMA_PROMPT).items()}
+PRODUCT_REQUIRED_FIELDS = ("nombre", "marca")
+_PRODUCT_URL = re.compile(r"^https?://[^\s/]+\.[^\s]+$", re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+def _loads_lenient(text: str):
+    """json.loads que tolera saltos de línea dentro de los textos y comas finales sobrantes."""
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return json.loads(_TRAILING_COMMA.sub(r"\1", text), strict=False)
+
+def _iter_json_objects(chunks: Iterable[str]) -> Iterable[Dict]:
+    """
+    Extrae los objetos JSON a medida que llegan los fragmentos de texto, sin esperar al final
+    de la respuesta: los de primer nivel y los elementos de cualquier array, de modo que los
+    productos de un {"productos": [...]} envolvente salen uno a uno (y después el envoltorio).
+    Se ignora el texto alrededor (```json, explicaciones), un array truncado conserva sus
+    objetos completos y los objetos mal formados se descartan.
+    """
+    stack: List[str] = []  # contenedores abiertos: "{" o "["
+    captures: List[Tuple[int, List[str]]] = []  # (profundidad, texto) de los objetos en curso
+    in_string = escaped = False
+    for chunk in chunks:
+        for char in chunk:
+            for _, text in captures:
+                text.append(char)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                if char == "{" and (not stack or stack[-1] == "["):
+                    captures.append((len(stack) + 1, [char]))
+                stack.append(char)
+            elif char in "}]" and stack:
+                stack.pop()
+                if captures and len(stack) < captures[-1][0]:
+                    _, text = captures.pop()
+                    try:
+                        obj = _loads_lenient("".join(text))
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(obj, dict):
+                        yield obj
+
+def _validate_product(obj: Dict) -> Optional[Dict]:
+    """
+    Ajusta un objeto de la respuesta al esquema de producto: conserva sólo los campos conocidos,
+    pasa a texto los valores simples y a lista los textos separados por comas donde corresponde,
+    y descarta URLs que no son http(s). Retorna None si faltan los campos obligatorios.
+    """
+    product: Dict = {}
+    for field, kind in PRODUCT_SCHEMA.items():
+        value = obj.get(field)
+        if kind is list:
+            if isinstance(value, str):
+                value = value.split(",")
+            if not isinstance(value, list):
+                continue
+            value = [str(item).strip() for item in value if isinstance(item, (str, int, float))]
+            value = [item for item in value if item]
+        elif isinstance(value, (str, int, float)):
+            value = str(value).strip()
+        else:
+            continue
+        if value:
+            product[field] = value
+    if not all(product.get(field) for field in PRODUCT_REQUIRED_FIELDS):
+        return None
+    if "url" in product and not _PRODUCT_URL.match(product["url"]):
+        del product["url"]
+    return product
+
+def _iter_products(chunks: Iterable[str]) -> Iterable[Dict]:
+    """Productos válidos según el esquema, extraídos de la respuesta a medida que llega."""
+    for obj in _iter_json_objects(chunks):
+        product = _validate_product(obj)
+        if product is None:
+            if any(isinstance(value, list) and value and isinstance(value[0], dict) for value in obj.values()):
+                continue  # Envoltorio cuyos productos ya se procesaron
+            metrics.incr("gemini_invalid_products")
+            log(f"Objeto descartado: no cumple el esquema de producto ({', '.join(sorted(obj)[:5])}).", "warning")
+            continue
+        yield product
+
+@instrumented("gemini_search")
+def find_products_with_gemini() -> bool:
+    """
+    Usa Gemini para encontrar 5 productos de skincare innovadores y los guarda en un archivo JSON.
+    Cada intento pide sólo los productos que faltan (más SEARCH_OVERSAMPLE de margen), excluye
+    los ya vistos y procesa la respuesta en streaming, cortándola en cuanto se completa la cuota.
+    Retorna True si la operación fue exitosa, False en caso contrario.
+    """
+    if not GEMINI_API_KEY:
+        log("GEMINI_API_KEY no está configurada. No se puede realizar la búsqueda.", "error")
+        return False
+
     log("Iniciando búsqueda de productos con Gemini...", "info")
+    try:
+        # Historial previo para no repetir productos
+        history = ProductHistory(HISTORY_DB_FILE, HISTORY_FILE)
+    except Exception as e:
+        log(f"Error al abrir el historial de productos: {e}", "error")
+        return False
+
+    calls_before, tokens_before = metrics.counter("gemini_api_calls"), metrics.counter("gemini_tokens")
     try:
         unique_products: List[Dict] = []
+        # Productos ya elegidos en esta búsqueda (aún no están en el historial)
+        batch_index = NearDuplicateIndex()
         attempts = 0
+        recent = history.recent_names(SEARCH_EXCLUDE_LIMIT)
 
         while len(unique_products) < 5 and attempts < 5:
-            response = model.generate_content(prompt)
-            # Limpiar la respuesta para asegurar que sea un JSON válido
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-            try:
-                products_batch = json.loads(cleaned_response)
-            except json.JSONDecodeError:
-                log("La respuesta de Gemini no era JSON válido. Reintentando...", "warning")
-                attempts += 1
-                continue
+            if attempts:
+                metrics.incr("gemini_search_retries")
+            attempts += 1
+            missing = 5 - len(unique_products)
+            chosen = [_display_name(p) for p in unique_products]
+            prompt = _build_search_prompt(missing + SEARCH_OVERSAMPLE, recent + chosen)
 
-            for prod in products_batch:
-                key = prod.get('url') or prod.get('nombre')
-                if key and key not in seen_keys and len(unique_products) < 5:
-                    unique_products.append(prod)
-                    seen_keys.add(key)
+            # Sin caché: cada intento debe traer productos nuevos. Se aprovechan todos los productos
+            # válidos aunque la respuesta venga truncada o con texto extra; sólo se reintenta lo que falta.
+            found = 0
+            for prod in _iter_products(_stream_content(prompt)):
+                found += 1
+                duplicate = batch_index.find(prod) or history.find_duplicate(prod)
+                if duplicate:
+                    log(f"Descartado '{prod.get('nombre')}': parecido a un producto ya visto ({duplicate}).", "info")
+                    continue
+                unique_products.append(prod)
+                batch_index.add(prod)
+                if len(unique_products) >= 5:
+                    # Cuota completa: no hace falta esperar el resto de la respuesta
+                    break
 
-            attempts += 1
+            if not found:
+                log("La respuesta de Gemini no contenía productos válidos. Reintentando...", "warning")
 
+        calls = metrics.counter("gemini_api_calls") - calls_before
+        tokens = metrics.counter("gemini_tokens") - tokens_before
         if len(unique_products) < 5:
-            log("No se pudieron obtener 5 productos únicos tras múltiples intentos.", "error")
+            log(f"No se pudieron obtener 5 productos únicos tras {calls} llamadas ({tokens} tokens).", "error")
             return False
 
         # Guardar la lista semanal
         with open(WEEKLY_PRODUCTS_FILE, 'w', encoding='utf-8') as f:
             json.dump(unique_products, f, indent=4, ensure_ascii=False)
 
-        # Actualizar historial global
-        history.extend(unique_products)
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as hf:
-            json.dump(history, hf, indent=4, ensure_ascii=False)
+        # Actualizar historial global (sólo se agregan las filas nuevas)
+        history.add_many(unique_products)
 
-        log(f"Búsqueda exitosa. Se guardaron {len(unique_products)} productos únicos.", "info")
+        log(f"Búsqueda exitosa. Se guardaron {len(unique_products)} productos únicos "
+            f"con {calls} llamadas a la API y {tokens} tokens.", "info")
         return True
 
     except Exception as e:
         log(f"Error durante la búsqueda con Gemini: {e}", "error")
         return False
+    finally:
+        history.close()
 
 # --- Agente de Contenido con Gemini ---
-def generate_newsletter_with_gemini(product: Dict) -> str:
-    """Genera el contenido del newsletter con un enfoque educativo y accesible."""
+_SECTION_SEPARATOR = '<hr style="border: 1px solid #f0eafc; margin: 30px 0;">'
+
+def _strip_fences(text: str) -> str:
+    """Quita el bloque de código Markdown (```html ... ```) que a veces envuelve la respuesta."""
+    cleaned = text.strip()
+    if cleaned.startswith("```html"):
+        cleaned = cleaned[7:]
+    elif cleaned.startswith("```"):
+        cleaned = cleaned[3:]
+    if cleaned.endswith("```"):
+        cleaned = cleaned[:-3]
+    return cleaned.strip()
+
+def _check_newsletter(text: str, complete: bool) -> Optional[bool]:
+    """Validación para `_generate_content`: el HTML debe empezar con una etiqueta y terminar siendo un newsletter válido."""
+    html = _strip_fences(text)
+    if complete:
+        return _is_valid_newsletter(html)
+    if len(html) < 16:
+        return None
+    return html.startswith("<")
+
+def _render_fallback_newsletter(product: Dict) -> str:
+    """
+    Newsletter de respaldo armado sólo con los datos del producto, con la misma estructura
+    que pide el prompt. Se usa cuando Gemini no responde a tiempo o su respuesta no sirve.
+    """
+    def bullet_list(values: List[str]) -> str:
+        return "<ul>" + "".join(f"<li>{escape(str(value))}</li>" for value in values) + "</ul>"
+
+    parts = [
+        f"<h1>{escape(product.get('marca', 'Marca'))} - {escape(product.get('nombre', 'Nombre del Producto'))}</h1>",
+        "<h2>💡 ¿Qué es y qué lo hace especial?</h2>",
+        f"<p>{escape(product.get('descripcion') or 'Descripción no disponible.')}</p>",
+    ]
+    if product.get('tecnologia'):
+        parts.append(f"<p><b>Tecnología:</b> {escape(product['tecnologia'])}</p>")
+    if product.get('ingredientes'):
+        parts += [_SECTION_SEPARATOR, "<h2>🔬 Ingredientes clave</h2>", bullet_list(product['ingredientes'])]
+    if product.get('beneficios'):
+        parts += ["<h2>✨ Beneficios</h2>", bullet_list(product['beneficios'])]
+    details = [(label, product.get(field)) for label, field in (
+        ("Tipo de piel", "tipo_piel"), ("Estudios clínicos", "estudios_clinicos"),
+        ("Sostenibilidad", "sostenibilidad"), ("Precio", "precio")) if product.get(field)]
+    if details:
+        parts += [_SECTION_SEPARATOR, "<h2>✅ Resumen Clave</h2>",
+                  "<ul>" + "".join(f"<li><b>{label}:</b> {escape(str(value))}</li>" for label, value in details) + "</ul>"]
+    return "\n".join(parts)
+
+@instrumented("gemini_generate")
+def generate_newsletter_with_gemini(product: Dict, allow_fallback: bool = True) -> str:
+    """
+    Genera el contenido del newsletter con un enfoque educativo y accesible.
+    La respuesta llega en streaming y se valida mientras llega; si no termina dentro de
+    GEMINI_GENERATION_BUDGET segundos o no es HTML válido, se usa la plantilla de respaldo
+    (o, con `allow_fallback=False`, se lanza la excepción).
+    """
     if not GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY no está configurada.")
 
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    
     # Construcción dinámica de la lista de ingredientes para el prompt
     ingredients_list_html = ""
     for ing in product.get('ingredientes', []):
@@ -216,160 +1421,1358 @@ def generate_newsletter_with_gemini(product: Dict) -> str:
     
     log(f"Generando newsletter para '{product.get('nombre')}'...", "info")
     try:
-        response = model.generate_content(prompt)
-        # Limpieza final para eliminar cualquier bloque de código Markdown
-        cleaned_html = response.text.strip()
-        if cleaned_html.startswith("```html"):
-            cleaned_html = cleaned_html[7:]
-        if cleaned_html.endswith("```"):
-            cleaned_html = cleaned_html[:-3]
-        
-        return cleaned_html.strip()
+        # Una re-ejecución del mismo día reutiliza el newsletter ya generado
+        response_text = _generate_content(prompt, budget=GEMINI_GENERATION_BUDGET, validate=_check_newsletter)
+        return _strip_fences(response_text)
+    except (TimeoutError, ValueError) as e:
+        if not allow_fallback:
+            log(f"No se generó el newsletter de '{product.get('nombre')}': {e}.", "warning")
+            raise
+        # La plantilla no se guarda en caché: la próxima ejecución vuelve a intentar con Gemini
+        metrics.incr("gemini_fallbacks")
+        log(f"{e}. Se usará la plantilla de respaldo con los datos del producto.", "warning")
+        return _render_fallback_newsletter(product)
     except Exception as e:
         log(f"Error generando contenido con Gemini: {e}", "error")
         raise
 
-# --- Agente de Email ---
-def send_email(subject: str, body_html: str, product_url: str, recipients: List[str]):
-    """Envía el newsletter con un diseño visualmente mágico a una lista de destinatarios."""
-    if not all([EMAIL_SENDER, SMTP_SERVER, SMTP_PORT, SMTP_PASS]):
-        log("Credenciales de email incompletas. No se puede enviar.", "error")
-        raise ValueError("Credenciales de email incompletas.")
+# --- Pre-generación Semanal ---
+def _product_key(product: Dict) -> Optional[str]:
+    return product.get('url') or product.get('nombre')
 
-    if not recipients:
-        log("No hay destinatarios a los que enviar el correo.", "warning")
-        return
+def _is_valid_newsletter(html: str) -> bool:
+    """Comprobación mínima: HTML no vacío con al menos un título y sin restos de Markdown."""
+    return bool(html) and ("<h1" in html or "<h2" in html) and not html.lstrip().startswith(("#", "```"))
+
+def pregenerate_weekly_newsletters(products: List[Dict]) -> int:
+    """
+    Genera en paralelo los newsletters de todos los productos de la semana (hasta
+    GEMINI_MAX_CONCURRENCY a la vez, respetando el límite de llamadas por minuto),
+    valida cada uno y guarda los válidos en WEEKLY_NEWSLETTERS_FILE.
+    Retorna cuántos newsletters quedaron guardados.
+    """
+    def generate(product: Dict) -> Optional[str]:
+        try:
+            # Sin plantilla de respaldo: si Gemini falla, ese día se vuelve a intentar
+            html = generate_newsletter_with_gemini(product, allow_fallback=False)
+        except Exception:
+            return None
+        if not _is_valid_newsletter(html):
+            log(f"El newsletter de '{product.get('nombre')}' no pasó la validación.", "warning")
+            return None
+        return html
+
+    log(f"Pre-generando {len(products)} newsletters de la semana...", "info")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, GEMINI_MAX_CONCURRENCY)) as executor:
+        results = list(executor.map(generate, products))
+
+    newsletters = {_product_key(p): html for p, html in zip(products, results) if html and _product_key(p)}
+    with open(WEEKLY_NEWSLETTERS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(newsletters, f, indent=4, ensure_ascii=False)
+    log(f"{len(newsletters)} de {len(products)} newsletters pre-generados en {time.perf_counter() - start:.2f}s.", "info")
+    return len(newsletters)
+
+def _newsletter_for(product: Dict) -> str:
+    """Retorna el newsletter pre-generado del producto o, si no existe, lo genera ahora."""
+    if os.path.exists(WEEKLY_NEWSLETTERS_FILE):
+        with open(WEEKLY_NEWSLETTERS_FILE, 'r', encoding='utf-8') as f:
+            html = json.load(f).get(_product_key(product))
+        if html and _is_valid_newsletter(html):
+            log("Usando el newsletter pre-generado para hoy.", "info")
+            return html
+    return generate_newsletter_with_gemini(product)
+
+def _run_weekly_search() -> bool:
+    """Búsqueda de los lunes seguida de la pre-generación de los newsletters de la semana."""
+    log("Día de búsqueda. Iniciando la caza de productos innovadores...", "info")
+    if not find_products_with_gemini():
+        log("La búsqueda semanal falló. Reintentando en la próxima ejecución.", "error")
+        return False
+    with open(WEEKLY_PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+        products = json.load(f)
+    # Si la pre-generación falla, cada día generará su newsletter como antes
+    pregenerate_weekly_newsletters(products)
+    return True
+
+# --- Pool de Conexiones SMTP ---
+class _PooledConnection:
+    """Una ranura del pool: la sesión SMTP abierta y cuántos mensajes lleva."""
+
+    def __init__(self):
+        self.server: Optional[smtplib.SMTP] = None
+        self.sent = 0
+
+
+class SMTPConnectionPool:
+    """
+    Mantiene un conjunto de conexiones SMTP autenticadas que se comparten entre hilos.
+    Cada conexión se recicla al llegar a `max_per_session` mensajes y se reabre
+    automáticamente si el servidor cierra la sesión.
+    """
+
+    def __init__(self, host: str, port: int, user: Optional[str] = None, password: Optional[str] = None,
+                 size: int = SMTP_POOL_SIZE, max_per_session: int = SMTP_MAX_PER_SESSION,
+                 use_ssl: Optional[bool] = None, starttls: bool = True, timeout: int = 30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = max(1, size)
+        self.max_per_session = max(1, max_per_session)
+        # Igual que antes: SSL directo en el puerto 465, STARTTLS en el resto
+        self.use_ssl = port == 465 if use_ssl is None else use_ssl
+        self.starttls = starttls and not self.use_ssl
+        self.timeout = timeout
+        self._slots: "queue.Queue[_PooledConnection]" = queue.Queue()
+        self._all = [_PooledConnection() for _ in range(self.size)]
+        for slot in self._all:
+            self._slots.put(slot)
+
+    def _open(self) -> smtplib.SMTP:
+        if self.use_ssl:
+            context = ssl.create_default_context()
+            server = smtplib.SMTP_SSL(self.host, self.port, context=context, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls(context=ssl.create_default_context())
+            if self.user and self.password:
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _reconnect(self, slot: _PooledConnection):
+        self._discard(slot)
+        slot.server = self._open()
+        slot.sent = 0
 
-    # Paleta de colores "mágica"
-    color_bg = "#f0eafc" # Lavanda pálido
-    color_header_bg = "#3c1053" # Morado oscuro
-    color_header_text = "#ffffff" # Blanco
-    color_title = "#6a1b9a" # Morado
-    color_subtitle = "#8e24aa" # Púrpura
-    color_text = "#4a4a4a" # Gris oscuro
-    color_accent = "#d1c4e9" # Lavanda más oscuro
-
-    html_content = f"""
-    <html>
+    @staticmethod
+    def _discard(slot: _PooledConnection):
+        if slot.server is not None:
+            try:
+                slot.server.quit()
+            except Exception:
+                slot.server.close()
+        slot.server = None
+
+    def connect(self, count: int = 1):
+        """Abre por adelantado `count` conexiones. Falla de inmediato si las credenciales son inválidas."""
+        for slot in self._all[:count]:
+            if slot.server is None:
+                self._reconnect(slot)
+
+    def sendmail(self, from_addr: str, to_addrs: List[str], msg) -> Dict:
+        """Envía un mensaje usando la primera conexión libre, reconectando una vez si la sesión se cayó."""
+        slot = self._slots.get()
+        try:
+            for attempt in range(2):
+                if slot.server is None or slot.sent >= self.max_per_session:
+                    self._reconnect(slot)
+                try:
+                    refused = slot.server.sendmail(from_addr, to_addrs, msg)
+                    slot.sent += 1
+                    return refused
+                except smtplib.SMTPServerDisconnected:
+                    slot.server = None
+                    if attempt:
+                        raise
+                    metrics.incr("smtp_reconnects")
+                    log("La sesión SMTP se cerró. Reconectando...", "warning")
+        finally:
+            self._slots.put(slot)
+
+    def close(self):
+        for slot in self._all:
+            self._discard(slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MaildirBackend:
+    """
+    Backend de entrega que escribe cada mensaje en un Maildir (tmp/ -> new/) en vez de enviarlo:
+    sirve para ensayos y pruebas de carga sin red, y para entregar el spool a un MTA dedicado.
+
+    Formato de entrega al relay: el mensaje en new/<nombre> es exactamente el que se enviaría por
+    SMTP, con fin de línea LF como todo Maildir y sin cabeceras de sobre (en modo por lotes no debe
+    revelar a los demás destinatarios). El sobre va aparte, en envelope/<nombre> (mismo nombre):
+    un JSON {"from": remitente, "to": [destinatarios]}. Se escribe antes de mover el mensaje a
+    new/, así que todo mensaje visible tiene su sobre; el relay debe borrar ambos al terminar.
+    Cada mensaje se escribe con una sola escritura en buffer y sin fsync; `close` sincroniza
+    los directorios una vez al final.
+    """
+
+    def __init__(self, directory: str = DELIVERY_SPOOL_DIR, size: int = SMTP_POOL_SIZE, buffer_size: int = 1 << 20):
+        self.directory = directory
+        self.size = max(1, size)
+        self.buffer_size = buffer_size
+        self.written = 0
+        self._tmp = os.path.join(directory, "tmp")
+        self._new = os.path.join(directory, "new")
+        self._envelope = os.path.join(directory, "envelope")
+        self._prefix = f"{int(time.time())}.P{os.getpid()}"
+        self._host = socket.gethostname().replace("/", "_").replace(":", "_")
+        self._counter = itertools.count()
+
+    def connect(self, count: int = 1):
+        for path in (self._tmp, self._new, self._envelope, os.path.join(self.directory, "cur")):
+            os.makedirs(path, exist_ok=True)
+
+    def sendmail(self, from_addr: str, to_addrs: List[str], msg) -> Dict:
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        name = f"{self._prefix}Q{next(self._counter)}.{self._host}"
+        tmp_path = os.path.join(self._tmp, name)
+        envelope_tmp = tmp_path + ".envelope"
+        with open(envelope_tmp, 'w', encoding='utf-8') as f:
+            json.dump({"from": from_addr, "to": list(to_addrs)}, f)
+        with open(tmp_path, 'wb', buffering=self.buffer_size) as f:
+            f.write(msg.replace(b"\r\n", b"\n"))
+        # Los rename son atómicos: el MTA nunca ve un mensaje a medio escribir ni sin su sobre
+        os.rename(envelope_tmp, os.path.join(self._envelope, name))
+        os.rename(tmp_path, os.path.join(self._new, name))
+        self.written += 1
+        return {}
+
+    def close(self):
+        if self.written and hasattr(os, "O_DIRECTORY"):
+            for path in (self._envelope, self._new):
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NullBackend:
+    """Backend de entrega que descarta los mensajes; sólo cuenta mensajes, destinatarios y bytes."""
+
+    def __init__(self, size: int = SMTP_POOL_SIZE):
+        self.size = max(1, size)
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def connect(self, count: int = 1):
+        pass
+
+    def sendmail(self, from_addr: str, to_addrs: List[str], msg) -> Dict:
+        with self._lock:
+            self.messages += 1
+            self.recipients += len(to_addrs)
+            self.bytes += len(msg)
+        return {}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def create_delivery_backend(name: Optional[str] = None):
+    """
+    Crea el backend de entrega indicado (por defecto DELIVERY_BACKEND). Todos exponen la interfaz
+    del pool SMTP: `size`, `connect`, `sendmail` (retorna los rechazos) y `close`.
+    """
+    name = (name or DELIVERY_BACKEND).lower()
+    if name == "smtp":
+        return SMTPConnectionPool(SMTP_SERVER, SMTP_PORT, EMAIL_SENDER, SMTP_PASS)
+    if name == "maildir":
+        return MaildirBackend(DELIVERY_SPOOL_DIR)
+    if name == "null":
+        return NullBackend()
+    raise ValueError(f"Backend de entrega desconocido: {name}")
+
+
+def _needs_smtp_credentials(backend) -> bool:
+    return isinstance(backend, SMTPConnectionPool) and not all([EMAIL_SENDER, SMTP_SERVER, SMTP_PORT, SMTP_PASS])
+
+
+_UTF8_QP = Charset('utf-8')
+_UTF8_QP.body_encoding = QP
+
+
+class PreparedMessage:
+    """
+    Newsletter renderizado una sola vez: las partes MIME se codifican a bytes al construirlo
+    y por cada destinatario sólo se añade la cabecera To: (y cabeceras opcionales).
+    """
+
+    def __init__(self, subject: str, html_content: str, sender: str):
+        msg = MIMEMultipart('alternative')
+        msg['From'] = sender
+        msg['Subject'] = subject
+        # Quoted-printable: el HTML es casi todo ASCII y así ocupa bastante menos que en base64
+        msg.attach(MIMEText(html_content, 'html', _UTF8_QP))
+        raw = msg.as_bytes(policy=policy.compat32.clone(linesep="\r\n"))
+        # Todo hasta el último CRLF de las cabeceras es compartido; el resto (línea vacía + cuerpo) también
+        header_end = raw.index(b"\r\n\r\n") + 2
+        self.headers = raw[:header_end]
+        self.body = raw[header_end:]
+
+    @staticmethod
+    def _encode(value: str) -> bytes:
+        if value.isascii():
+            return value.encode('ascii')
+        return Header(value, 'utf-8').encode().encode('ascii')
+
+    def render(self, recipient: str, extra_headers: Optional[Dict[str, str]] = None) -> bytes:
+        """Retorna el mensaje completo en bytes para `recipient`, listo para `sendmail`."""
+        parts = [self.headers, b"To: ", self._encode(recipient), b"\r\n"]
+        if extra_headers:
+            for name, value in extra_headers.items():
+                parts += [name.encode('ascii'), b": ", self._encode(value), b"\r\n"]
+        parts.append(self.body)
+        return b"".join(parts)
+
+
+def _recipient_headers(recipient: str) -> Optional[Dict[str, str]]:
+    """Cabeceras propias de cada destinatario (por ahora sólo List-Unsubscribe)."""
+    if not LIST_UNSUBSCRIBE_URL:
+        return None
+    return {"List-Unsubscribe": f"<{LIST_UNSUBSCRIBE_URL.format(email=recipient)}>"}
+
+
+def _batch_headers() -> Optional[Dict[str, str]]:
+    """Cabeceras de un sobre compartido: List-Unsubscribe sólo si la URL no es personalizada."""
+    if not LIST_UNSUBSCRIBE_URL or "{email}" in LIST_UNSUBSCRIBE_URL:
+        return None
+    return {"List-Unsubscribe": f"<{LIST_UNSUBSCRIBE_URL}>"}
+
+
+def _domain(recipient: str) -> str:
+    return recipient.rpartition("@")[2].lower()
+
+def _parse_domain_rates(spec: str) -> Dict[str, float]:
+    """'gmail.com=5,outlook.com=2' -> {'gmail.com': 5.0, 'outlook.com': 2.0}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        domain, _, rate = item.partition("=")
+        rates[domain.strip().lower()] = float(rate)
+    return rates
+
+class DomainScheduler:
+    """
+    Planificador de envíos: agrupa los destinatarios por dominio, limita el ritmo con un
+    token bucket por dominio y otro global, y alterna entre dominios (round-robin) para que
+    un proveedor lento no frene a los demás. Ante rechazos temporales (4xx) pausa el dominio
+    con espera exponencial y vuelve a encolar la dirección; los envíos exitosos reducen la pausa.
+
+    Los productores llaman a `put` (bloquea si hay `max_pending` direcciones sin terminar) y
+    luego a `close`; los hilos de envío llaman a `get` hasta recibir None.
+    Con `share_with`, los límites, las pausas por dominio y el bloqueo son los del otro
+    planificador (campañas simultáneas, ver CampaignScheduler).
+    """
+
+    def __init__(self, batch_size: int = 1, domain_rate: float = 0.0, global_rate: float = 0.0,
+                 domain_rates: Optional[Dict[str, float]] = None, max_attempts: int = 1,
+                 backoff_base: float = 5.0, backoff_max: float = 300.0, max_pending: int = 1000,
+                 share_with: Optional["DomainScheduler"] = None):
+        self.batch_size = max(1, batch_size)
+        self.domain_rate = domain_rate
+        self.domain_rates = domain_rates or {}
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_pending = max(1, max_pending)
+        self._global = TokenBucket(global_rate, global_rate)
+        self._queues: Dict[str, deque] = {}
+        self._rotation: deque = deque()  # dominios con direcciones en cola, en orden de turno
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._paused_until: Dict[str, float] = {}
+        self._backoff: Dict[str, float] = {}
+        self._attempts: Dict[str, int] = {}
+        self._pending = 0  # en cola + en vuelo
+        self._closed = False
+        self._cond = threading.Condition()
+        if share_with is not None:
+            self._global, self._buckets = share_with._global, share_with._buckets
+            self._paused_until, self._backoff = share_with._paused_until, share_with._backoff
+            self._cond = share_with._cond
+
+    def _enqueue(self, recipient: str, front: bool = False):
+        domain = _domain(recipient)
+        queue_ = self._queues.get(domain)
+        if queue_ is None:
+            queue_ = self._queues[domain] = deque()
+        if domain not in self._buckets:
+            rate = self.domain_rates.get(domain, self.domain_rate)
+            self._buckets[domain] = TokenBucket(rate, rate)
+        if not queue_:
+            self._rotation.append(domain)
+        if front:
+            queue_.appendleft(recipient)
+        else:
+            queue_.append(recipient)
+
+    def put(self, recipient: str):
+        with self._cond:
+            while self._pending >= self.max_pending:
+                self._cond.wait()
+            self._pending += 1
+            self._enqueue(recipient)
+            self._cond.notify_all()
+
+    def close(self):
+        """No habrá más direcciones nuevas (las diferidas aún pueden volver a la cola)."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def finished(self) -> bool:
+        """Cerrado y sin direcciones en cola ni en vuelo (llamar con el bloqueo tomado)."""
+        return self._closed and not self._pending
+
+    def get(self) -> Optional[List[str]]:
+        """Bloquea hasta el próximo lote listo para enviar (mismo dominio), o None si ya no queda nada."""
+        with self._cond:
+            while True:
+                if self.finished:
+                    return None
+                batch, wait = self._poll()
+                if batch:
+                    return batch
+                self._cond.wait(timeout=wait)
+
+    def _poll(self) -> Tuple[Optional[List[str]], Optional[float]]:
+        """
+        Toma el próximo lote si hay uno listo; si no, retorna cuánto esperar (None: hasta que
+        llegue algo). Se llama con el bloqueo tomado.
+        """
+        wait = self._global.wait_time()
+        if wait:
+            return None, wait
+        wait = None
+        now = time.monotonic()
+        for _ in range(len(self._rotation)):
+            domain = self._rotation[0]
+            self._rotation.rotate(-1)
+            domain_wait = max(self._paused_until.get(domain, 0) - now, self._buckets[domain].wait_time())
+            if domain_wait <= 0:
+                return self._take(domain), None
+            wait = domain_wait if wait is None else min(wait, domain_wait)
+        return None, wait
+
+    def _take(self, domain: str) -> List[str]:
+        # Una ficha por destinatario, no por lote: el lote se recorta a las fichas disponibles
+        # (_poll ya comprobó que hay al menos una en cada balde)
+        bucket, queue_ = self._buckets[domain], self._queues[domain]
+        size = int(min(self.batch_size, len(queue_), bucket.available(), self._global.available()))
+        bucket.try_acquire(size)
+        self._global.try_acquire(size)
+        batch = [queue_.popleft() for _ in range(size)]
+        if not queue_:
+            self._rotation.remove(domain)
+        return batch
+
+    def complete(self, recipient: str, ok: bool = True):
+        """Marca la dirección como terminada (entregada o con fallo definitivo)."""
+        domain = _domain(recipient)
+        with self._cond:
+            self._pending -= 1
+            self._attempts.pop(recipient, None)
+            if ok and self._backoff.get(domain):
+                # Recuperación gradual tras una racha de rechazos temporales
+                self._backoff[domain] /= 2
+            self._cond.notify_all()
+
+    def defer(self, recipient: str) -> bool:
+        """
+        Rechazo temporal: pausa el dominio y vuelve a encolar la dirección.
+        Retorna False si ya agotó sus intentos (el llamador debe registrarla como fallida y completarla).
+        """
+        domain = _domain(recipient)
+        with self._cond:
+            attempts = self._attempts.get(recipient, 1) + 1
+            if attempts > self.max_attempts:
+                return False
+            self._attempts[recipient] = attempts
+            backoff = min(self.backoff_max, max(self.backoff_base, 2 * self._backoff.get(domain, 0)))
+            self._backoff[domain] = backoff
+            self._paused_until[domain] = max(self._paused_until.get(domain, 0), time.monotonic() + backoff)
+            self._enqueue(recipient, front=True)
+            self._cond.notify_all()
+            return True
+
+
+class CampaignScheduler:
+    """
+    Varias campañas sobre el mismo pool de envío: cada una tiene su propio DomainScheduler
+    (creado con `add`), pero todos comparten los límites por dominio y global y las pausas ante
+    rechazos temporales, porque el proveedor de destino es el mismo.
+    `get` reparte los turnos con una cola justa ponderada: entre las campañas con un lote listo
+    gana la que lleva menos envíos en proporción a su peso, así una lista grande no acapara las
+    conexiones mientras una pequeña espera.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.lanes: List[DomainScheduler] = []
+        self._weights: List[float] = []
+        self._served: List[int] = []
+
+    def add(self, weight: float = 1.0) -> DomainScheduler:
+        lane = DomainScheduler(**self.options, share_with=self.lanes[0] if self.lanes else None)
+        self.lanes.append(lane)
+        self._weights.append(weight)
+        self._served.append(0)
+        return lane
+
+    def get(self) -> Optional[Tuple[int, List[str]]]:
+        """Bloquea hasta el próximo lote de alguna campaña: (índice de la campaña, lote), o None si todas terminaron."""
+        cond = self.lanes[0]._cond
+        with cond:
+            while True:
+                active = [i for i, lane in enumerate(self.lanes) if not lane.finished]
+                if not active:
+                    return None
+                wait = None
+                for i in sorted(active, key=lambda i: self._served[i] / self._weights[i]):
+                    batch, lane_wait = self.lanes[i]._poll()
+                    if batch:
+                        self._served[i] += len(batch)
+                        return i, batch
+                    if lane_wait is not None:
+                        wait = lane_wait if wait is None else min(wait, lane_wait)
+                cond.wait(timeout=wait)
+
+
+def _scheduler_options() -> Dict:
+    """Opciones de planificación de la configuración (SMTP_BATCH_SIZE, SMTP_RATE_*, SMTP_BACKOFF_*)."""
+    return dict(batch_size=SMTP_BATCH_SIZE, domain_rate=SMTP_RATE_PER_DOMAIN, global_rate=SMTP_RATE_GLOBAL,
+                domain_rates=_parse_domain_rates(SMTP_DOMAIN_RATES), max_attempts=SMTP_MAX_ATTEMPTS,
+                backoff_base=SMTP_BACKOFF_BASE, backoff_max=SMTP_BACKOFF_MAX)
+
+
+def _is_temporary(code: Optional[int]) -> bool:
+    return code is not None and 400 <= code < 500
+
+
+def deliver_concurrently(recipients: Iterable[str],
+                         send_batch: Callable[[List[str]], Optional[Dict[str, Tuple[int, bytes]]]],
+                         workers: int, scheduler: Optional[DomainScheduler] = None) -> Dict[str, str]:
+    """
+    Reparte los destinatarios entre `workers` hilos a través del `scheduler` (cola acotada,
+    ritmo por dominio y reintentos ante rechazos temporales).
+    `send_batch` recibe un lote del mismo dominio y puede retornar los rechazos individuales
+    {correo: (código, motivo)}, como `sendmail`. Un fallo no detiene a los demás lotes.
+    Retorna un diccionario {correo: error} con los envíos fallidos definitivamente.
+    """
+    scheduler = scheduler or DomainScheduler()
+    failures: Dict[str, str] = {}
+    failures_lock = threading.Lock()
+
+    def worker():
+        while True:
+            batch = scheduler.get()
+            if batch is None:
+                return
+            _send_and_settle(batch, send_batch, scheduler, failures, failures_lock)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for recipient in recipients:
+            scheduler.put(recipient)
+    finally:
+        scheduler.close()
+        for thread in threads:
+            thread.join()
+    return failures
+
+
+def _send_and_settle(batch: List[str], send_batch: Callable, scheduler: DomainScheduler,
+                     failures: Dict[str, str], failures_lock: threading.Lock):
+    """Envía un lote y resuelve cada dirección: completada, diferida (rechazo temporal) o fallida en `failures`."""
+    try:
+        refused = send_batch(batch) or {}
+    except smtplib.SMTPRecipientsRefused as e:
+        refused = e.recipients
+    except smtplib.SMTPResponseException as e:
+        refused = {recipient: (e.smtp_code, e.smtp_error) for recipient in batch}
+    except Exception as e:
+        refused = {recipient: (None, str(e)) for recipient in batch}
+    for recipient in batch:
+        if recipient not in refused:
+            scheduler.complete(recipient)
+            continue
+        code, reason = refused[recipient]
+        if _is_temporary(code) and scheduler.defer(recipient):
+            metrics.incr("smtp_deferrals")
+            log(f"Rechazo temporal para {recipient} ({code}). Se reintentará más tarde.", "warning")
+            continue
+        error = reason.decode('utf-8', 'replace') if isinstance(reason, bytes) else str(reason)
+        error = f"{code} {error}" if code else error
+        log(f"No se pudo enviar a {recipient}: {error}", "error")
+        with failures_lock:
+            failures[recipient] = error
+        scheduler.complete(recipient, ok=False)
+
+
+def deliver_campaigns(jobs: List[Tuple[Iterable[str], Callable]], workers: int,
+                      scheduler: CampaignScheduler) -> List[Dict[str, str]]:
+    """
+    Como deliver_concurrently, pero para varias campañas a la vez sobre los mismos `workers` hilos.
+    `jobs` tiene un par (destinatarios, send_batch) por cada carril de `scheduler`, en el mismo orden;
+    los destinatarios de cada campaña se leen en su propio hilo. Retorna los fallos de cada campaña.
+    """
+    failures: List[Dict[str, str]] = [{} for _ in jobs]
+    failures_lock = threading.Lock()
+
+    def produce(lane: DomainScheduler, recipients: Iterable[str]):
+        try:
+            for recipient in recipients:
+                lane.put(recipient)
+        except Exception as e:
+            log(f"Error leyendo los destinatarios de una campaña: {e}", "error")
+        finally:
+            lane.close()
+
+    def worker():
+        while True:
+            item = scheduler.get()
+            if item is None:
+                return
+            index, batch = item
+            _send_and_settle(batch, jobs[index][1], scheduler.lanes[index], failures[index], failures_lock)
+
+    producers = [threading.Thread(target=produce, args=(lane, recipients), daemon=True)
+                 for lane, (recipients, _) in zip(scheduler.lanes, jobs)]
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in producers + threads:
+        thread.start()
+    for thread in producers + threads:
+        thread.join()
+    return failures
+
+# --- Diario de Entregas ---
+class DeliveryJournal:
+    """
+    Diario append-only de entregas (JSON Lines, un archivo por día).
+    Cada línea guarda asunto, destinatario, estado y latencia, de modo que una re-ejecución
+    tras un fallo omite a quienes ya recibieron el correo de esa fecha y asunto.
+    Las escrituras se sincronizan a disco (fsync) cada `fsync_every` registros.
+    Varias campañas con el mismo asunto comparten el diario: `claim` evita que alguien que está
+    en más de una lista reciba el correo dos veces.
+    """
+
+    def __init__(self, subject: str, date: Optional[datetime] = None, directory: str = DELIVERY_JOURNAL_DIR,
+                 fsync_every: int = JOURNAL_FSYNC_EVERY):
+        date = date or datetime.now()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{date.strftime('%Y-%m-%d')}.jsonl")
+        self.subject = subject
+        self.fsync_every = max(1, fsync_every)
+        self._delivered = set()
+        self._claimed = set()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Última línea truncada por una caída: se ignora
+                        continue
+                    if entry.get("subject") == subject and entry.get("status") == "sent":
+                        self._delivered.add(entry["to"])
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._prune(directory, date)
+
+    @staticmethod
+    def _prune(directory: str, date: datetime):
+        """Elimina diarios de más de JOURNAL_RETENTION_DAYS días."""
+        for name in os.listdir(directory):
+            try:
+                age = (date - datetime.strptime(name, '%Y-%m-%d.jsonl')).days
+            except ValueError:
+                continue
+            if age > JOURNAL_RETENTION_DAYS:
+                os.remove(os.path.join(directory, name))
+
+    def already_delivered(self, recipient: str) -> bool:
+        return recipient in self._delivered
+
+    def claim(self, recipient: str) -> bool:
+        """Reserva el destinatario en esta ejecución: False si ya lo recibió o si otra lista ya lo reservó."""
+        with self._lock:
+            if recipient in self._delivered or recipient in self._claimed:
+                return False
+            self._claimed.add(recipient)
+            return True
+
+    def record(self, recipient: str, status: str, latency: Optional[float] = None, error: Optional[str] = None):
+        entry = {"subject": self.subject, "to": recipient, "status": status,
+                 "ms": round(latency * 1000, 1) if latency is not None else None,
+                 "at": datetime.now().isoformat(timespec='seconds')}
+        if error:
+            entry["error"] = error
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            if status == "sent":
+                self._delivered.add(recipient)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- Plantilla del Newsletter ---
+# Paleta de colores "mágica"
+LAYOUT_COLORS = {
+    "bg": "#f0eafc",  # Lavanda pálido
+    "header_bg": "#3c1053",  # Morado oscuro
+    "header_text": "#ffffff",  # Blanco
+    "title": "#6a1b9a",  # Morado
+    "subtitle": "#8e24aa",  # Púrpura
+    "text": "#4a4a4a",  # Gris oscuro
+    "accent": "#d1c4e9",  # Lavanda más oscuro
+}
+# Sin Google Fonts (muchos clientes bloquean recursos externos): fuentes del sistema
+_FONT_SERIF = "Georgia,serif"
+_FONT_SANS = "Arial,sans-serif"
+
+# Estilos en línea para las etiquetas del contenido generado (muchos clientes ignoran <style>)
+_BODY_TAG_STYLES = {
+    "h1": f"font-family:{_FONT_SERIF};color:{LAYOUT_COLORS['title']};font-size:28px;",
+    "h2": (f"font-family:{_FONT_SERIF};color:{LAYOUT_COLORS['subtitle']};font-size:22px;"
+           f"border-bottom:2px solid {LAYOUT_COLORS['accent']};padding-bottom:5px;margin-top:30px;"),
+    "p": "line-height:1.7;",
+    "ul": "list-style:none;padding:0;",
+    "li": "margin-bottom:10px;",
+}
+# Reemplaza al li:before del diseño original
+_BULLET = f'<span style="color:{LAYOUT_COLORS["subtitle"]}">✦</span> '
+_BODY_TAG = re.compile(r"<(h1|h2|p|ul|li)(\s[^>]*)?>", re.IGNORECASE)
+_STYLE_ATTR = re.compile(r"""style=(["'])""", re.IGNORECASE)
+_INDENTATION = re.compile(r">\s*\n\s*<")
+_WHITESPACE = re.compile(r"\s{2,}")
+
+def _minify_html(html: str) -> str:
+    """Quita la indentación entre etiquetas y colapsa espacios repetidos."""
+    return _WHITESPACE.sub(" ", _INDENTATION.sub("><", html.strip()))
+
+def _inline_body_styles(html: str) -> str:
+    """Agrega los estilos del diseño a las etiquetas del contenido, antes de los estilos propios que traigan."""
+    def apply(match):
+        tag, attrs = match.group(1).lower(), match.group(2) or ""
+        css = _BODY_TAG_STYLES[tag]
+        if _STYLE_ATTR.search(attrs):
+            attrs = _STYLE_ATTR.sub(lambda m: f"style={m.group(1)}{css}", attrs, count=1)
+        else:
+            attrs += f' style="{css}"'
+        opening = f"<{match.group(1)}{attrs}>"
+        return opening + _BULLET if tag == "li" else opening
+    return _BODY_TAG.sub(apply, html)
+
+def _compile_layout() -> Template:
+    """Arma una sola vez (al importar) el diseño del correo, con estilos en línea y minificado."""
+    c = LAYOUT_COLORS
+    return Template(_minify_html(f"""
+    <!DOCTYPE html>
+    <html lang="es">
     <head>
-        <link href="https://fonts.googleapis.com/css2?family=Playfair+Display:wght@700&family=Roboto:wght@400;700&display=swap" rel="stylesheet">
-        <style>
-            body {{ font-family: 'Roboto', sans-serif; margin: 0; padding: 0; background-color: {color_bg}; }}
-            .container {{ max-width: 680px; margin: 0 auto; background-color: #ffffff; }}
-            .header {{ background-color: {color_header_bg}; color: {color_header_text}; padding: 30px 20px; text-align: center; }}
-            .header h1 {{ font-family: 'Playfair Display', serif; font-size: 32px; margin: 0; }}
-            .content {{ padding: 30px; color: {color_text}; }}
-            .content h1 {{ font-family: 'Playfair Display', serif; color: {color_title}; font-size: 28px; }}
-            .content h2 {{ font-family: 'Playfair Display', serif; color: {color_subtitle}; font-size: 22px; border-bottom: 2px solid {color_accent}; padding-bottom: 5px; margin-top: 30px; }}
-            .content p {{ line-height: 1.7; }}
-            .content ul {{ list-style: none; padding-left: 0; }}
-            .content li {{ padding-left: 20px; position: relative; margin-bottom: 10px; }}
-            .content li:before {{ content: '✦'; color: {color_subtitle}; position: absolute; left: 0; font-size: 14px; }}
-            .cta-button {{ display: inline-block; background-color: {color_title}; color: #ffffff; padding: 15px 30px; text-decoration: none; border-radius: 5px; margin: 20px 0; font-weight: bold; text-align: center; }}
-            .footer {{ text-align: center; padding: 20px; font-size: 12px; color: #999; }}
-        </style>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <title>BB Beauty Bot</title>
     </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>BB Beauty Bot</h1>
-            </div>
-            <div class="content">
-                {body_html}
-                {'<div style="text-align: center;"><a href="' + product_url + '" class="cta-button">Descubrir el Secreto</a></div>' if product_url and product_url != '#' else ''}
+    <body style="margin:0;padding:0;background-color:{c['bg']};font-family:{_FONT_SANS};">
+        <div style="max-width:680px;margin:0 auto;background-color:#ffffff;">
+            <div style="background-color:{c['header_bg']};color:{c['header_text']};padding:30px 20px;text-align:center;">
+                <h1 style="font-family:{_FONT_SERIF};font-size:32px;margin:0;">BB Beauty Bot</h1>
             </div>
-            <div class="footer">
-                <p>Análisis exclusivo de BB Beauty Bot · {datetime.now().strftime('%Y')}</p>
+            <div style="padding:30px;color:{c['text']};">$body$cta</div>
+            <div style="text-align:center;padding:20px;font-size:12px;color:#999;">
+                <p>Análisis exclusivo de BB Beauty Bot · $year</p>
             </div>
         </div>
     </body>
     </html>
+    """))
+
+def _compile_cta() -> Template:
+    return Template(_minify_html(f"""
+    <div style="text-align:center;">
+        <a href="$url" style="display:inline-block;background-color:{LAYOUT_COLORS['title']};color:#ffffff;padding:15px 30px;text-decoration:none;border-radius:5px;margin:20px 0;font-weight:bold;text-align:center;">Descubrir el Secreto</a>
+    </div>
+    """))
+
+NEWSLETTER_LAYOUT = _compile_layout()
+_CTA_TEMPLATE = _compile_cta()
+
+def render_newsletter(body_html: str, product_url: Optional[str]) -> str:
+    """HTML completo del correo: el contenido con estilos en línea dentro del diseño precompilado."""
+    cta = _CTA_TEMPLATE.substitute(url=escape(product_url)) if product_url and product_url != '#' else ""
+    return NEWSLETTER_LAYOUT.substitute(body=_minify_html(_inline_body_styles(body_html)), cta=cta,
+                                        year=datetime.now().strftime('%Y'))
+
+# --- Agente de Email ---
+class Mailing:
+    """
+    El envío del newsletter a una lista: deja pasar sólo a los destinatarios que el `journal`
+    no tiene ya entregados (o reservados por otra lista), envía lotes por el `backend` con
+    `send_batch` (llamado desde varios hilos) y al terminar registra fallos y métricas.
     """
-    
-    log(f"Preparando para enviar correo a {len(recipients)} destinatarios.", "info")
-    try:
-        # Determinar si se debe usar SSL directo o STARTTLS en función del puerto
-        use_ssl = SMTP_PORT == 465
-        if use_ssl:
-            context = ssl.create_default_context()
-            smtp_client = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context, timeout=30)
-        else:
-            smtp_client = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
 
-        with smtp_client as server:
-            if not use_ssl:
-                # Negociar STARTTLS sólo si no estamos ya en SSL
-                server.starttls(context=ssl.create_default_context())
-            server.login(EMAIL_SENDER, SMTP_PASS)
-            
-            for recipient in recipients:
-                msg = MIMEMultipart('alternative')
-                msg['From'] = formataddr(("BB Beauty Bot ✨", EMAIL_SENDER))
-                msg['To'] = recipient
-                msg['Subject'] = subject
-                msg.attach(MIMEText(html_content, 'html'))
-                server.sendmail(EMAIL_SENDER, [recipient], msg.as_string())
-                log(f"Correo enviado a {recipient}", "info")
-                
+    def __init__(self, message: PreparedMessage, sender: str, backend, recipients: Iterable[str],
+                 journal: Optional[DeliveryJournal] = None, name: Optional[str] = None):
+        self.message = message
+        self.sender = sender
+        self.backend = backend
+        self.journal = journal
+        self.label = f"[{name}] " if name else ""
+        self.pending = 0
+        self.skipped = 0
+        self.recipients = _peek(self._pending_recipients(recipients))
+
+    def _pending_recipients(self, recipients: Iterable[str]) -> Iterator[str]:
+        for recipient in recipients:
+            if self.journal and not self.journal.claim(recipient):
+                self.skipped += 1
+                continue
+            self.pending += 1
+            yield recipient
+
+    def _send_one(self, recipient: str):
+        start = time.perf_counter()
+        self.backend.sendmail(self.sender, [recipient], self.message.render(recipient, _recipient_headers(recipient)))
+        latency = time.perf_counter() - start
+        metrics.observe("send_latency_seconds", latency)
+        metrics.incr("emails_sent")
+        if self.journal:
+            self.journal.record(recipient, "sent", latency)
+        log(f"{self.label}Correo enviado a {recipient}", "info")
+
+    def send_batch(self, batch: List[str]) -> Dict:
+        if len(batch) == 1:
+            self._send_one(batch[0])
+            return {}
+        # Un solo DATA para todo el sobre; los destinatarios van sólo en el RCPT TO (estilo BCC).
+        # Los rechazos parciales vuelven al planificador, que reintenta los temporales.
+        start = time.perf_counter()
+        refused = self.backend.sendmail(self.sender, batch, self.message.render(BATCH_TO_HEADER, _batch_headers()))
+        latency = time.perf_counter() - start
+        accepted = len(batch) - len(refused)
+        # Cada destinatario aceptado del sobre cuenta con la latencia de la transacción completa
+        metrics.observe("send_latency_seconds", latency, accepted)
+        metrics.incr("emails_sent", accepted)
+        if self.journal:
+            for recipient in batch:
+                if recipient not in refused:
+                    self.journal.record(recipient, "sent", latency)
+        log(f"{self.label}Lote enviado a {accepted} de {len(batch)} destinatarios.", "info")
+        return refused
+
+    def finish(self, failures: Dict[str, str]):
+        """Registra el resultado; lanza SMTPException si no se entregó ningún correo."""
+        metrics.incr("emails_failed", len(failures))
+        metrics.incr("emails_skipped", self.skipped)
+        if self.journal:
+            for recipient, error in failures.items():
+                self.journal.record(recipient, "failed", error=error)
+
+        if self.skipped:
+            log(f"{self.label}{self.skipped} destinatarios ya recibieron este correo. Se omitieron.", "info")
+        if failures and len(failures) == self.pending:
+            raise smtplib.SMTPException(f"No se pudo entregar ningún correo ({len(failures)} fallos).")
+        if failures:
+            log(f"{self.label}{len(failures)} de {self.pending} correos no pudieron entregarse.", "warning")
+
+    def nothing_to_send(self):
+        metrics.incr("emails_skipped", self.skipped)
+        if self.skipped:
+            log(f"{self.label}Los {self.skipped} destinatarios ya recibieron este correo.", "info")
+        log(f"{self.label}No hay destinatarios a los que enviar el correo.", "warning")
+
+
+def _open_delivery(subject: str, body_html: str, product_url: str, backend):
+    """Backend (el recibido o uno nuevo), remitente y mensaje preparado para un envío."""
+    own_backend = backend is None
+    if own_backend:
+        backend = create_delivery_backend()
+    if _needs_smtp_credentials(backend):
+        log("Credenciales de email incompletas. No se puede enviar.", "error")
+        raise ValueError("Credenciales de email incompletas.")
+    # Sin SMTP (maildir/null) el remitente es opcional
+    sender = EMAIL_SENDER or "bbbot@localhost"
+    # El diseño ya está compilado; sólo se estiliza el contenido del día, una vez por envío
+    html_content = render_newsletter(body_html, product_url)
+    # El cuerpo se codifica una vez; por destinatario sólo cambian las cabeceras
+    message = PreparedMessage(subject, html_content, formataddr(("BB Beauty Bot ✨", sender)))
+    return backend, own_backend, sender, message
+
+
+@instrumented("send")
+def send_email(subject: str, body_html: str, product_url: str, recipients: Iterable[str],
+               journal: Optional[DeliveryJournal] = None, backend=None):
+    """
+    Envía el newsletter con un diseño visualmente mágico a los destinatarios.
+    `recipients` puede ser un generador: el envío empieza con el primero, sin esperar la lista completa.
+    Si se entrega un `journal`, se omiten los destinatarios que ya lo recibieron y se registra cada envío.
+    Si se entrega un `backend` (p. ej. un pool ya precalentado), se usa y queda abierto para quien lo creó;
+    si no, se crea el indicado por DELIVERY_BACKEND.
+    """
+    backend, own_backend, sender, message = _open_delivery(subject, body_html, product_url, backend)
+    mailing = Mailing(message, sender, backend, recipients, journal)
+    if mailing.recipients is None:
+        mailing.nothing_to_send()
+        return
+
+    log("Preparando el envío; los destinatarios se procesan a medida que llegan.", "info")
+    try:
+        with backend if own_backend else nullcontext(backend):
+            # Abrir la primera conexión antes de repartir: un error de login debe abortar el envío
+            backend.connect()
+            failures = deliver_concurrently(mailing.recipients, mailing.send_batch, backend.size,
+                                            DomainScheduler(**_scheduler_options()))
+        mailing.finish(failures)
         log(f"💌 Proceso de envío de correos completado.", "info")
     except Exception as e:
         log(f"Error enviando email: {e}", "error")
         raise
 
+
+@instrumented("send")
+def send_campaigns(subject: str, body_html: str, product_url: str, lists: List[Tuple[Campaign, Iterable[str]]],
+                   journal: Optional[DeliveryJournal] = None, backend=None):
+    """
+    Envía el mismo newsletter a varias campañas a la vez, sobre un solo backend: las conexiones
+    se reparten entre las listas según su peso (CampaignScheduler) y los límites por dominio
+    valen para el total. Con un `journal` compartido, quien esté en varias listas lo recibe una vez.
+    Un fallo total en una campaña no detiene a las demás; se lanza SMTPException al final.
+    """
+    backend, own_backend, sender, message = _open_delivery(subject, body_html, product_url, backend)
+    mailings, scheduler = [], CampaignScheduler(**_scheduler_options())
+    for campaign, recipients in lists:
+        mailing = Mailing(message, sender, backend, recipients, journal, campaign.name)
+        if mailing.recipients is None:
+            mailing.nothing_to_send()
+            continue
+        mailings.append(mailing)
+        scheduler.add(campaign.weight)
+    if not mailings:
+        return
+
+    log(f"Preparando el envío de {len(mailings)} campañas sobre el mismo pool.", "info")
+    try:
+        with backend if own_backend else nullcontext(backend):
+            backend.connect()
+            results = deliver_campaigns([(m.recipients, m.send_batch) for m in mailings], backend.size, scheduler)
+        errors = []
+        for mailing, failures in zip(mailings, results):
+            try:
+                mailing.finish(failures)
+            except smtplib.SMTPException as e:
+                log(f"{mailing.label}{e}", "error")
+                errors.append(mailing.label.strip())
+        if errors:
+            raise smtplib.SMTPException(f"Campañas sin ningún correo entregado: {', '.join(errors)}")
+        log(f"💌 Envío de {len(mailings)} campañas completado.", "info")
+    except Exception as e:
+        log(f"Error enviando email: {e}", "error")
+        raise
+
+# --- Estado de Ejecución ---
+class RunState:
+    """
+    Registro compacto (JSON) de lo ya hecho en cada semana ISO: la búsqueda semanal y, por día,
+    la generación y el envío del newsletter, cada uno con sus artefactos (productos, asunto,
+    conteos). Cada etapa se guarda apenas termina, con escritura atómica, de modo que una
+    re-ejecución o un reinicio tras una caída sólo hace lo que falta.
+    Se conservan las últimas `keep_weeks` semanas.
+    """
+
+    STAGES = ("search", "generation", "delivery")
+
+    def __init__(self, path: Optional[str] = None, keep_weeks: int = RUN_STATE_WEEKS):
+        self.path = path = path or RUN_STATE_FILE
+        self.keep_weeks = max(1, keep_weeks)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self._weeks = json.load(f)
+        except FileNotFoundError:
+            self._weeks = {}
+        except ValueError as e:
+            # Sin estado sólo se repite trabajo: el diario de entregas sigue evitando envíos duplicados
+            log(f"El estado de ejecución '{path}' no se pudo leer ({e}). Se empieza de cero.", "warning")
+            self._weeks = {}
+
+    @staticmethod
+    def week_key(date: datetime) -> str:
+        year, week, _ = date.isocalendar()
+        return f"{year}-W{week:02d}"
+
+    def _entries(self, date: datetime, create: bool = False) -> Dict:
+        """Etapas de la semana (búsqueda) o del día de `date` (generación y envío)."""
+        week = self._weeks.setdefault(self.week_key(date), {}) if create else self._weeks.get(self.week_key(date), {})
+        days = week.setdefault("days", {}) if create else week.get("days", {})
+        return week, (days.setdefault(str(date.isoweekday()), {}) if create else days.get(str(date.isoweekday()), {}))
+
+    def get(self, date: datetime, stage: str) -> Optional[Dict]:
+        """Artefactos de la etapa si ya terminó en esa semana (búsqueda) o ese día; None si está pendiente."""
+        week, day = self._entries(date)
+        return week.get(stage) if stage == "search" else day.get(stage)
+
+    def done(self, date: datetime, stage: str) -> bool:
+        return self.get(date, stage) is not None
+
+    def mark(self, date: datetime, stage: str, **artifacts):
+        """Registra la etapa como terminada y guarda el estado de inmediato."""
+        if stage not in self.STAGES:
+            raise ValueError(f"Etapa desconocida: {stage}")
+        week, day = self._entries(date, create=True)
+        (week if stage == "search" else day)[stage] = {"at": datetime.now().isoformat(timespec='seconds'), **artifacts}
+        for old in sorted(self._weeks)[:-self.keep_weeks]:
+            del self._weeks[old]
+        _write_atomically(self.path, json.dumps(self._weeks, ensure_ascii=False, separators=(",", ":")))
+
+    def pending_days(self, date: datetime) -> List[datetime]:
+        """Días hábiles de la semana de `date`, hasta ese día inclusive, cuyo envío no se registró."""
+        monday = date - timedelta(days=date.weekday())
+        days = [monday + timedelta(days=offset) for offset in range(min(date.weekday(), 4) + 1)]
+        return [day for day in days if not self.done(day, "delivery")]
+
 # --- Flujo Principal ---
+def _load_product_of_the_day(today: int) -> Optional[Dict]:
+    """Lee los productos de la semana y retorna el del día, o None si no hay."""
+    if not os.path.exists(WEEKLY_PRODUCTS_FILE):
+        log("El archivo de productos no existe. Esperando a la próxima búsqueda.", "warning")
+        return None
+
+    with open(WEEKLY_PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+        products = json.load(f)
+
+    if today >= len(products):
+        log(f"No hay producto asignado para hoy (Día {today+1}).", "warning")
+        return None
+
+    product = products[today]
+    log(f"Producto para el {DAY_NAMES[today]}: {product.get('nombre')}", "info")
+    return product
+
+def _subject_for(today: int) -> str:
+    return f"Tu Dosis de Magia Skincare del {DAY_NAMES[today]} ✨"
+
+def _campaigns_for_run() -> Optional[List[Campaign]]:
+    """Campañas de CAMPAIGNS_FILE, o None (registrando el error) si la configuración no sirve."""
+    try:
+        return load_campaigns()
+    except (OSError, ValueError) as e:
+        metrics.incr("run_errors")
+        log(f"Configuración de campañas inválida en '{CAMPAIGNS_FILE}': {e}", "critical")
+        return None
+
+def _open_campaigns(campaigns: List[Campaign]) -> List[Tuple[Campaign, Iterator[str]]]:
+    """
+    Empieza a leer todas las listas a la vez (basta con la primera página; el resto se lee durante
+    el envío) y retorna las que tienen suscriptores, cada una con su iterador de correos.
+    """
+    with ThreadPoolExecutor(max_workers=len(campaigns)) as executor:
+        streams = list(executor.map(lambda campaign: _peek(iter_subscribers(campaign)), campaigns))
+    opened = []
+    for campaign, subscribers in zip(campaigns, streams):
+        if subscribers is None:
+            if len(campaigns) > 1:
+                log(f"La campaña '{campaign.name}' no tiene suscriptores.", "warning")
+            continue
+        opened.append((campaign, subscribers))
+    return opened
+
+def _send_newsletter(subject: str, newsletter_html: str, product_url: str,
+                     lists: List[Tuple[Campaign, Iterator[str]]], journal: DeliveryJournal, backend=None):
+    """Una sola lista sale por send_email; varias, por send_campaigns compartiendo el backend."""
+    if len(lists) == 1:
+        send_email(subject, newsletter_html, product_url, lists[0][1], journal, backend)
+    else:
+        send_campaigns(subject, newsletter_html, product_url, lists, journal, backend)
+
+def _write_run_report():
+    """Guarda el informe de métricas de la ejecución; un fallo aquí nunca debe afectar al envío."""
+    status = "error" if metrics.counter("run_errors") else "ok"
+    try:
+        path = metrics.write_report(RUN_REPORT_DIR, status, METRICS_TEXTFILE)
+        log(f"Informe de la ejecución guardado en {path}.", "info")
+    except OSError as e:
+        log(f"No se pudo guardar el informe de la ejecución: {e}", "warning")
+
+def _ensure_weekly_search(state: RunState, date: datetime) -> bool:
+    """
+    Deja lista la búsqueda de la semana de `date`: si ya consta en el estado no hace nada; si falta
+    (p. ej. falló el lunes) la ejecuta ahora, el día que sea, en vez de usar los productos de otra semana.
+    Sólo cuenta el estado: la fecha de modificación de WEEKLY_PRODUCTS_FILE no sirve, porque el
+    checkout y la descarga de artefactos la reescriben en cada ejecución.
+    """
+    if state.done(date, "search"):
+        return True
+    if not _run_weekly_search():
+        return False
+    with open(WEEKLY_PRODUCTS_FILE, 'r', encoding='utf-8') as f:
+        products = json.load(f)
+    state.mark(date, "search", file=WEEKLY_PRODUCTS_FILE, products=[_product_key(p) for p in products])
+    return True
+
+def _store_newsletter(key: str, html: str):
+    """Agrega el newsletter del día a WEEKLY_NEWSLETTERS_FILE para que una re-ejecución envíe lo mismo."""
+    newsletters = {}
+    if os.path.exists(WEEKLY_NEWSLETTERS_FILE):
+        with open(WEEKLY_NEWSLETTERS_FILE, 'r', encoding='utf-8') as f:
+            newsletters = json.load(f)
+    if newsletters.get(key) == html:
+        return
+    newsletters[key] = html
+    _write_atomically(WEEKLY_NEWSLETTERS_FILE, json.dumps(newsletters, indent=4, ensure_ascii=False))
+
+def _newsletter_of_the_day(state: RunState, date: datetime, product: Dict) -> str:
+    """
+    Newsletter del día: el ya generado si el estado lo registra, o uno nuevo (pre-generado o
+    generado ahora) que se guarda antes de enviar. Así, si el envío se corta, la re-ejecución
+    manda exactamente el mismo contenido a quienes faltan, sin volver a llamar a Gemini.
+    """
+    key = _product_key(product)
+    generated = state.get(date, "generation")
+    if generated and generated.get("product") == key and os.path.exists(WEEKLY_NEWSLETTERS_FILE):
+        with open(WEEKLY_NEWSLETTERS_FILE, 'r', encoding='utf-8') as f:
+            html = json.load(f).get(key)
+        if html and _is_valid_newsletter(html):
+            log("Usando el newsletter ya generado para este día.", "info")
+            return html
+    html = _newsletter_for(product)
+    if key:
+        _store_newsletter(key, html)
+    state.mark(date, "generation", product=key, file=WEEKLY_NEWSLETTERS_FILE)
+    return html
+
+def _deliver_day(state: RunState, date: datetime, product: Dict, newsletter_html: str,
+                 lists: List[Tuple[Campaign, Iterator[str]]], backend=None):
+    """
+    Envía el newsletter de `date`. El envío sólo se registra en el estado si no quedaron destinatarios
+    fallidos: si no, el día sigue pendiente y la re-ejecución, gracias al diario, reintenta sólo a esos.
+    Retorna True si quedó registrado.
+    """
+    subject = _subject_for(date.weekday())
+    counters = ("emails_sent", "emails_failed", "emails_skipped")
+    before = [metrics.counter(name) for name in counters]
+    # El diario permite que una re-ejecución envíe sólo a quienes faltan
+    with DeliveryJournal(subject, date) as journal:
+        _send_newsletter(subject, newsletter_html, product.get('url', '#'), lists, journal, backend)
+    sent, failed, skipped = (metrics.counter(name) - start for name, start in zip(counters, before))
+    if failed:
+        log(f"{failed} destinatarios fallaron; el envío del {DAY_NAMES[date.weekday()]} queda pendiente "
+            f"para la próxima ejecución.", "warning")
+        return False
+    state.mark(date, "delivery", subject=subject, product=_product_key(product), sent=sent, failed=failed,
+               skipped=skipped)
+    return True
+
+def _run_day(state: RunState, date: datetime, lists: List[Tuple[Campaign, Iterator[str]]]) -> bool:
+    """Generación y envío del newsletter de un día hábil. Retorna True si quedó enviado."""
+    try:
+        product = _load_product_of_the_day(date.weekday())
+        if product is None:
+            return False
+        # Generar (o cargar el ya generado) y enviar el newsletter; es el mismo para todas las campañas
+        newsletter_html = _newsletter_of_the_day(state, date, product)
+        if not _deliver_day(state, date, product, newsletter_html, lists):
+            return False
+        log(f"✅ Newsletter del {DAY_NAMES[date.weekday()]} enviado.", "info")
+        return True
+    except FileNotFoundError:
+        metrics.incr("run_errors")
+        log(f"Archivo de productos no encontrado. Ejecuta la búsqueda de lunes primero.", "error")
+    except Exception as e:
+        metrics.incr("run_errors")
+        log(f"💣 Error crítico en el flujo principal: {e}", "critical")
+    return False
+
+def _days_to_run(state: RunState, now: datetime) -> List[datetime]:
+    """Hoy si su envío está pendiente; en modo de recuperación, además los días hábiles pendientes de la semana."""
+    pending = state.pending_days(now)
+    if not BBBOT_CATCH_UP:
+        pending = [day for day in pending if day.date() == now.date()]
+    if not pending:
+        log("El envío de hoy ya consta como completado. No hay nada pendiente.", "info")
+    elif len(pending) > 1:
+        log(f"Modo de recuperación: días pendientes {', '.join(DAY_NAMES[d.weekday()] for d in pending)}.", "info")
+    return pending
+
 def main():
+    metrics.reset()
+    try:
+        _daily_run()
+    finally:
+        _write_run_report()
+
+def _daily_run():
     log("🚀 Iniciando BB Beauty Bot 2.0 (Gemini Edition)", "info")
-    
-    # Paso 1: Obtener la lista de suscriptores
-    subscribers = get_subscribers_from_sheet()
+
+    # Lo primero es lo más barato: el fin de semana no se lee la hoja ni se carga nada más
+    now = datetime.now()
+    today = now.weekday()  # Lunes=0, Domingo=6
+
+    is_weekend = today >= 5
+    if is_weekend and not BBBOT_CATCH_UP:
+        log("Es fin de semana. No se envía newsletter.", "info")
+        return
+
+    # Sólo lo que falta: con el estado, una re-ejecución no repite búsquedas, generaciones ni envíos
+    state = RunState()
+    days = _days_to_run(state, now)
+    if not days:
+        return
+    campaigns = _campaigns_for_run()
+    if campaigns is None:
+        return
+    _run_days(state, now, campaigns, days)
+
+def _run_days(state: RunState, now: datetime, campaigns: List[Campaign], days: List[datetime]):
+    """Búsqueda semanal si falta y luego generación y envío de cada uno de los `days`, en orden."""
+    # Paso 1: Empezar a leer los suscriptores de cada campaña (el resto se lee durante el envío)
+    subscribers = _open_campaigns(campaigns)
     if not subscribers:
         log("No hay suscriptores para enviar el correo. Finalizando proceso.", "warning")
         return
 
-    today = datetime.now().weekday()  # Lunes=0, Domingo=6
+    # Paso 2: Búsqueda semanal si aún no se hizo (normalmente el lunes)
+    if not _ensure_weekly_search(state, now):
+        log("Sin productos de esta semana no se envía nada hoy.", "error")
+        return
 
-    is_weekend = today >= 5
-    if is_weekend:
+    # Paso 3: Generar y enviar el newsletter de cada día pendiente
+    for index, date in enumerate(days):
+        # Cada envío consume sus iteradores: los días siguientes vuelven a leer las listas (copia local)
+        lists = subscribers if index == 0 else _open_campaigns(campaigns)
+        if lists:
+            _run_day(state, date, lists)
+
+async def _timed_stage(name: str, func: Callable, *args):
+    """Ejecuta una etapa bloqueante en un hilo y registra su duración como fase en `metrics`."""
+    import asyncio
+    start = time.perf_counter()
+    try:
+        return await asyncio.to_thread(func, *args)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.add_phase(name, elapsed)
+        log(f"Etapa '{name}' terminada en {elapsed:.2f}s", "info")
+
+async def main_async():
+    """
+    Variante de main() que solapa las etapas independientes: la lectura de suscriptores,
+    la búsqueda/generación con Gemini y la conexión al servidor SMTP corren a la vez,
+    y el envío empieza en cuanto el contenido y los suscriptores están listos.
+    """
+    metrics.reset()
+    try:
+        await _daily_run_async()
+    finally:
+        _write_run_report()
+
+async def _daily_run_async():
+    import asyncio
+    log("🚀 Iniciando BB Beauty Bot 2.0 (Gemini Edition, modo asíncrono)", "info")
+    run_start = time.perf_counter()
+
+    now = datetime.now()
+    today = now.weekday()  # Lunes=0, Domingo=6
+    if today >= 5 and not BBBOT_CATCH_UP:
         log("Es fin de semana. No se envía newsletter.", "info")
         return
+    state = RunState()
+    days = _days_to_run(state, now)
+    if not days:
+        return
+    campaigns = _campaigns_for_run()
+    if campaigns is None:
+        return
 
-    # Paso 2: Búsqueda semanal si es lunes
-    if today == 0: 
-        log("Día de búsqueda. Iniciando la caza de productos innovadores...", "info")
-        if not find_products_with_gemini():
-            log("La búsqueda semanal falló. Reintentando en la próxima ejecución.", "error")
-            return
-    
-    # Paso 3: Verificar si los productos de la semana existen
-    if not os.path.exists(WEEKLY_PRODUCTS_FILE):
-        log("El archivo de productos no existe. Esperando a la próxima búsqueda.", "warning")
+    # Los días atrasados (modo de recuperación) van primero y en serie; el de hoy, con etapas solapadas
+    earlier = [day for day in days if day.date() != now.date()]
+    if earlier:
+        await _timed_stage("recuperación", _run_days, state, now, campaigns, earlier)
+    if len(earlier) == len(days):
         return
 
-    # Paso 4: Seleccionar producto del día y enviar
-    try:
-        with open(WEEKLY_PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-            products = json.load(f)
-        
-        day_index = today
-        if day_index >= len(products):
-            log(f"No hay producto asignado para hoy (Día {day_index+1}).", "warning")
-            return
-            
-        product_of_the_day = products[day_index]
-        day_name = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"][day_index]
-        log(f"Producto para el {day_name}: {product_of_the_day.get('nombre')}", "info")
-
-        # Generar y enviar el newsletter
-        newsletter_html = generate_newsletter_with_gemini(product_of_the_day)
-        subject = f"Tu Dosis de Magia Skincare del {day_name} ✨"
-        send_email(subject, newsletter_html, product_of_the_day.get('url', '#'), subscribers)
-        
-        log("✅ Proceso diario completado exitosamente.", "info")
+    def prepare_content():
+        if not _ensure_weekly_search(state, now):
+            return None
+        product = _load_product_of_the_day(today)
+        if product is None:
+            return None
+        return product, _newsletter_of_the_day(state, now, product)
 
-    except FileNotFoundError:
-        log(f"Archivo de productos no encontrado. Ejecuta la búsqueda de lunes primero.", "error")
-    except Exception as e:
-        log(f"💣 Error crítico en el flujo principal: {e}", "critical")
+    backend = create_delivery_backend()
+    stages = [
+        # Basta con la primera página: el resto se sigue leyendo mientras se envía
+        _timed_stage("suscriptores", _open_campaigns, campaigns),
+        _timed_stage("contenido", prepare_content),
+    ]
+    if not _needs_smtp_credentials(backend):
+        stages.append(_timed_stage("conexión SMTP", backend.connect, backend.size))
+
+    with backend:
+        subscribers, content, *warm_up = await asyncio.gather(*stages, return_exceptions=True)
+        try:
+            for result in (subscribers, content, *warm_up):
+                if isinstance(result, BaseException):
+                    raise result
+            if not subscribers:
+                log("No hay suscriptores para enviar el correo. Finalizando proceso.", "warning")
+                return
+            if content is None:
+                return
+
+            product, newsletter_html = content
+            if await _timed_stage("envío", _deliver_day, state, now, product, newsletter_html, subscribers, backend):
+                log("✅ Proceso diario completado exitosamente.", "info")
+        except Exception as e:
+            metrics.incr("run_errors")
+            log(f"💣 Error crítico en el flujo principal: {e}", "critical")
+        finally:
+            wall = time.perf_counter() - run_start
+            log(f"Tiempo total {wall:.2f}s frente a {sum(metrics.phases.values()):.2f}s de etapas en serie.", "info")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if BBBOT_ASYNC:
+        # asyncio sólo se importa en este modo: el flujo en serie no lo necesita
+        import asyncio
+        asyncio.run(main_async())
+    else:
+        main()
@@ -0,0 +1,816 @@
+"""
+Benchmarks de BB Beauty Bot.
+
+Uso:
+    python bench_bbbot.py smtp [--messages 2000] [--latency-ms 5]
+    python bench_bbbot.py render [--recipients 50000]
+    python bench_bbbot.py layout [--iterations 2000]
+    python bench_bbbot.py generate [--latency 2.0]
+    python bench_bbbot.py history [--sizes 10000 100000]
+    python bench_bbbot.py deliver [--recipients 20000]
+    python bench_bbbot.py schedule [--messages 600] [--limits gmail.com=100,outlook.com=50]
+    python bench_bbbot.py campaigns [--sizes 3000 300 100] [--latency-ms 2]
+    python bench_bbbot.py imports [--runs 5]
+    python bench_bbbot.py e2e [--sizes 100 10000 100000] [--gemini-latency 0.2] [--reruns 0] [--output e2e.json]
+"""
+import argparse
+import asyncio
+import compileall
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import socketserver
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from unittest.mock import patch
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import bbbot
+
+
+# --- Servidor SMTP local ---
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Implementa lo mínimo de SMTP para aceptar y descartar mensajes."""
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        latency = self.server.latency
+        self.reply("220 localhost bench")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.reply("250 localhost")
+            elif command == b"RCPT":
+                if self.server.defer(line):
+                    self.reply("450 4.7.0 Try again later")
+                else:
+                    self.reply("250 OK")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                if latency:
+                    time.sleep(latency)
+                with self.server.lock:
+                    self.server.received += 1
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP...
+                self.reply("250 OK")
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Servidor SMTP de descarte en localhost, con latencia opcional por mensaje.
+    `domain_limits` ({dominio: destinatarios/seg}) simula el throttling de un proveedor:
+    sobre ese ritmo responde 450 al RCPT, como hacen gmail.com u outlook.com.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.0, domain_limits=None):
+        super().__init__(("127.0.0.1", 0), _SinkHandler)
+        self.latency = latency
+        self.limits = {domain: bbbot.TokenBucket(rate, rate) for domain, rate in (domain_limits or {}).items()}
+        self.deferred = 0
+        self.received = 0
+        self.lock = threading.Lock()
+
+    def defer(self, rcpt_line: bytes) -> bool:
+        address = rcpt_line.decode().partition("<")[2].partition(">")[0]
+        limit = self.limits.get(address.rpartition("@")[2].lower())
+        if limit is None or not limit.try_acquire():
+            return False
+        with self.lock:
+            self.deferred += 1
+        return True
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+# --- Benchmarks ---
+def bench_smtp(messages: int, latency_ms: float, connections=(1, 4, 16)):
+    """Mide mensajes/seg del pool SMTP con distintos números de conexiones."""
+    payload = "Subject: bench\r\n\r\n" + "x" * 20_000
+    recipients = [f"user{i}@example.com" for i in range(messages)]
+    with LocalSMTPServer(latency=latency_ms / 1000) as server:
+        for size in connections:
+            pool = bbbot.SMTPConnectionPool("127.0.0.1", server.port, size=size, starttls=False)
+            with pool:
+                pool.connect(size)
+                start = time.perf_counter()
+                failures = bbbot.deliver_concurrently(
+                    recipients, lambda batch: pool.sendmail("bench@example.com", batch, payload), size)
+                elapsed = time.perf_counter() - start
+            print(f"{size:>3} conexiones: {messages / elapsed:10.1f} mensajes/seg ({len(failures)} fallos)")
+
+
+def bench_schedule(messages: int, limits, connections: int = 8):
+    """
+    Envío a una lista mezclada de dominios contra un servidor que limita el ritmo de algunos:
+    en orden de planilla sin pausas (cada 450 es un fallo, como antes) vs. DomainScheduler
+    con límites por dominio, intercalado y pausas ante rechazos temporales.
+    """
+    domains = ["gmail.com", "outlook.com", "yahoo.com", "example.com"]
+    recipients = [f"user{i}@{domains[i % len(domains)]}" for i in range(messages)]
+    payload = "Subject: bench\r\n\r\n" + "x" * 20_000
+
+    def run(scheduler):
+        with LocalSMTPServer(latency=0.002, domain_limits=limits) as server:
+            pool = bbbot.SMTPConnectionPool("127.0.0.1", server.port, size=connections, starttls=False)
+            with pool:
+                pool.connect(connections)
+                start = time.perf_counter()
+                failures = bbbot.deliver_concurrently(
+                    recipients, lambda batch: pool.sendmail("bench@example.com", batch, payload), connections, scheduler)
+                elapsed = time.perf_counter() - start
+            return elapsed, len(failures), server.deferred
+
+    naive = run(bbbot.DomainScheduler(max_attempts=1))
+    # Un 90 % del límite real: margen para que el ritmo propio no choque con el del servidor
+    scheduled = run(bbbot.DomainScheduler(domain_rates={d: rate * 0.9 for d, rate in limits.items()},
+                                          max_attempts=4, backoff_base=0.1, backoff_max=2))
+    print(f"{messages} mensajes, {connections} conexiones, límites del servidor (por seg): {limits}")
+    for label, (elapsed, failed, deferred) in (("Sin planificar", naive), ("DomainScheduler", scheduled)):
+        print(f"  {label:<16} {elapsed:6.2f} s  {(messages - failed) / elapsed:8.1f} entregados/seg  "
+              f"({failed} fallidos, {deferred} respuestas 450)")
+
+
+def bench_deliver(count: int):
+    """
+    Render + encolado de send_email completo con cada backend: null (techo sin I/O),
+    maildir (spool en disco) y smtp contra el servidor local.
+    """
+    recipients = [f"user{i}@example.com" for i in range(count)]
+    html = _sample_html()
+    with tempfile.TemporaryDirectory() as tmpdir, LocalSMTPServer() as server, \
+            patch.object(bbbot, "EMAIL_SENDER", "bench@example.com"), \
+            patch.object(bbbot, "SMTP_SERVER", "127.0.0.1"), \
+            patch.object(bbbot, "SMTP_PASS", "bench"), \
+            patch.object(bbbot, "SMTP_RATE_PER_DOMAIN", 0), \
+            patch.object(bbbot, "log", lambda msg, level="info": None):
+        backends = {
+            "null": bbbot.NullBackend(),
+            "maildir": bbbot.MaildirBackend(os.path.join(tmpdir, "outbox")),
+            "smtp": bbbot.SMTPConnectionPool("127.0.0.1", server.port, starttls=False),
+        }
+        print(f"{count} destinatarios, cuerpo de {len(html.encode()) // 1024} KB")
+        for name, backend in backends.items():
+            with backend:
+                start = time.perf_counter()
+                bbbot.send_email("Asunto", html, "#", recipients, backend=backend)
+                elapsed = time.perf_counter() - start
+            print(f"  {name:<8} {elapsed:7.2f} s  {count / elapsed:10.1f} mensajes/seg")
+
+
+class _FinishTimes:
+    """Envuelve un backend y anota cuándo se entregó el último correo de cada campaña (prefijo del correo)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.size = backend.size
+        self.start = time.perf_counter()
+        self.finished = {}
+
+    def connect(self, count: int = 1):
+        self.backend.connect(count)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        refused = self.backend.sendmail(from_addr, to_addrs, msg)
+        self.finished[to_addrs[0].partition("-")[0]] = time.perf_counter() - self.start
+        return refused
+
+    def close(self):
+        self.backend.close()
+
+
+def bench_campaigns(sizes, latency_ms: float, connections: int = 4):
+    """
+    Varias listas de distinto tamaño por el mismo pool SMTP: una campaña tras otra con send_email
+    vs. todas a la vez con send_campaigns. Muestra cuándo termina cada lista y el total.
+    """
+    def recipients(index: int, size: int):
+        return (f"c{index}-{i}@example.com" for i in range(size))
+
+    def lists():
+        return [(bbbot.Campaign(f"c{index}"), recipients(index, size)) for index, size in enumerate(sizes)]
+
+    def run(shared: bool):
+        with LocalSMTPServer(latency=latency_ms / 1000) as server:
+            pool = bbbot.SMTPConnectionPool("127.0.0.1", server.port, size=connections, starttls=False)
+            backend = _FinishTimes(pool)
+            with pool:
+                pool.connect(connections)
+                backend.start = time.perf_counter()
+                if shared:
+                    bbbot.send_campaigns("Asunto", html, "#", lists(), backend=backend)
+                else:
+                    for _, stream in lists():
+                        bbbot.send_email("Asunto", html, "#", stream, backend=backend)
+                elapsed = time.perf_counter() - backend.start
+        return elapsed, backend.finished
+
+    html = _sample_html(10)
+    with patch.object(bbbot, "EMAIL_SENDER", "bench@example.com"), \
+            patch.object(bbbot, "SMTP_SERVER", "127.0.0.1"), \
+            patch.object(bbbot, "SMTP_PASS", "bench"), \
+            patch.object(bbbot, "SMTP_RATE_PER_DOMAIN", 0), \
+            patch.object(bbbot, "log", lambda msg, level="info": None):
+        print(f"Listas de {', '.join(map(str, sizes))} destinatarios, {connections} conexiones, "
+              f"{latency_ms} ms por mensaje")
+        for label, shared in (("Una tras otra", False), ("send_campaigns", True)):
+            elapsed, finished = run(shared)
+            ends = "  ".join(f"c{index} {finished[f'c{index}']:6.2f} s" for index in range(len(sizes)))
+            print(f"  {label:<15} total {elapsed:6.2f} s  terminan: {ends}")
+
+
+# Ejecución de fin de semana en un proceso nuevo: importar bbbot y llamar a main() con un sábado fijo
+_WEEKEND_RUN = """
+import json, sys, time
+start = time.perf_counter()
+import bbbot
+imported = time.perf_counter()
+from datetime import datetime
+
+class Saturday(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2026, 1, 10, 8, 0)
+
+bbbot.datetime = Saturday
+bbbot.log = lambda msg, level="info": None
+bbbot.main()
+done = time.perf_counter()
+heavy = [name for name in ("google.generativeai", "gspread", "google.oauth2", "asyncio") if name in sys.modules]
+print(json.dumps({"import_ms": (imported - start) * 1000, "main_ms": (done - imported) * 1000, "heavy": heavy}))
+"""
+
+
+def _importtime(module_dir: str, env: dict):
+    """`python -X importtime -c "import bbbot"`: (ms acumulados de bbbot, [(ms, módulo)] de sus importaciones directas)."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bbbot"], cwd=module_dir, env=env,
+                            capture_output=True, text=True, check=True).stderr
+    total, children, pending = 0.0, [], []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # encabezado
+        # Cada módulo se lista después de sus importaciones, con dos espacios más de sangría
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            pending.append((int(cumulative) / 1000, name.strip()))
+        elif depth == 0:
+            if name.strip() == "bbbot":
+                total, children = int(cumulative) / 1000, pending
+            pending = []
+    return total, sorted(children, reverse=True)
+
+
+def bench_imports(runs: int):
+    """
+    Costo de arranque de cada ejecución programada: tiempo de importar bbbot (con -X importtime,
+    mediana de `runs` procesos nuevos), las importaciones directas más pesadas y una ejecución
+    de fin de semana completa, que no debería cargar los clientes de Google.
+    """
+    module_dir = os.path.dirname(os.path.abspath(bbbot.__file__))
+    # Sin .pyc al día se mediría la compilación de bbbot.py en vez de la importación
+    compileall.compile_file(os.path.join(module_dir, "bbbot.py"), quiet=1)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [module_dir, os.environ.get("PYTHONPATH")])))
+
+    samples = [_importtime(module_dir, env) for _ in range(runs)]
+    total = statistics.median(total for total, _ in samples)
+    print(f"import bbbot: {total:7.1f} ms (mediana de {runs} procesos)")
+    for cumulative, name in samples[-1][1][:8]:
+        print(f"  {cumulative:7.1f} ms  {name}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        weekend = [json.loads(subprocess.run([sys.executable, "-c", _WEEKEND_RUN], cwd=tmpdir, env=env,
+                                             capture_output=True, text=True, check=True).stdout)
+                   for _ in range(runs)]
+    print(f"Fin de semana: importar {statistics.median(r['import_ms'] for r in weekend):7.1f} ms, "
+          f"main() {statistics.median(r['main_ms'] for r in weekend):6.1f} ms, "
+          f"módulos pesados cargados: {', '.join(weekend[-1]['heavy']) or 'ninguno'}")
+
+
+def _sample_html(size_kb: int = 30) -> str:
+    """Cuerpo HTML de tamaño parecido a un newsletter real, con acentos y emojis."""
+    block = "<h2>💡 ¿Qué es y qué lo hace especial?</h2><p>Análisis de ingredientes, niacinamida y péptidos.</p>\n"
+    return block * (size_kb * 1024 // len(block.encode()))
+
+
+def _legacy_render(subject: str, html: str, sender: str, recipient: str) -> str:
+    """Construcción original: un MIMEMultipart nuevo y `as_string()` por destinatario."""
+    msg = MIMEMultipart('alternative')
+    msg['From'] = sender
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html, 'html'))
+    return msg.as_string()
+
+
+def _measure(render, recipients):
+    start = time.perf_counter()
+    for recipient in recipients:
+        render(recipient)
+    elapsed = time.perf_counter() - start
+    # Memoria asignada en una muestra (tracemalloc ralentiza mucho el bucle completo)
+    tracemalloc.start()
+    for recipient in recipients[:1000]:
+        render(recipient)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_render(count: int):
+    """Compara el render por destinatario original con PreparedMessage."""
+    subject = "Tu Dosis de Magia Skincare del Miércoles ✨"
+    sender = bbbot.formataddr(("BB Beauty Bot ✨", "bot@example.com"))
+    html = _sample_html()
+    recipients = [f"user{i}@example.com" for i in range(count)]
+
+    legacy_time, legacy_peak = _measure(lambda r: _legacy_render(subject, html, sender, r), recipients)
+    prepared = bbbot.PreparedMessage(subject, html, sender)
+    prepared_time, prepared_peak = _measure(prepared.render, recipients)
+
+    print(f"{count} destinatarios, cuerpo de {len(html.encode()) // 1024} KB")
+    print(f"  MIME por destinatario: {legacy_time:8.3f} s  (pico {legacy_peak / 1024:8.1f} KB)")
+    print(f"  PreparedMessage:       {prepared_time:8.3f} s  (pico {prepared_peak / 1024:8.1f} KB)")
+    print(f"  Aceleración: {legacy_time / prepared_time:.1f}x")
+
+
+def _legacy_layout(body_html: str, product_url: str) -> str:
+    """Diseño original: f-string completo con <style> y Google Fonts, armado en cada envío."""
+    color_bg = "#f0eafc"
+    color_header_bg = "#3c1053"
+    color_header_text = "#ffffff"
+    color_title = "#6a1b9a"
+    color_subtitle = "#8e24aa"
+    color_text = "#4a4a4a"
+    color_accent = "#d1c4e9"
+    return f"""
+    <html>
+    <head>
+        <link href="https://fonts.googleapis.com/css2?family=Playfair+Display:wght@700&family=Roboto:wght@400;700&display=swap" rel="stylesheet">
+        <style>
+            body {{ font-family: 'Roboto', sans-serif; margin: 0; padding: 0; background-color: {color_bg}; }}
+            .container {{ max-width: 680px; margin: 0 auto; background-color: #ffffff; }}
+            .header {{ background-color: {color_header_bg}; color: {color_header_text}; padding: 30px 20px; text-align: center; }}
+            .header h1 {{ font-family: 'Playfair Display', serif; font-size: 32px; margin: 0; }}
+            .content {{ padding: 30px; color: {color_text}; }}
+            .content h1 {{ font-family: 'Playfair Display', serif; color: {color_title}; font-size: 28px; }}
+            .content h2 {{ font-family: 'Playfair Display', serif; color: {color_subtitle}; font-size: 22px; border-bottom: 2px solid {color_accent}; padding-bottom: 5px; margin-top: 30px; }}
+            .content p {{ line-height: 1.7; }}
+            .content ul {{ list-style: none; padding-left: 0; }}
+            .content li {{ padding-left: 20px; position: relative; margin-bottom: 10px; }}
+            .content li:before {{ content: '✦'; color: {color_subtitle}; position: absolute; left: 0; font-size: 14px; }}
+            .cta-button {{ display: inline-block; background-color: {color_title}; color: #ffffff; padding: 15px 30px; text-decoration: none; border-radius: 5px; margin: 20px 0; font-weight: bold; text-align: center; }}
+            .footer {{ text-align: center; padding: 20px; font-size: 12px; color: #999; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>BB Beauty Bot</h1>
+            </div>
+            <div class="content">
+                {body_html}
+                {'<div style="text-align: center;"><a href="' + product_url + '" class="cta-button">Descubrir el Secreto</a></div>' if product_url and product_url != '#' else ''}
+            </div>
+            <div class="footer">
+                <p>Análisis exclusivo de BB Beauty Bot · {datetime.now().strftime('%Y')}</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+
+def _sample_newsletter() -> str:
+    """Contenido típico de Gemini, con la estructura e indentación que pide el prompt."""
+    return """
+    <h1>Marca - Sérum Renovador</h1>
+
+    <h2>💡 ¿Qué es y qué lo hace especial?</h2>
+    <p>Un sérum ligero que combina niacinamida al 10% con péptidos biomiméticos. Su textura se absorbe
+    rápido y está pensado para pieles mixtas que buscan unificar el tono sin sensación grasa.</p>
+
+    <hr style="border: 1px solid #f0eafc; margin: 30px 0;">
+
+    <h2>🔬 Análisis de Ingredientes y Beneficios</h2>
+    <p>Estos son los ingredientes clave y lo que realmente hacen por tu piel:</p>
+    <ul>
+        <li><b>Niacinamida:</b> Ayuda a regular el sebo y a unificar el tono de la piel.</li>
+        <li><b>Ceramidas:</b> Refuerzan la barrera cutánea y retienen la hidratación.</li>
+        <li><b>Péptidos:</b> Estimulan la producción de colágeno para una piel más firme.</li>
+    </ul>
+
+    <hr style="border: 1px solid #f0eafc; margin: 30px 0;">
+
+    <h2>⚠️ Consejos de Uso: Cómo y Cuándo</h2>
+    <p>Para sacarle el máximo provecho y mantener tu piel segura, sigue estos consejos:</p>
+    <ul>
+        <li><b>Combinaciones recomendadas (Sinergia):</b> Úsalo junto a un limpiador suave y un protector solar.</li>
+        <li><b>Combinaciones a evitar (Antagonismo):</b> Evita aplicarlo al mismo tiempo que la vitamina C pura.</li>
+        <li><b>Momento ideal de aplicación:</b> Mañana y noche, después de la limpieza.</li>
+    </ul>
+
+    <hr style="border: 1px solid #f0eafc; margin: 30px 0;">
+
+    <h2>✅ Resumen Clave y Tip Experto</h2>
+    <p><b>En pocas palabras:</b> Ideal para pieles mixtas con manchas; su mayor fortaleza es la tolerancia.</p>
+    <p><b>Tip Experto:</b> Aplícalo sobre la piel ligeramente húmeda para mejorar su absorción.</p>
+    """
+
+
+def bench_layout(iterations: int):
+    """Diseño del correo: f-string original + base64 vs. plantilla precompilada minificada + quoted-printable."""
+    body = _sample_newsletter()
+    url = "https://www.marca.com/es-cl/serum-renovador"
+    sender = bbbot.formataddr(("BB Beauty Bot ✨", "bot@example.com"))
+    subject = "Tu Dosis de Magia Skincare del Miércoles ✨"
+
+    timings = {}
+    for label, render in (("original", _legacy_layout), ("precompilado", bbbot.render_newsletter)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            render(body, url)
+        timings[label] = (time.perf_counter() - start) / iterations
+
+    legacy_html = _legacy_layout(body, url)
+    legacy_message = _legacy_render(subject, legacy_html, sender, "user@example.com").encode()
+    new_html = bbbot.render_newsletter(body, url)
+    new_message = bbbot.PreparedMessage(subject, new_html, sender).render("user@example.com")
+
+    print(f"Contenido de {len(body.encode())} B, {iterations} renders")
+    print(f"  Original:     {timings['original'] * 1e6:8.1f} µs/render  HTML {len(legacy_html.encode()):7d} B  "
+          f"mensaje {len(legacy_message):7d} B")
+    print(f"  Precompilado: {timings['precompilado'] * 1e6:8.1f} µs/render  HTML {len(new_html.encode()):7d} B  "
+          f"mensaje {len(new_message):7d} B")
+    print(f"  Bytes por destinatario: {100 * (1 - len(new_message) / len(legacy_message)):.1f}% menos")
+
+
+class FakeModel:
+    """Sustituto de genai.GenerativeModel con latencia fija por llamada."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def generate_content(self, prompt, stream: bool = False, **kwargs):
+        time.sleep(self.latency)
+        response = type("Response", (), {"text": "<h1>Producto</h1><h2>Análisis</h2><p>" + "texto " * 400 + "</p>"})()
+        return iter([response]) if stream else response
+
+
+def bench_generate(latency: float, days: int = 5):
+    """Tiempo de generar los newsletters de la semana en serie vs. con pregenerate_weekly_newsletters."""
+    products = [{"nombre": f"Producto {i}", "marca": "Marca", "url": f"https://example.com/{i}",
+                 "ingredientes": ["niacinamida", "péptidos"]} for i in range(days)]
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            patch.object(bbbot, "_get_model", lambda name=None: FakeModel(latency)), \
+            patch.object(bbbot, "_gemini_rate_limiter", bbbot.TokenBucket(0)), \
+            patch.object(bbbot, "GEMINI_API_KEY", "bench"), \
+            patch.object(bbbot, "GEMINI_CACHE_BYPASS", True), \
+            patch.object(bbbot, "WEEKLY_NEWSLETTERS_FILE", os.path.join(tmpdir, "newsletters.json")):
+        start = time.perf_counter()
+        for product in products:
+            bbbot.generate_newsletter_with_gemini(product)
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stored = bbbot.pregenerate_weekly_newsletters(products)
+        parallel = time.perf_counter() - start
+
+    print(f"{days} newsletters, {latency:.1f}s de latencia por llamada, {bbbot.GEMINI_MAX_CONCURRENCY} hilos")
+    print(f"  En serie:    {sequential:6.2f} s")
+    print(f"  En paralelo: {parallel:6.2f} s ({stored} guardados, {sequential / parallel:.1f}x)")
+
+
+def _fake_products(count: int, prefix: str = "p"):
+    return [{"nombre": f"Producto {prefix}{i}", "marca": f"Marca {i % 500}",
+             "url": f"https://www.marca{i % 500}.com/es-cl/productos/{prefix}{i}/",
+             "descripcion": "Descripción técnica " * 10, "ingredientes": ["niacinamida", "ceramidas"]}
+            for i in range(count)]
+
+
+def bench_history(sizes):
+    """
+    Costo de cargar el historial y deduplicar 5 candidatos: JSON completo (coincidencia exacta)
+    vs. ProductHistory (clave exacta, URL canónica y casi-duplicados por LSH).
+    """
+    for size in sizes:
+        history = _fake_products(size)
+        candidates = _fake_products(3) + _fake_products(2, prefix="nuevo")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_path = os.path.join(tmpdir, "product_history.json")
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(history, f, indent=4, ensure_ascii=False)
+
+            # Flujo original: cargar todo, armar el set, reescribir todo
+            start = time.perf_counter()
+            with open(json_path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            seen = {p.get('url') or p.get('nombre') for p in loaded}
+            new = [p for p in candidates if (p.get('url') or p.get('nombre')) not in seen]
+            loaded.extend(new)
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(loaded, f, indent=4, ensure_ascii=False)
+            legacy = time.perf_counter() - start
+
+            db_path = os.path.join(tmpdir, "product_history.sqlite3")
+            start = time.perf_counter()
+            with bbbot.ProductHistory(db_path, legacy_json=json_path):
+                pass
+            migration = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with bbbot.ProductHistory(db_path, legacy_json=None) as store:
+                new = [p for p in candidates if not store.find_duplicate(p)]
+                store.add_many(new)
+            indexed = time.perf_counter() - start
+
+        print(f"{size:>7} productos: JSON {legacy * 1000:9.1f} ms | SQLite {indexed * 1000:7.1f} ms "
+              f"(migración única {migration:.2f} s)")
+
+
+# --- Extremo a extremo ---
+class FakeGeminiModel:
+    """
+    Sustituto determinista de genai.GenerativeModel: la búsqueda produce productos nuevos
+    en cada llamada y el resto de las llamadas un newsletter HTML. Cada llamada tarda
+    `latency` segundos y falla con probabilidad `failure_rate`, decidida por hash del prompt
+    y del número de intento (no depende del orden de los hilos).
+    """
+
+    BRANDS = ["Aquaveil", "Nocturne", "Lumière", "Dermaflux", "Citrine", "Botanik", "Verdant", "Solenne"]
+    FORMATS = ["Serum", "Cream", "Essence", "Oil", "Balm", "Toner", "Mask", "Drops"]
+
+    def __init__(self, latency: float, failure_rate: float):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = {}
+        self.products = 0
+        self.lock = threading.Lock()
+
+    def _maybe_fail(self, prompt: str):
+        with self.lock:
+            attempt = self.calls[prompt] = self.calls.get(prompt, 0) + 1
+        digest = hashlib.blake2b(f"{attempt}:{prompt}".encode(), digest_size=8).digest()
+        if int.from_bytes(digest, "big") / 2 ** 64 < self.failure_rate:
+            raise RuntimeError("503 Service Unavailable (simulado)")
+
+    def _new_products(self, count: int):
+        with self.lock:
+            first, self.products = self.products, self.products + count
+        return [{"nombre": f"{self.FORMATS[i % 8]} {hashlib.md5(str(i).encode()).hexdigest()[:8]}",
+                 "marca": self.BRANDS[i // 8 % 8], "url": f"https://shop.example.com/p/{i}",
+                 "descripcion": "Fórmula con tecnología encapsulada.", "ingredientes": ["niacinamida", "péptidos"]}
+                for i in range(first, first + count)]
+
+    def generate_content(self, prompt, stream: bool = False, **kwargs):
+        time.sleep(self.latency)
+        self._maybe_fail(prompt)
+        usage = type("Usage", (), {"total_token_count": len(prompt) // 4 + 800})()
+        if "encuentra los " in prompt:
+            count = int(prompt.split("encuentra los ", 1)[1].split()[0])
+            text = json.dumps(self._new_products(count), ensure_ascii=False)
+        else:
+            text = "<h1>Producto</h1><h2>💡 Análisis</h2><p>" + "texto " * 400 + "</p>"
+        if not stream:
+            return type("Response", (), {"text": text, "usage_metadata": usage})()
+        return (type("Chunk", (), {"text": text[i:i + 256], "usage_metadata": usage})()
+                for i in range(0, len(text), 256))
+
+
+class FakeWorksheet:
+    """Hoja de gspread con `subscribers` correos en la columna B, generados al vuelo por fila."""
+
+    DOMAINS = ["gmail.com", "outlook.com", "yahoo.com", "example.com"]
+
+    def __init__(self, subscribers: int):
+        self.row_count = subscribers + 1
+
+    def get(self, range_name: str):
+        first, last = (int(cell[1:]) for cell in range_name.split(":"))
+        return [["Correo"] if row == 1 else [f"user{row}@{self.DOMAINS[row % 4]}"]
+                for row in range(first, min(last, self.row_count) + 1)]
+
+
+class FakeSheetsClient:
+    def __init__(self, subscribers: int):
+        self.spreadsheet = type("Spreadsheet", (), {"worksheet": lambda _, name: FakeWorksheet(subscribers)})()
+
+    def open_by_key(self, key):
+        return self.spreadsheet
+
+    def open(self, name):
+        return self.spreadsheet
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa KB; macOS, bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _e2e_run(subscribers: int, options: dict) -> dict:
+    """Una ejecución completa de main() en un directorio temporal. Corre en su propio proceso."""
+    workdir = tempfile.mkdtemp(prefix="bbbot-e2e-")
+    os.chdir(workdir)
+    model = FakeGeminiModel(options["gemini_latency"], options["gemini_failure_rate"])
+    run_day = datetime(2026, 1, 5 + options["weekday"], 8, 0)  # 5 de enero de 2026 es lunes
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return run_day
+
+    try:
+        with LocalSMTPServer(latency=options["smtp_latency_ms"] / 1000) as server, \
+                patch.object(bbbot, "datetime", FixedDatetime), \
+                patch.object(bbbot, "log", bbbot.log if options["verbose"] else lambda msg, level="info": None), \
+                patch.object(bbbot, "GEMINI_API_KEY", "bench"), \
+                patch.object(bbbot, "_get_model", lambda name=None: model), \
+                patch.object(bbbot, "_gemini_rate_limiter", bbbot.TokenBucket(0)), \
+                patch.object(bbbot, "_sheets_client", lambda: FakeSheetsClient(subscribers)), \
+                patch.object(bbbot, "EMAIL_SENDER", "bench@example.com"), \
+                patch.object(bbbot, "SMTP_SERVER", "127.0.0.1"), \
+                patch.object(bbbot, "SMTP_PASS", "bench"), \
+                patch.object(bbbot, "SMTP_RATE_PER_DOMAIN", options["domain_rate"]), \
+                patch.object(bbbot, "create_delivery_backend",
+                             lambda name=None: bbbot.SMTPConnectionPool("127.0.0.1", server.port, starttls=False)):
+            bbbot._response_cache.cache_clear()
+            start = time.perf_counter()
+            if options["async"]:
+                asyncio.run(bbbot.main_async())
+            else:
+                bbbot.main()
+            wall = time.perf_counter() - start
+            report = bbbot.metrics.report("error" if bbbot.metrics.counter("run_errors") else "ok")
+            received = server.received
+            # Re-ejecuciones del mismo día: con el estado de ejecución no deberían repetir trabajo
+            reruns = []
+            for _ in range(options.get("reruns", 0)):
+                rerun_start = time.perf_counter()
+                bbbot.main()
+                reruns.append({"wall_seconds": round(time.perf_counter() - rerun_start, 3),
+                               **{name: bbbot.metrics.counter(name)
+                                  for name in ("gemini_api_calls", "sheets_api_calls", "emails_sent")}})
+    finally:
+        os.chdir("/")
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    sent = report["counters"].get("emails_sent", 0)
+    return {
+        "subscribers": subscribers,
+        "status": report["status"],
+        "wall_seconds": round(wall, 3),
+        "stages": {name: stage["seconds"] for name, stage in report["stages"].items()},
+        "phases": report["phases"],
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "emails_sent": sent,
+        "smtp_messages_received": received,
+        "send_messages_per_second": report["throughput_emails_per_second"],
+        "end_to_end_messages_per_second": round(sent / wall, 2) if wall else 0.0,
+        "send_latency_p95": report["histograms"].get("send_latency_seconds", {}).get("p95"),
+        "gemini_ttft_p50": report["histograms"].get("gemini_ttft_seconds", {}).get("p50"),
+        "counters": report["counters"],
+        "reruns": reruns,
+    }
+
+
+def bench_e2e(sizes, options: dict, output: str):
+    """
+    main() completo con Gemini, Sheets y SMTP simulados localmente, para cada tamaño de lista.
+    Cada tamaño corre en un proceso nuevo para que el pico de memoria (RSS) sea el suyo.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(_e2e_run, size, options).result()
+        results.append(result)
+        stages = "  ".join(f"{name} {seconds:.2f}s" for name, seconds in result["stages"].items())
+        print(f"{size:>7} suscriptores [{result['status']}]: {result['wall_seconds']:7.2f} s total, "
+              f"{result['send_messages_per_second']:8.1f} mensajes/seg, pico RSS {result['peak_rss_mb']:.0f} MB")
+        print(f"          etapas: {stages}")
+        for rerun in result["reruns"]:
+            print(f"          re-ejecución: {rerun['wall_seconds']:.2f} s, {rerun['gemini_api_calls']} llamadas a Gemini, "
+                  f"{rerun['sheets_api_calls']} a Sheets, {rerun['emails_sent']} correos")
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"generated_at": datetime.now().isoformat(timespec='seconds'), "options": options,
+                   "results": results}, f, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    smtp = sub.add_parser("smtp", help="Rendimiento del pool SMTP contra un servidor local")
+    smtp.add_argument("--messages", type=int, default=2000)
+    smtp.add_argument("--latency-ms", type=float, default=5.0)
+
+    render = sub.add_parser("render", help="Render MIME por destinatario vs. mensaje pre-renderizado")
+    render.add_argument("--recipients", type=int, default=50_000)
+
+    layout = sub.add_parser("layout", help="Diseño del correo: render y tamaño del mensaje, antes y después")
+    layout.add_argument("--iterations", type=int, default=2000)
+
+    generate = sub.add_parser("generate", help="Generación semanal en serie vs. en paralelo con un modelo simulado")
+    generate.add_argument("--latency", type=float, default=2.0)
+
+    history = sub.add_parser("history", help="Carga y deduplicación del historial: JSON vs. SQLite")
+    history.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+
+    deliver = sub.add_parser("deliver", help="send_email completo con los backends null, maildir y smtp")
+    deliver.add_argument("--recipients", type=int, default=20_000)
+
+    schedule = sub.add_parser("schedule", help="Planificador por dominio ante rechazos temporales (450)")
+    schedule.add_argument("--messages", type=int, default=600)
+    schedule.add_argument("--limits", default="gmail.com=100,outlook.com=50",
+                          help="dominio=n: el servidor responde 450 sobre n destinatarios/seg")
+
+    campaigns = sub.add_parser("campaigns", help="Varias listas por el mismo pool: en serie vs. send_campaigns")
+    campaigns.add_argument("--sizes", type=int, nargs="+", default=[3000, 300, 100])
+    campaigns.add_argument("--latency-ms", type=float, default=2.0)
+
+    imports = sub.add_parser("imports", help="Tiempo de importación (-X importtime) y de una ejecución de fin de semana")
+    imports.add_argument("--runs", type=int, default=5)
+
+    e2e = sub.add_parser("e2e", help="main() de extremo a extremo con Gemini, Sheets y SMTP simulados")
+    e2e.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000, 100_000])
+    e2e.add_argument("--gemini-latency", type=float, default=0.2, help="segundos por llamada")
+    e2e.add_argument("--gemini-failure-rate", type=float, default=0.0)
+    e2e.add_argument("--smtp-latency-ms", type=float, default=0.0)
+    e2e.add_argument("--domain-rate", type=float, default=0,
+                     help="SMTP_RATE_PER_DOMAIN durante la prueba (0 = sin límite)")
+    e2e.add_argument("--weekday", type=int, default=0, choices=range(5), help="0 = lunes (incluye la búsqueda)")
+    e2e.add_argument("--async", dest="use_async", action="store_true", help="usar main_async()")
+    e2e.add_argument("--reruns", type=int, default=0, help="volver a ejecutar main() el mismo día")
+    e2e.add_argument("--verbose", action="store_true", help="mostrar el log del bot")
+    e2e.add_argument("--output", default="e2e_results.json")
+
+    args = parser.parse_args()
+    if args.bench == "smtp":
+        bench_smtp(args.messages, args.latency_ms)
+    elif args.bench == "render":
+        bench_render(args.recipients)
+    elif args.bench == "layout":
+        bench_layout(args.iterations)
+    elif args.bench == "generate":
+        bench_generate(args.latency)
+    elif args.bench == "history":
+        bench_history(args.sizes)
+    elif args.bench == "deliver":
+        bench_deliver(args.recipients)
+    elif args.bench == "e2e":
+        options = {"gemini_latency": args.gemini_latency, "gemini_failure_rate": args.gemini_failure_rate,
+                   "smtp_latency_ms": args.smtp_latency_ms, "domain_rate": args.domain_rate,
+                   "weekday": args.weekday, "async": args.use_async, "verbose": args.verbose,
+                   "reruns": args.reruns}
+        bench_e2e(args.sizes, options, os.path.abspath(args.output))
+    elif args.bench == "schedule":
+        bench_schedule(args.messages, bbbot._parse_domain_rates(args.limits))
+    elif args.bench == "campaigns":
+        bench_campaigns(args.sizes, args.latency_ms)
+    elif args.bench == "imports":
+        bench_imports(args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,16 @@ import unittest
 from unittest.mock import patch, MagicMock
 import os
 import json
-from datetime import datetime
+import time
+import threading
+import asyncio
+import shutil
+import tempfile
+import smtplib
+import email
+import email.header
+import subprocess
+from datetime import datetime, timedelta
 
 # Add the parent directory to sys.path to allow importing bbbot
 import sys
@@ -10,169 +19,1191 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import bbbot # Import the script to be tested
 
+def setUpModule():
+    # Sin límite de llamadas a Gemini: los modelos son simulados y el límite real (15/min) haría esperar a las pruebas
+    patcher = patch('bbbot._gemini_rate_limiter', bbbot.TokenBucket(0))
+    patcher.start()
+    unittest.addModuleCleanup(patcher.stop)
+
 class TestBBBotUtils(unittest.TestCase):
 
     def test_normalize(self):
-        self.assertEqual(bbbot.normalize("  Test String  "), "test string")
-        self.assertEqual(bbbot.normalize("AlreadyNormalized"), "alreadynormalized")
-        self.assertEqual(bbbot.normalize("UPPERCASE"), "uppercase")
-        self.assertEqual(bbbot.normalize(""), "")
-
-class TestBBBotFindProductUrls(unittest.TestCase):
-
-    @patch('bbbot.requests.post')
-    @patch('bbbot.PERPLEXITY_API_KEY', 'fake_api_key') # Ensure API key is set for tests
-    def test_find_product_urls_api_success(self, mock_post):
-        # Simulate a successful API response
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "choices": [{
-                "message": {
-                    "content": '''{
-                        "productos": [
-                            {"nombre": "Product A", "url": "http://example.com/a"},
-                            {"nombre": "Product B", "url": "http://example.com/b"}
-                        ]
-                    }'''
-                }
-            }]
-        }
-        mock_post.return_value = mock_response
-
-        # Mock datetime to make it always Monday
-        with patch('bbbot.datetime') as mock_datetime:
-            mock_datetime.now.return_value.weekday.return_value = 0 # Monday
-
-            # Mock open for saving the response
-            with patch('builtins.open', unittest.mock.mock_open()) as mock_file:
-                urls = bbbot.find_product_urls()
-                mock_file.assert_called_once_with(bbbot.PERPLEXITY_SAVE_FILE, 'w')
-
-        self.assertEqual(len(urls), 2)
-        self.assertIn("http://example.com/a", urls)
-        self.assertIn("http://example.com/b", urls)
-        mock_post.assert_called_once()
-
-    @patch('bbbot.requests.post')
-    @patch('bbbot.PERPLEXITY_API_KEY', 'fake_api_key')
-    def test_find_product_urls_api_error(self, mock_post):
-        # Simulate an API error
-        mock_response = MagicMock()
-        mock_response.status_code = 500
-        mock_response.raise_for_status.side_effect = bbbot.requests.exceptions.HTTPError("API Error")
-        mock_post.return_value = mock_response
+        self.assertEqual(bbbot._normalize_name("  Hydra-Serum  B5! "), "hydra serum b5")
+        self.assertEqual(bbbot._normalize_name("Crème ÉCLAT"), "crème éclat")
+        self.assertEqual(bbbot._normalize_name(""), "")
+        self.assertEqual(bbbot._normalize_url("https://WWW.Marca.com/Serum/?utm=1#top"), "marca.com/serum")
+        self.assertEqual(bbbot._normalize_url("marca.com/serum/"), "marca.com/serum")
 
-        with patch('bbbot.datetime') as mock_datetime:
-            mock_datetime.now.return_value.weekday.return_value = 0 # Monday
-            urls = bbbot.find_product_urls()
+    def test_normalize_url_keeps_identifying_params(self):
+        self.assertEqual(bbbot._normalize_url("https://tienda.cl/p?utm_source=x&id=1&gclid=abc&color=rosa"),
+                         "tienda.cl/p?color=rosa&id=1")
+        self.assertNotEqual(bbbot._normalize_url("tienda.cl/p?id=1"), bbbot._normalize_url("tienda.cl/p?id=2"))
+        self.assertEqual(bbbot._canonical_url("https://tienda.cl/es-cl/p/?id=1&fbclid=z"), "tienda.cl/p?id=1")
 
-        self.assertEqual(urls, [])
-        mock_post.assert_called_once()
+    def test_history_key_prefers_url(self):
+        self.assertEqual(bbbot._history_key({"nombre": "Serum", "url": "https://marca.com/s"}), "url:marca.com/s")
+        self.assertEqual(bbbot._history_key({"nombre": "Sérum B5", "url": "#"}), "nombre:sérum b5")
+        self.assertIsNone(bbbot._history_key({}))
 
-    @patch('bbbot.PERPLEXITY_API_KEY', 'fake_api_key')
-    def test_find_product_urls_load_from_file_success(self):
-        # Simulate existing PERPLEXITY_SAVE_FILE
-        mock_products_data = [
-            {"nombre": "Product C", "url": "http://example.com/c"},
-            {"nombre": "Product D", "url": "http://example.com/d"}
-        ]
-        mock_open_content = json.dumps(mock_products_data)
+class TestBBBotFindProducts(unittest.TestCase):
 
-        with patch('bbbot.datetime') as mock_datetime:
-            mock_datetime.now.return_value.weekday.return_value = 1 # Not Monday
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for name, value in [('HISTORY_DB_FILE', 'h.sqlite3'), ('HISTORY_FILE', 'h.json'),
+                            ('WEEKLY_PRODUCTS_FILE', 'weekly.json')]:
+            patcher = patch(f'bbbot.{name}', os.path.join(self.tmpdir, value))
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
-            with patch('builtins.open', unittest.mock.mock_open(read_data=mock_open_content)) as mock_file:
-                with patch('os.path.exists') as mock_exists: # Ensure this is not needed if open handles it
-                    mock_exists.return_value = True # Though mock_open should handle this
-                    urls = bbbot.find_product_urls()
-                    mock_file.assert_called_with(bbbot.PERPLEXITY_SAVE_FILE, 'r')
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot._get_model')
+    def test_find_products_api_success(self, mock_get_model):
+        products = [{"nombre": n, "marca": m, "url": f"https://example.com/{i}"} for i, (n, m) in enumerate(
+            [("Hydra Serum", "Aqua"), ("Retinal Oil", "Nocturne"), ("Peptide Cream", "Lift"),
+             ("Barrier Balm", "Derma"), ("Vitamin C Drops", "Citrus")])]
+        chunk = MagicMock(text=json.dumps(products), usage_metadata=None)
+        mock_get_model.return_value.generate_content.return_value = iter([chunk])
 
-        self.assertEqual(len(urls), 2)
-        self.assertIn("http://example.com/c", urls)
+        self.assertTrue(bbbot.find_products_with_gemini())
 
-    @patch('bbbot.PERPLEXITY_API_KEY', 'fake_api_key')
-    def test_find_product_urls_load_from_file_not_found(self):
-        with patch('bbbot.datetime') as mock_datetime:
-            mock_datetime.now.return_value.weekday.return_value = 1 # Not Monday
-            with patch('builtins.open', side_effect=FileNotFoundError) as mock_file:
-                urls = bbbot.find_product_urls()
+        with open(bbbot.WEEKLY_PRODUCTS_FILE, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), products)
+        with bbbot.ProductHistory(bbbot.HISTORY_DB_FILE, None) as history:
+            self.assertEqual(len(history), 5)
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot._get_model')
+    def test_find_products_api_error(self, mock_get_model):
+        mock_get_model.return_value.generate_content.side_effect = Exception("API Error")
+
+        self.assertFalse(bbbot.find_products_with_gemini())
+        self.assertFalse(os.path.exists(bbbot.WEEKLY_PRODUCTS_FILE))
 
-        self.assertEqual(urls, [])
+    @patch('bbbot.GEMINI_API_KEY', None)
+    def test_find_products_without_api_key(self):
+        self.assertFalse(bbbot.find_products_with_gemini())
+
+    def test_load_product_of_the_day_from_file(self):
+        with open(bbbot.WEEKLY_PRODUCTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump([{"nombre": "Product C"}, {"nombre": "Product D"}], f)
+
+        self.assertEqual(bbbot._load_product_of_the_day(1), {"nombre": "Product D"})
+        self.assertIsNone(bbbot._load_product_of_the_day(3))
+
+    def test_load_product_of_the_day_file_not_found(self):
+        self.assertIsNone(bbbot._load_product_of_the_day(1))
 
 class TestBBBotGenerateNewsletter(unittest.TestCase):
 
-    @patch('bbbot.client.chat.completions.create')
-    @patch('bbbot.OPENAI_KEY', 'fake_openai_key') # Ensure API key is set
-    def test_generate_newsletter_success(self, mock_create_completion):
-        mock_response = MagicMock()
-        mock_response.choices[0].message.content = "Generated HTML Newsletter"
-        mock_create_completion.return_value = mock_response
-
-        product_data = {
-            "nombre": "Test Product", "marca": "Test Brand", "precio": "10",
-            "tecnologia": "Test Tech", "descripcion": "Test Desc",
-            "ingredientes": ["i1", "i2"], "beneficios": ["b1", "b2"],
-            "tipo_piel": "All", "estudios_clinicos": "None", "sostenibilidad": "Good"
-        }
-        content = bbbot.generate_newsletter(product_data)
-
-        self.assertEqual(content, "Generated HTML Newsletter")
-        mock_create_completion.assert_called_once()
-
-    @patch('bbbot.client.chat.completions.create')
-    @patch('bbbot.OPENAI_KEY', 'fake_openai_key')
-    def test_generate_newsletter_api_error(self, mock_create_completion):
-        mock_create_completion.side_effect = Exception("OpenAI API Error")
-
-        product_data = {
-            "nombre": "Test Product", "marca": "Test Brand", "precio": "10",
-            "tecnologia": "Test Tech", "descripcion": "Test Desc",
-            "ingredientes": ["i1", "i2"], "beneficios": ["b1", "b2"],
-            "tipo_piel": "All", "estudios_clinicos": "None", "sostenibilidad": "Good"
-        }
+    product_data = {
+        "nombre": "Test Product", "marca": "Test Brand", "descripcion": "Test Desc",
+        "ingredientes": ["niacinamida", "ceramidas"], "url": "https://example.com/p",
+    }
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot.GEMINI_CACHE_BYPASS', True)
+    @patch('bbbot._get_model')
+    def test_generate_newsletter_success(self, mock_get_model):
+        mock_get_model.return_value.generate_content.return_value = iter([
+            MagicMock(text=part, usage_metadata=None) for part in ("```html\n<h1>Test Brand", " - Test Product</h1>\n```")])
+
+        content = bbbot.generate_newsletter_with_gemini(self.product_data)
+
+        self.assertEqual(content, "<h1>Test Brand - Test Product</h1>")
+        prompt = mock_get_model.return_value.generate_content.call_args.args[0]
+        self.assertIn("<b>niacinamida:</b>", prompt)
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot.GEMINI_CACHE_BYPASS', True)
+    @patch('bbbot._get_model')
+    def test_generate_newsletter_api_error(self, mock_get_model):
+        mock_get_model.return_value.generate_content.side_effect = Exception("Gemini API Error")
+
         with self.assertRaises(Exception) as context:
-            bbbot.generate_newsletter(product_data)
+            bbbot.generate_newsletter_with_gemini(self.product_data)
+
+        self.assertIn("Gemini API Error", str(context.exception))
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot.GEMINI_CACHE_BYPASS', True)
+    @patch('bbbot.GEMINI_GENERATION_BUDGET', 0.2)
+    @patch('bbbot._get_model')
+    def test_slow_response_falls_back_to_template(self, mock_get_model):
+        def slow_stream():
+            yield MagicMock(text="<h1>Empieza", usage_metadata=None)
+            time.sleep(1)
+            yield MagicMock(text=" tarde</h1>", usage_metadata=None)
+        mock_get_model.return_value.generate_content.return_value = slow_stream()
+
+        with patch('bbbot.metrics', bbbot.RunMetrics()) as metrics:
+            start = time.perf_counter()
+            content = bbbot.generate_newsletter_with_gemini(self.product_data)
+            self.assertLess(time.perf_counter() - start, 0.5)
+            self.assertEqual(metrics.counter('gemini_fallbacks'), 1)
+            self.assertEqual(metrics.histograms['gemini_ttft_seconds'].count, 1)
+
+        self.assertIn("<h1>Test Brand - Test Product</h1>", content)
+        self.assertIn("<li>niacinamida</li>", content)
+        self.assertTrue(bbbot._is_valid_newsletter(content))
+
+        mock_get_model.return_value.generate_content.return_value = slow_stream()
+        with self.assertRaises(TimeoutError):
+            bbbot.generate_newsletter_with_gemini(self.product_data, allow_fallback=False)
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot._get_model')
+    def test_non_html_response_is_cut_early_and_not_cached(self, mock_get_model):
+        consumed = []
 
-        self.assertTrue("OpenAI API Error" in str(context.exception))
+        def markdown_stream():
+            for part in ["# Título en Markdown", " y mucho texto", " que no debería descargarse"]:
+                time.sleep(0.05)  # Latencia de red entre fragmentos
+                consumed.append(part)
+                yield MagicMock(text=part, usage_metadata=None)
+        mock_get_model.return_value.generate_content.side_effect = lambda prompt, stream: markdown_stream()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = bbbot.ResponseCache(os.path.join(tmpdir, 'cache.sqlite3'))
+        self.addCleanup(cache.close)
+
+        with patch('bbbot._response_cache', return_value=cache):
+            content = bbbot.generate_newsletter_with_gemini(self.product_data)
+            bbbot.generate_newsletter_with_gemini(self.product_data)
+
+        self.assertTrue(content.startswith("<h1>Test Brand - Test Product</h1>"))
+        self.assertNotIn(" que no debería descargarse", consumed)
+        # La plantilla no se guarda: la segunda llamada vuelve a consultar a Gemini
+        self.assertEqual(mock_get_model.return_value.generate_content.call_count, 2)
+
+    @patch('bbbot.GEMINI_API_KEY', None)
+    def test_generate_newsletter_without_api_key(self):
+        with self.assertRaises(ValueError):
+            bbbot.generate_newsletter_with_gemini(self.product_data)
 
 class TestBBBotSendEmail(unittest.TestCase):
 
     @patch('bbbot.smtplib.SMTP')
+    @patch('bbbot.DELIVERY_BACKEND', 'smtp')
     @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
-    @patch('bbbot.EMAIL_RECEIVER', 'receiver@example.com')
     @patch('bbbot.SMTP_SERVER', 'smtp.example.com')
     @patch('bbbot.SMTP_PORT', 587)
     @patch('bbbot.SMTP_PASS', 'password')
     def test_send_email_success(self, mock_smtp_constructor):
-        mock_smtp_instance = MagicMock()
-        mock_smtp_constructor.return_value.__enter__.return_value = mock_smtp_instance # For 'with' statement
+        server = mock_smtp_constructor.return_value
+        server.sendmail.return_value = {}
 
-        subject = "Test Subject"
-        body = "Test Body"
-        product_url = "http://example.com/product"
-
-        bbbot.send_email(subject, body, product_url)
+        bbbot.send_email("Test Subject", "<p>Test Body</p>", "http://example.com/product", ["receiver@example.com"])
 
         mock_smtp_constructor.assert_called_with('smtp.example.com', 587, timeout=30)
-        mock_smtp_instance.starttls.assert_called_once()
-        mock_smtp_instance.login.assert_called_with('sender@example.com', 'password')
-        mock_smtp_instance.sendmail.assert_called_once()
-        # Could add more assertions about the content of sendmail if needed
+        server.starttls.assert_called_once()
+        server.login.assert_called_with('sender@example.com', 'password')
+        server.sendmail.assert_called_once()
+        sender, recipients, raw = server.sendmail.call_args.args
+        self.assertEqual((sender, recipients), ('sender@example.com', ['receiver@example.com']))
+        msg = email.message_from_bytes(raw)
+        self.assertEqual(msg['To'], 'receiver@example.com')
+        self.assertIn('http://example.com/product', msg.get_payload()[0].get_payload(decode=True).decode())
 
     @patch('bbbot.smtplib.SMTP')
+    @patch('bbbot.DELIVERY_BACKEND', 'smtp')
     @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
-    @patch('bbbot.EMAIL_RECEIVER', 'receiver@example.com')
     @patch('bbbot.SMTP_SERVER', 'smtp.example.com')
     @patch('bbbot.SMTP_PORT', 587)
     @patch('bbbot.SMTP_PASS', 'password')
     def test_send_email_smtp_error(self, mock_smtp_constructor):
-        mock_smtp_instance = MagicMock()
-        mock_smtp_instance.login.side_effect = smtplib.SMTPAuthenticationError(535, "Auth failed")
-        mock_smtp_constructor.return_value.__enter__.return_value = mock_smtp_instance
+        mock_smtp_constructor.return_value.login.side_effect = smtplib.SMTPAuthenticationError(535, "Auth failed")
 
         with self.assertRaises(smtplib.SMTPAuthenticationError):
-            bbbot.send_email("Subject", "Body", "url")
+            bbbot.send_email("Subject", "Body", "url", ["receiver@example.com"])
+
+class TestSMTPConnectionPool(unittest.TestCase):
+
+    @patch('bbbot.smtplib.SMTP')
+    def test_reconnects_after_max_per_session(self, mock_smtp_constructor):
+        pool = bbbot.SMTPConnectionPool('smtp.example.com', 587, 'user', 'pass', size=1, max_per_session=2)
+        for i in range(5):
+            pool.sendmail('sender@example.com', [f'r{i}@example.com'], 'msg')
+
+        # 5 mensajes con tope de 2 por sesión: 3 sesiones
+        self.assertEqual(mock_smtp_constructor.call_count, 3)
+        mock_smtp_constructor.return_value.login.assert_called_with('user', 'pass')
+
+    @patch('bbbot.smtplib.SMTP')
+    def test_reconnects_when_server_disconnects(self, mock_smtp_constructor):
+        server = mock_smtp_constructor.return_value
+        server.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), {}]
+        pool = bbbot.SMTPConnectionPool('smtp.example.com', 587, size=1)
+
+        self.assertEqual(pool.sendmail('sender@example.com', ['r@example.com'], 'msg'), {})
+        self.assertEqual(mock_smtp_constructor.call_count, 2)
+
+    def test_deliver_concurrently_collects_failures(self):
+        sent = []
+
+        def send_batch(batch):
+            if batch == ['bad@example.com']:
+                raise smtplib.SMTPRecipientsRefused({batch[0]: (550, b'No such user')})
+            sent.extend(batch)
+
+        recipients = [f'r{i}@example.com' for i in range(20)] + ['bad@example.com']
+        failures = bbbot.deliver_concurrently(recipients, send_batch, workers=4)
+
+        self.assertEqual(sorted(sent), sorted(recipients[:-1]))
+        self.assertEqual(list(failures), ['bad@example.com'])
+
+class TestBatchedDelivery(unittest.TestCase):
+
+    @patch('bbbot.smtplib.SMTP')
+    @patch('bbbot.SMTP_BATCH_SIZE', 3)
+    @patch('bbbot.SMTP_BACKOFF_BASE', 0.01)
+    @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
+    @patch('bbbot.SMTP_SERVER', 'smtp.example.com')
+    @patch('bbbot.SMTP_PORT', 587)
+    @patch('bbbot.SMTP_PASS', 'password')
+    def test_partial_refusals_are_retried_or_recorded(self, mock_smtp_constructor):
+        server = mock_smtp_constructor.return_value
+
+        def sendmail(sender, to_addrs, msg):
+            if len(to_addrs) > 1:
+                return {'busy@example.com': (450, b'Try later'), 'gone@example.com': (550, b'No such user')}
+            return {}
+        server.sendmail.side_effect = sendmail
+
+        recipients = ['ok@example.com', 'busy@example.com', 'gone@example.com']
+        with patch('bbbot.SMTP_POOL_SIZE', 1):
+            bbbot.send_email("Asunto", "<p>Hola</p>", "#", recipients)
+
+        envelopes = [call.args[1] for call in server.sendmail.call_args_list]
+        # Un sobre de 3 y un reintento individual sólo para el rechazo temporal
+        self.assertEqual(envelopes, [recipients, ['busy@example.com']])
+        self.assertIn(b'To: undisclosed-recipients:;', server.sendmail.call_args_list[0].args[2])
+
+class TestDomainScheduler(unittest.TestCase):
+
+    def drain(self, scheduler):
+        batches = []
+        while (batch := scheduler.get()) is not None:
+            batches.append(batch)
+            for recipient in batch:
+                scheduler.complete(recipient)
+        return batches
+
+    def test_batches_by_domain_and_interleaves(self):
+        scheduler = bbbot.DomainScheduler(batch_size=2)
+        for recipient in ['a1@gmail.com', 'a2@gmail.com', 'a3@gmail.com', 'b1@outlook.com', 'b2@outlook.com']:
+            scheduler.put(recipient)
+        scheduler.close()
+
+        batches = self.drain(scheduler)
+        self.assertEqual(batches, [['a1@gmail.com', 'a2@gmail.com'], ['b1@outlook.com', 'b2@outlook.com'],
+                                   ['a3@gmail.com']])
+
+    def test_slow_domain_does_not_block_others(self):
+        scheduler = bbbot.DomainScheduler(domain_rates={'gmail.com': 2})
+        for i in range(3):
+            scheduler.put(f'g{i}@gmail.com')
+        for i in range(10):
+            scheduler.put(f'o{i}@outlook.com')
+        scheduler.close()
+
+        start = time.monotonic()
+        batches = self.drain(scheduler)
+        elapsed = time.monotonic() - start
+
+        # gmail.com admite ráfagas de 2 y luego 1 cada 0,5 s; outlook.com sale sin esperar
+        order = [batch[0] for batch in batches]
+        self.assertEqual(order[-1], 'g2@gmail.com')
+        self.assertGreaterEqual(elapsed, 0.4)
+
+    def test_rate_limits_recipients_not_batches(self):
+        scheduler = bbbot.DomainScheduler(batch_size=5, domain_rates={'gmail.com': 2})
+        for i in range(4):
+            scheduler.put(f'g{i}@gmail.com')
+        scheduler.close()
+
+        start = time.monotonic()
+        batches = self.drain(scheduler)
+        elapsed = time.monotonic() - start
+
+        # Ráfaga de 2 fichas y luego 2 por segundo: los 4 destinatarios no caben en un solo lote
+        self.assertEqual(sum(len(batch) for batch in batches), 4)
+        self.assertLessEqual(max(len(batch) for batch in batches), 2)
+        self.assertGreaterEqual(elapsed, 0.9)
+
+    def test_deferral_backs_off_and_gives_up(self):
+        scheduler = bbbot.DomainScheduler(max_attempts=2, backoff_base=0.05)
+        scheduler.put('busy@gmail.com')
+        scheduler.close()
+
+        self.assertEqual(scheduler.get(), ['busy@gmail.com'])
+        self.assertTrue(scheduler.defer('busy@gmail.com'))
+        start = time.monotonic()
+        self.assertEqual(scheduler.get(), ['busy@gmail.com'])
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertFalse(scheduler.defer('busy@gmail.com'))
+        scheduler.complete('busy@gmail.com', ok=False)
+        self.assertIsNone(scheduler.get())
+
+    def test_deliver_concurrently_retries_temporary_refusals(self):
+        attempts = {}
+
+        def send_batch(batch):
+            # gmail.com rechaza temporalmente los dos primeros intentos de cada dirección
+            refused = {}
+            for recipient in batch:
+                attempts[recipient] = attempts.get(recipient, 0) + 1
+                if recipient.endswith('@gmail.com') and attempts[recipient] <= 2:
+                    refused[recipient] = (421, b'Too many connections')
+            return refused
+
+        recipients = [f'u{i}@gmail.com' for i in range(3)] + [f'u{i}@outlook.com' for i in range(3)]
+        scheduler = bbbot.DomainScheduler(batch_size=10, max_attempts=3, backoff_base=0.01)
+        failures = bbbot.deliver_concurrently(recipients, send_batch, 2, scheduler)
+
+        self.assertEqual(failures, {})
+        self.assertEqual({r: n for r, n in attempts.items() if r.endswith('@gmail.com')},
+                         {f'u{i}@gmail.com': 3 for i in range(3)})
+        self.assertTrue(all(attempts[f'u{i}@outlook.com'] == 1 for i in range(3)))
+
+    def test_parse_domain_rates(self):
+        self.assertEqual(bbbot._parse_domain_rates(' Gmail.com=5, outlook.com=0.5,'),
+                         {'gmail.com': 5.0, 'outlook.com': 0.5})
+
+class TestDeliveryBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @patch('bbbot.SMTP_BATCH_SIZE', 2)
+    @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
+    @patch('bbbot.SMTP_SERVER', None)
+    @patch('bbbot.SMTP_PASS', None)
+    def test_maildir_spools_messages_with_envelope(self):
+        with patch('bbbot.DELIVERY_BACKEND', 'maildir'), patch('bbbot.DELIVERY_SPOOL_DIR', self.tmpdir):
+            bbbot.send_email("Asunto", "<p>Hola</p>", "#", ['a@example.com', 'b@example.com', 'c@example.com'])
+
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'tmp')), [])
+        spooled = []
+        for name in os.listdir(os.path.join(self.tmpdir, 'new')):
+            with open(os.path.join(self.tmpdir, 'new', name), 'rb') as f:
+                raw = f.read()
+            with open(os.path.join(self.tmpdir, 'envelope', name), encoding='utf-8') as f:
+                envelope = json.load(f)
+            self.assertNotIn(b'\r\n', raw)
+            msg = email.message_from_bytes(raw)
+            # El sobre no va en el mensaje: en modo por lotes no se revelan los demás destinatarios
+            self.assertIsNone(msg['X-Original-To'])
+            if len(envelope['to']) > 1:
+                for recipient in envelope['to']:
+                    self.assertNotIn(recipient.encode(), raw)
+            self.assertEqual(envelope['from'], 'sender@example.com')
+            self.assertIn('>Hola</p>', msg.get_payload()[0].get_payload(decode=True).decode())
+            spooled.extend(envelope['to'])
+        self.assertEqual(sorted(spooled), ['a@example.com', 'b@example.com', 'c@example.com'])
+
+    @patch('bbbot.EMAIL_SENDER', None)
+    def test_null_backend_needs_no_credentials(self):
+        backend = bbbot.NullBackend(size=2)
+        with patch('bbbot.DELIVERY_BACKEND', 'null'):
+            bbbot.send_email("Asunto", "<p>Hola</p>", "#", (f'r{i}@example.com' for i in range(5)), backend=backend)
+
+        self.assertEqual((backend.messages, backend.recipients), (5, 5))
+        self.assertGreater(backend.bytes, 0)
+
+    @patch('bbbot.SMTP_PASS', None)
+    def test_smtp_backend_still_requires_credentials(self):
+        with patch('bbbot.DELIVERY_BACKEND', 'smtp'), self.assertRaises(ValueError):
+            bbbot.send_email("Asunto", "<p>Hola</p>", "#", ['a@example.com'])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            bbbot.create_delivery_backend('carrier-pigeon')
+
+class TestDeliveryJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_rerun_skips_delivered_recipients(self):
+        with bbbot.DeliveryJournal("Asunto", directory=self.tmpdir) as journal:
+            journal.record("a@example.com", "sent", 0.01)
+            journal.record("b@example.com", "failed", error="450 busy")
+
+        with bbbot.DeliveryJournal("Asunto", directory=self.tmpdir) as journal:
+            self.assertTrue(journal.already_delivered("a@example.com"))
+            self.assertFalse(journal.already_delivered("b@example.com"))
+        with bbbot.DeliveryJournal("Otro asunto", directory=self.tmpdir) as journal:
+            self.assertFalse(journal.already_delivered("a@example.com"))
+
+    def test_truncated_last_line_is_ignored(self):
+        with bbbot.DeliveryJournal("Asunto", directory=self.tmpdir) as journal:
+            journal.record("a@example.com", "sent", 0.01)
+            path = journal.path
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('{"subject": "Asunto", "to": "b@exa')
+
+        with bbbot.DeliveryJournal("Asunto", directory=self.tmpdir) as journal:
+            self.assertTrue(journal.already_delivered("a@example.com"))
+
+    @patch('bbbot.smtplib.SMTP')
+    @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
+    @patch('bbbot.SMTP_SERVER', 'smtp.example.com')
+    @patch('bbbot.SMTP_PORT', 587)
+    @patch('bbbot.SMTP_PASS', 'password')
+    def test_send_email_only_sends_remaining(self, mock_smtp_constructor):
+        with bbbot.DeliveryJournal("Asunto", directory=self.tmpdir) as journal:
+            journal.record("a@example.com", "sent", 0.01)
+            bbbot.send_email("Asunto", "<p>Hola</p>", "#", ["a@example.com", "b@example.com"], journal)
+            self.assertTrue(journal.already_delivered("b@example.com"))
+
+        envelopes = [call.args[1] for call in mock_smtp_constructor.return_value.sendmail.call_args_list]
+        self.assertEqual(envelopes, [["b@example.com"]])
+
+class TestStartup(unittest.TestCase):
+
+    def test_import_does_not_load_google_clients(self):
+        code = ("import sys, bbbot; "
+                "print([m for m in ('google.generativeai', 'gspread', 'google.oauth2', 'asyncio') if m in sys.modules])")
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(bbbot.__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+    @patch('bbbot._write_run_report')
+    @patch('bbbot.iter_subscribers')
+    @patch('bbbot.load_campaigns')
+    def test_weekend_exits_before_reading_subscribers(self, mock_campaigns, mock_subscribers, mock_report):
+        with patch('bbbot.datetime') as mock_datetime:
+            mock_datetime.now.return_value.weekday.return_value = 5  # Sábado
+            bbbot.main()
+
+        mock_campaigns.assert_not_called()
+        mock_subscribers.assert_not_called()
+        mock_report.assert_called_once()
+
+class TestRunState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.products_file = os.path.join(self.tmpdir, 'products.json')
+        products = [{"nombre": f"Producto {i}", "url": f"https://example.com/{i}"} for i in range(5)]
+        with open(self.products_file, 'w', encoding='utf-8') as f:
+            json.dump(products, f)
+        for target, value in [('bbbot.RUN_STATE_FILE', os.path.join(self.tmpdir, 'state.json')),
+                              ('bbbot.WEEKLY_PRODUCTS_FILE', self.products_file),
+                              ('bbbot.WEEKLY_NEWSLETTERS_FILE', os.path.join(self.tmpdir, 'newsletters.json')),
+                              ('bbbot.DeliveryJournal', MagicMock()),
+                              ('bbbot._write_run_report', MagicMock()),
+                              ('bbbot._open_campaigns',
+                               lambda campaigns: [(campaigns[0], iter(["a@example.com"]))])]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_on(self, day):
+        class FixedDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return day
+        with patch('bbbot.datetime', FixedDatetime):
+            bbbot.main()
+
+    def test_stages_are_persisted_per_week_and_day(self):
+        state = bbbot.RunState(keep_weeks=2)
+        monday = datetime(2026, 1, 5)
+        state.mark(monday, "search", products=["a"])
+        state.mark(monday + timedelta(days=2), "delivery", sent=3)
+        state.mark(monday + timedelta(days=7), "search")
+        state.mark(monday + timedelta(days=14), "search")
+
+        reloaded = bbbot.RunState()
+        self.assertIsNone(reloaded.get(monday, "search"))  # semana más antigua descartada
+        self.assertTrue(reloaded.done(monday + timedelta(days=14), "search"))
+        self.assertEqual(bbbot.RunState.week_key(monday), "2026-W02")
+        self.assertEqual([d.day for d in reloaded.pending_days(datetime(2026, 1, 21))], [19, 20, 21])
+
+    def test_unreadable_state_starts_empty(self):
+        with open(bbbot.RUN_STATE_FILE, 'w', encoding='utf-8') as f:
+            f.write('{"2026-W02": {"sea')
+        self.assertEqual(bbbot.RunState().pending_days(datetime(2026, 1, 6)), [datetime(2026, 1, 5), datetime(2026, 1, 6)])
+
+    @patch('bbbot.send_email')
+    @patch('bbbot.generate_newsletter_with_gemini', return_value="<h1>Hola</h1>")
+    def test_rerun_does_only_outstanding_work(self, mock_generate, mock_send):
+        tuesday = datetime(2026, 1, 6, 9, 30)
+        bbbot.RunState().mark(datetime(2026, 1, 5), "search", file=self.products_file)
+        mock_send.side_effect = [smtplib.SMTPException("caído"), None]
+
+        self.run_on(tuesday)  # se genera y el envío falla
+        self.run_on(tuesday)  # sólo se reintenta el envío, con el mismo contenido
+        self.run_on(tuesday)  # nada pendiente
+
+        self.assertEqual(mock_generate.call_count, 1)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual(mock_send.call_args.args[:3], (bbbot._subject_for(1), "<h1>Hola</h1>", "https://example.com/1"))
+        state = bbbot.RunState()
+        self.assertEqual(state.get(tuesday, "delivery")["product"], "https://example.com/1")
+
+    @patch('bbbot.send_email')
+    @patch('bbbot.generate_newsletter_with_gemini', return_value="<h1>Hola</h1>")
+    def test_failed_recipients_keep_the_day_pending(self, mock_generate, mock_send):
+        tuesday = datetime(2026, 1, 6, 9, 30)
+        bbbot.RunState().mark(datetime(2026, 1, 5), "search", file=self.products_file)
+        # Primera ejecución: un destinatario agota sus reintentos; la segunda termina sin fallos
+        outcomes = iter([1, 0])
+        mock_send.side_effect = lambda *args, **kwargs: bbbot.metrics.incr("emails_failed", next(outcomes))
+
+        self.run_on(tuesday)
+        self.assertFalse(bbbot.RunState().done(tuesday, "delivery"))
+        self.run_on(tuesday)
+        self.assertEqual(bbbot.RunState().get(tuesday, "delivery")["failed"], 0)
+        self.run_on(tuesday)  # nada pendiente
+
+        self.assertEqual(mock_send.call_count, 2)
+
+    @patch('bbbot.send_email')
+    @patch('bbbot.generate_newsletter_with_gemini', return_value="<h1>Hola</h1>")
+    def test_new_week_searches_even_with_fresh_products_file(self, mock_generate, mock_send):
+        # En CI el checkout deja la mtime en "ahora": los productos de la semana pasada parecen nuevos
+        bbbot.RunState().mark(datetime(2025, 12, 29), "search", file=self.products_file)
+        monday = datetime(2026, 1, 5, 9, 30)
+        os.utime(self.products_file, (monday.timestamp(), monday.timestamp()))
+
+        with patch('bbbot._run_weekly_search', return_value=True) as mock_search:
+            self.run_on(monday)
+
+        mock_search.assert_called_once()
+        self.assertTrue(bbbot.RunState().done(monday, "search"))
+
+    @patch('bbbot.send_email')
+    @patch('bbbot.generate_newsletter_with_gemini', return_value="<h1>Hola</h1>")
+    def test_missed_search_runs_later_in_the_week(self, mock_generate, mock_send):
+        # La búsqueda consta sólo en la semana anterior: el martes no se usan esos productos, se busca de nuevo
+        bbbot.RunState().mark(datetime(2025, 12, 29), "search", file=self.products_file)
+        with patch('bbbot._run_weekly_search', return_value=False) as mock_search:
+            self.run_on(datetime(2026, 1, 6, 9, 30))
+        mock_search.assert_called_once()
+        mock_send.assert_not_called()
+
+        with patch('bbbot._run_weekly_search', return_value=True):
+            self.run_on(datetime(2026, 1, 7, 9, 30))
+        self.assertEqual(mock_send.call_args.args[0], bbbot._subject_for(2))
+
+    @patch('bbbot.BBBOT_CATCH_UP', True)
+    @patch('bbbot.send_email')
+    @patch('bbbot.generate_newsletter_with_gemini', return_value="<h1>Hola</h1>")
+    def test_catch_up_sends_missed_days_in_order(self, mock_generate, mock_send):
+        wednesday = datetime(2026, 1, 7, 9, 30)
+        state = bbbot.RunState()
+        state.mark(wednesday, "search")
+        state.mark(datetime(2026, 1, 5), "delivery")
+
+        self.run_on(wednesday)
+
+        self.assertEqual([c.args[0] for c in mock_send.call_args_list], [bbbot._subject_for(1), bbbot._subject_for(2)])
+        self.assertEqual(bbbot.RunState().pending_days(wednesday), [])
+
+class TestMainAsync(unittest.TestCase):
+
+    @patch('bbbot._write_run_report')
+    @patch('bbbot.DeliveryJournal')
+    @patch('bbbot.send_email')
+    @patch('bbbot._load_product_of_the_day', return_value={"nombre": "Serum", "url": "https://example.com"})
+    @patch('bbbot.EMAIL_SENDER', None)
+    def test_stages_run_concurrently(self, mock_load, mock_send, mock_journal, mock_report):
+        # Cada etapa espera a la otra: si corrieran una tras otra, la barrera se rompería por tiempo
+        barrier = threading.Barrier(2, timeout=5)
+
+        def slow(result):
+            def stage(*args):
+                try:
+                    barrier.wait()
+                except threading.BrokenBarrierError:
+                    pass
+                return result
+            return stage
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        tuesday = datetime(2026, 1, 6, 9, 30)
+        state_file = os.path.join(tmpdir, 'state.json')
+        bbbot.RunState(state_file).mark(tuesday, "search", products=["https://example.com"])
+
+        class Tuesday(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return tuesday
+
+        with patch('bbbot.iter_subscribers', side_effect=slow(iter(["a@example.com"]))), \
+             patch('bbbot.generate_newsletter_with_gemini', side_effect=slow("<p>Hola</p>")), \
+             patch('bbbot.RUN_STATE_FILE', state_file), \
+             patch('bbbot.WEEKLY_NEWSLETTERS_FILE', os.path.join(tmpdir, 'newsletters.json')), \
+             patch('bbbot.datetime', Tuesday):
+            asyncio.run(bbbot.main_async())
+
+        self.assertFalse(barrier.broken)
+        args = mock_send.call_args.args
+        self.assertEqual(args[:3], (bbbot._subject_for(1), "<p>Hola</p>", "https://example.com"))
+        self.assertEqual(list(args[3]), ["a@example.com"])
+        self.assertEqual(set(bbbot.metrics.phases), {"suscriptores", "contenido", "envío"})
+        mock_report.assert_called_once()
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = patch('bbbot.metrics', bbbot.RunMetrics())
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_instrumented_generator_excludes_consumer_time(self):
+        @bbbot.instrumented("lectura")
+        def produce():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+
+        consumed = 0.0
+        start = time.perf_counter()
+        for _ in produce():
+            before = time.perf_counter()
+            time.sleep(0.05)
+            consumed += time.perf_counter() - before
+        total = time.perf_counter() - start
+
+        seconds = self.metrics.stages["lectura"]["seconds"]
+        self.assertGreaterEqual(seconds, 0.03)
+        # Sin el consumidor, la etapa queda muy por debajo del total (se descuenta al menos la mitad)
+        self.assertLess(seconds, total - consumed / 2)
+
+    def test_histogram_quantiles(self):
+        histogram = bbbot.LatencyHistogram()
+        for _ in range(90):
+            histogram.observe(0.02)
+        histogram.observe(3.0, times=10)
+
+        self.assertEqual(histogram.quantile(0.5), 0.025)
+        self.assertEqual(histogram.quantile(0.95), 3.0)
+        self.assertEqual(histogram.to_dict()["buckets"]["+Inf"], 100)
+
+    @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
+    def test_send_email_report(self):
+        bbbot.send_email("Asunto", "<p>Hola</p>", "#", [f'r{i}@example.com' for i in range(4)],
+                         backend=bbbot.NullBackend())
+        textfile = os.path.join(self.tmpdir, 'bbbot.prom')
+        path = self.metrics.write_report(self.tmpdir, textfile=textfile)
+
+        with open(path, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(report["counters"]["emails_sent"], 4)
+        self.assertEqual(report["histograms"]["send_latency_seconds"]["count"], 4)
+        self.assertEqual(report["stages"]["send"]["calls"], 1)
+        self.assertGreater(report["throughput_emails_per_second"], 0)
+        with open(textfile, encoding='utf-8') as f:
+            exposition = f.read()
+        self.assertIn('bbbot_stage_seconds{stage="send"}', exposition)
+        self.assertIn('bbbot_emails_sent_total 4', exposition)
+        self.assertIn('bbbot_send_latency_seconds_bucket{le="+Inf"} 4', exposition)
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'cache.sqlite3')
+
+    def test_hit_miss_and_ttl(self):
+        cache = bbbot.ResponseCache(self.path, ttl=60, max_entries=10)
+        self.addCleanup(cache.close)
+        self.assertIsNone(cache.get('m', 'prompt'))
+        cache.put('m', 'prompt', 'respuesta')
+        self.assertEqual(cache.get('m', 'prompt'), 'respuesta')
+        self.assertIsNone(cache.get('otro-modelo', 'prompt'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        with patch('bbbot.time.time', return_value=time.time() + 120):
+            self.assertIsNone(cache.get('m', 'prompt'))
+
+    def test_lru_eviction(self):
+        cache = bbbot.ResponseCache(self.path, ttl=60, max_entries=2)
+        self.addCleanup(cache.close)
+        cache.put('m', 'a', '1')
+        time.sleep(0.01)
+        cache.put('m', 'b', '2')
+        time.sleep(0.01)
+        cache.get('m', 'a')  # 'a' pasa a ser la más reciente
+        time.sleep(0.01)
+        cache.put('m', 'c', '3')
+
+        self.assertEqual(cache.get('m', 'a'), '1')
+        self.assertIsNone(cache.get('m', 'b'))
+        self.assertEqual(cache.get('m', 'c'), '3')
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot._get_model')
+    def test_newsletter_generation_reuses_cached_response(self, mock_get_model):
+        mock_get_model.return_value.generate_content.return_value = iter([
+            MagicMock(text="```html\n<h1>Hola</h1>\n```", usage_metadata=None)])
+        cache = bbbot.ResponseCache(self.path)
+        self.addCleanup(cache.close)
+        product = {"nombre": "Serum", "marca": "Marca", "ingredientes": ["niacinamida"]}
+
+        with patch('bbbot._response_cache', return_value=cache):
+            first = bbbot.generate_newsletter_with_gemini(product)
+            second = bbbot.generate_newsletter_with_gemini(product)
+
+        self.assertEqual(first, "<h1>Hola</h1>")
+        self.assertEqual(second, first)
+        mock_get_model.return_value.generate_content.assert_called_once()
+
+class TestWeeklyPregeneration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = patch('bbbot.WEEKLY_NEWSLETTERS_FILE', os.path.join(self.tmpdir, 'newsletters.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pregenerated_newsletters_are_reused(self):
+        products = [{"nombre": f"P{i}", "url": f"https://example.com/{i}"} for i in range(5)]
+
+        def generate(product, allow_fallback=True):
+            self.assertFalse(allow_fallback)
+            if product["nombre"] == "P3":
+                return "# Markdown inválido"
+            return f"<h1>{product['nombre']}</h1>"
+
+        with patch('bbbot.generate_newsletter_with_gemini', side_effect=generate):
+            self.assertEqual(bbbot.pregenerate_weekly_newsletters(products), 4)
+
+        with patch('bbbot.generate_newsletter_with_gemini', return_value="<h1>Nuevo</h1>") as mock_generate:
+            self.assertEqual(bbbot._newsletter_for(products[1]), "<h1>P1</h1>")
+            # El que no pasó la validación se genera en el día
+            self.assertEqual(bbbot._newsletter_for(products[3]), "<h1>Nuevo</h1>")
+            mock_generate.assert_called_once_with(products[3])
+
+    def test_token_bucket_limits_rate(self):
+        bucket = bbbot.TokenBucket(rate=10, capacity=1)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertGreater(bucket.try_acquire(), 0.0)
+        self.assertEqual(bbbot.TokenBucket(rate=0).try_acquire(), 0.0)
+
+class TestProductHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db_path = os.path.join(self.tmpdir, 'history.sqlite3')
+
+    def test_history_key_normalizes_urls_and_names(self):
+        self.assertEqual(bbbot._history_key({"url": "https://www.Brand.com/serum/?utm=x"}),
+                         bbbot._history_key({"url": "http://brand.com/serum"}))
+        self.assertEqual(bbbot._history_key({"nombre": "  Sérum  C-Firma "}),
+                         bbbot._history_key({"nombre": "sérum c firma"}))
+
+    def test_migrates_legacy_json_and_appends_incrementally(self):
+        legacy = os.path.join(self.tmpdir, 'product_history.json')
+        with open(legacy, 'w', encoding='utf-8') as f:
+            json.dump([{"nombre": "A", "url": "https://a.com/p"}, {"nombre": "B"}], f)
+
+        with bbbot.ProductHistory(self.db_path, legacy_json=legacy) as history:
+            self.assertEqual(len(history), 2)
+            self.assertTrue(history.contains({"url": "https://www.a.com/p/"}))
+            self.assertEqual(history.add_many([{"nombre": "B"}, {"nombre": "C"}]), 1)
+
+        self.assertFalse(os.path.exists(legacy))
+        self.assertTrue(os.path.exists(legacy + '.migrated'))
+        with bbbot.ProductHistory(self.db_path, legacy_json=legacy) as history:
+            self.assertEqual(len(history), 3)
+
+class TestNearDuplicates(unittest.TestCase):
+
+    SERUM = {"marca": "Augustinus Bader", "nombre": "Bio-Sculpting Serum",
+             "url": "https://augustinusbader.com/en-us/bio-sculpting-serum/"}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_canonical_url_drops_locale_segment(self):
+        self.assertEqual(bbbot._canonical_url("https://www.brand.com/es-cl/serum/"), "brand.com/serum")
+        self.assertEqual(bbbot._canonical_url("https://brand.com/en_US/serum?ref=1"), "brand.com/serum")
+        self.assertEqual(bbbot._canonical_url("https://brand.com/serum-cl/x"), "brand.com/serum-cl/x")
+
+    def test_history_finds_near_duplicates(self):
+        with bbbot.ProductHistory(os.path.join(self.tmpdir, 'h.sqlite3'), legacy_json=None) as history:
+            history.add_many([self.SERUM, {"marca": "Augustinus Bader", "nombre": "The Rich Cream"}])
+            key = bbbot._history_key(self.SERUM)
+
+            self.assertEqual(history.find_duplicate(
+                {"nombre": "Bio-Sculpting Serum", "marca": "Augustinus Bader",
+                 "url": "https://augustinusbader.com/es-cl/bio-sculpting-serum"}), key)
+            self.assertEqual(history.find_duplicate(
+                {"nombre": "The Bio Sculpting Serum", "marca": "Augustinus Bader",
+                 "url": "https://augustinusbader.com/serums/bio"}), key)
+            self.assertIsNone(history.find_duplicate(
+                {"nombre": "Vitamin C Booster", "marca": "Drunk Elephant", "url": "https://drunkelephant.com/c"}))
+
+    def test_in_memory_index(self):
+        index = bbbot.NearDuplicateIndex()
+        index.add(self.SERUM)
+        self.assertIsNotNone(index.find({"marca": "Augustinus Bader", "nombre": "Bio Sculpting Serum"}))
+        self.assertIsNone(index.find({"marca": "La Roche-Posay", "nombre": "Cicaplast Baume B5"}))
+
+class TestAdaptiveSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for name, value in [('HISTORY_DB_FILE', 'h.sqlite3'), ('HISTORY_FILE', 'h.json'),
+                            ('WEEKLY_PRODUCTS_FILE', 'weekly.json')]:
+            patcher = patch(f'bbbot.{name}', os.path.join(self.tmpdir, value))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _chunks(products, usage=100):
+        text = json.dumps(products)
+        # Cortes arbitrarios para simular el streaming
+        pieces = [text[i:i + 7] for i in range(0, len(text), 7)]
+        return [MagicMock(text=p, usage_metadata=MagicMock(total_token_count=usage)) for p in pieces]
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot.SEARCH_OVERSAMPLE', 1)
+    @patch('bbbot._get_model')
+    def test_requests_only_missing_products_and_stops_early(self, mock_get_model):
+        first = [{"nombre": n, "marca": "Marca", "url": f"https://m.com/{i}"}
+                 for i, n in enumerate(["Hydra Serum", "Retinal Night Oil", "Peptide Eye Cream"])]
+        second = [{"nombre": n, "marca": "Otra", "url": f"https://o.com/{i}"}
+                  for i, n in enumerate(["Barrier Balm", "Vitamin C Drops", "Ceramide Toner", "Clay Mask"])]
+        streams = [iter(self._chunks(first + [first[0]])), iter(self._chunks(second))]
+        mock_get_model.return_value.generate_content.side_effect = lambda prompt, stream: streams.pop(0)
+
+        with patch('bbbot.metrics', bbbot.RunMetrics()) as metrics:
+            self.assertTrue(bbbot.find_products_with_gemini())
+            self.assertEqual((metrics.counter('gemini_api_calls'), metrics.counter('gemini_tokens')), (2, 200))
+            self.assertEqual(metrics.counter('gemini_search_retries'), 1)
+
+        prompts = [call.args[0] for call in mock_get_model.return_value.generate_content.call_args_list]
+        self.assertIn("encuentra los 6 productos", prompts[0])
+        self.assertIn("encuentra los 3 productos", prompts[1])
+        self.assertIn("Marca Hydra Serum", prompts[1])
+        with open(bbbot.WEEKLY_PRODUCTS_FILE, encoding='utf-8') as f:
+            self.assertEqual([p["nombre"] for p in json.load(f)],
+                             ["Hydra Serum", "Retinal Night Oil", "Peptide Eye Cream", "Barrier Balm", "Vitamin C Drops"])
+
+    def test_iter_json_objects_handles_split_chunks(self):
+        chunks = ['```json\n[{"nombre": "A {', '}", "x": {"y": 1}}, {"nom', 'bre": "B"}, {roto}, {"nombre": "C"']
+        self.assertEqual([o["nombre"] for o in bbbot._iter_json_objects(chunks)], ["A {}", "B"])
+
+class TestProductExtraction(unittest.TestCase):
+
+    @staticmethod
+    def products(text, size=5):
+        return list(bbbot._iter_products(text[i:i + size] for i in range(0, len(text), size)))
+
+    def test_salvages_truncated_array_with_surrounding_text(self):
+        text = ('Aquí tienes:\n```json\n[{"nombre": "Hydra Serum", "marca": "Aqua"},\n'
+                ' {"nombre": "Retinal Oil", "marca": "Nocturne", "descripcion": "Cortado a la mit')
+        self.assertEqual(self.products(text), [{"nombre": "Hydra Serum", "marca": "Aqua"}])
+
+    def test_tolerates_wrapper_trailing_commas_and_raw_newlines(self):
+        text = ('{"productos": [{"nombre": "Barrier Balm", "marca": "Derma", "ingredientes": ["ceramidas",],},'
+                ' {"nombre": "Clay Mask", "marca": "Terra", "descripcion": "Dos\nlíneas"}]} Espero que sirva.')
+        products = self.products(text)
+        self.assertEqual([p["nombre"] for p in products], ["Barrier Balm", "Clay Mask"])
+        self.assertEqual(products[0]["ingredientes"], ["ceramidas"])
+        self.assertEqual(products[1]["descripcion"], "Dos\nlíneas")
+
+    def test_schema_validation(self):
+        product = bbbot._validate_product({
+            "nombre": " Peptide Cream ", "marca": "Lift", "precio": 80, "url": "N/A",
+            "ingredientes": "péptidos, niacinamida", "beneficios": None, "extra": "x"})
+        self.assertEqual(product, {"nombre": "Peptide Cream", "marca": "Lift", "precio": "80",
+                                   "ingredientes": ["péptidos", "niacinamida"]})
+        self.assertIsNone(bbbot._validate_product({"nombre": "Sin marca"}))
+        self.assertEqual(set(bbbot.PRODUCT_SCHEMA), set(json.loads(bbbot.PRODUCT_SCHEMA_PROMPT)))
+
+    @patch('bbbot.GEMINI_API_KEY', 'fake_api_key')
+    @patch('bbbot._get_model')
+    def test_truncated_response_needs_one_more_call_only_for_missing(self, mock_get_model):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        names = [("Hydra Serum", "Aqua"), ("Retinal Oil", "Nocturne"), ("Peptide Cream", "Lift"),
+                 ("Barrier Balm", "Derma"), ("Vitamin C Drops", "Citrus")]
+        products = [{"nombre": n, "marca": m, "url": f"https://example.com/{i}"} for i, (n, m) in enumerate(names)]
+        # Primera respuesta: 4 productos y un quinto truncado; la segunda trae el que falta
+        first = json.dumps(products[:4])[:-1] + ', {"nombre": "Clay'
+        second = "```json\n" + json.dumps(products[4:]) + "\n```"
+        streams = [iter([MagicMock(text=first, usage_metadata=None)]),
+                   iter([MagicMock(text=second, usage_metadata=None)])]
+        mock_get_model.return_value.generate_content.side_effect = lambda prompt, stream: streams.pop(0)
+
+        with patch('bbbot.HISTORY_DB_FILE', os.path.join(tmpdir, 'h.sqlite3')), \
+             patch('bbbot.HISTORY_FILE', os.path.join(tmpdir, 'h.json')), \
+             patch('bbbot.WEEKLY_PRODUCTS_FILE', os.path.join(tmpdir, 'weekly.json')), \
+             patch('bbbot.SEARCH_OVERSAMPLE', 0):
+            self.assertTrue(bbbot.find_products_with_gemini())
+
+        prompts = [call.args[0] for call in mock_get_model.return_value.generate_content.call_args_list]
+        self.assertEqual(len(prompts), 2)
+        self.assertIn("encuentra los 1 productos", prompts[1])
+
+class FakeWorksheet:
+    """Hoja de gspread en memoria: columna B (y opcionalmente C) con encabezado en la fila 1."""
+
+    def __init__(self, emails, row_count=1000, segments=()):
+        self.column = ["Correo"] + list(emails)
+        self.segments = ["Tipo de piel"] + list(segments)
+        self.row_count = row_count
+        self.calls = []
+
+    def get(self, range_name):
+        self.calls.append(range_name)
+        first_cell, last_cell = range_name.split(":")
+        first, last = int(first_cell[1:]), int(last_cell[1:])
+        rows = []
+        for index in range(first - 1, min(last, len(self.column))):
+            cells = [self.column[index]]
+            if last_cell[0] == "C":
+                cells.append(self.segments[index] if index < len(self.segments) else "")
+            # Igual que la API: sin celdas vacías al final de cada fila
+            while cells and not cells[-1]:
+                cells.pop()
+            rows.append(cells)
+        # Igual que la API: sin filas vacías al final
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+
+class TestSubscriberSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.worksheet = FakeWorksheet(["a@example.com", "", "no-es-correo"], row_count=8)
+        client = MagicMock()
+        client.open_by_key.return_value.worksheet.return_value = self.worksheet
+        for target, value in [('bbbot.SUBSCRIBERS_DB_FILE', os.path.join(self.tmpdir, 's.sqlite3')),
+                              ('bbbot.GOOGLE_SHEET_KEY', 'sheet-key'),
+                              ('bbbot._sheets_client', MagicMock(return_value=client))]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_incremental_refresh_reads_only_new_rows(self):
+        self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com"])
+        self.worksheet.column.append("b@example.com")
+
+        self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com", "b@example.com"])
+        # Lectura completa en páginas y luego desde la última fila con datos, para comprobar que sigue igual
+        self.assertEqual(self.worksheet.calls, ["B2:B1001", "B4:B1003"])
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_deleted_row_forces_full_refresh(self):
+        self.worksheet.column[1:] = ["a@example.com", "b@example.com", "c@example.com"]
+        bbbot.get_subscribers_from_sheet()
+        # Baja de b (se borra su fila y las siguientes suben) y alta de d en la fila que quedó libre
+        del self.worksheet.column[2]
+        self.worksheet.column.append("d@example.com")
+
+        self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com", "c@example.com", "d@example.com"])
+        self.assertEqual(self.worksheet.calls, ["B2:B1001", "B4:B1003", "B2:B1001"])
+
+    def test_fresh_snapshot_skips_sheets(self):
+        bbbot.get_subscribers_from_sheet()
+        self.worksheet.column.append("b@example.com")
+        with patch('bbbot.SUBSCRIBERS_CACHE_TTL', 3600):
+            self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com"])
+        self.assertEqual(len(self.worksheet.calls), 1)
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_streams_pages_with_validation_and_dedup(self):
+        self.worksheet.column[1:] = ["A@Example.com ", "a@example.com", "x@", "b@example.com", "", "c@example.com"]
+        stream = bbbot.iter_subscribers(page_size=2)
+
+        self.assertEqual(next(stream), "a@example.com")
+        # Sólo se pidió la primera página para producir el primer correo
+        self.assertEqual(self.worksheet.calls, ["B2:B3"])
+        self.assertEqual(list(stream), ["b@example.com", "c@example.com"])
+        self.assertEqual(self.worksheet.calls, ["B2:B3", "B4:B5", "B6:B7", "B8:B9"])
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_failure_mid_refresh_completes_from_snapshot(self):
+        self.worksheet.column[1:] = ["a@example.com", "b@example.com", "c@example.com"]
+        bbbot.get_subscribers_from_sheet()
+
+        def flaky_get(range_name):
+            raise TimeoutError("Sheets lento")
+        with patch('bbbot.SUBSCRIBERS_FULL_REFRESH_DAYS', 0), patch.object(self.worksheet, 'get', flaky_get):
+            self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com", "b@example.com", "c@example.com"])
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_falls_back_to_snapshot_when_sheets_fails(self):
+        bbbot.get_subscribers_from_sheet()
+        with patch('bbbot._sheets_client', side_effect=TimeoutError("Sheets lento")):
+            self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com"])
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_falls_back_to_snapshot_when_gspread_is_missing(self):
+        bbbot.get_subscribers_from_sheet()
+        with patch.dict(sys.modules, {'gspread': None}):
+            self.assertEqual(bbbot.get_subscribers_from_sheet(), ["a@example.com"])
+
+class TestCampaigns(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write_config(self, campaigns):
+        path = os.path.join(self.tmpdir, 'campaigns.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(campaigns, f)
+        return path
+
+    def test_without_config_uses_the_default_list(self):
+        campaigns = bbbot.load_campaigns(os.path.join(self.tmpdir, 'no-existe.json'))
+
+        self.assertEqual([c.name for c in campaigns], ["default"])
+        self.assertEqual(campaigns[0].db_file, bbbot.SUBSCRIBERS_DB_FILE)
+        self.assertEqual(campaigns[0].sheet_range(2, 1001), "B2:B1001")
+
+    def test_invalid_configs_are_rejected(self):
+        for config in ([], [{"name": "a"}, {"name": "a"}], [{"name": "Piel Grasa"}], [{"name": "a", "color": "x"}],
+                       [{"name": "a", "segment_column": "C"}], [{"name": "a", "weight": 0}]):
+            with self.subTest(config=config), self.assertRaises(ValueError):
+                bbbot.load_campaigns(self.write_config(config))
+
+    def test_segment_keeps_row_positions(self):
+        campaign = bbbot.Campaign("grasa", segment_column="C", segment_values=["Grasa", "mixta"])
+
+        self.assertEqual(campaign.sheet_range(2, 5), "B2:C5")
+        self.assertTrue(campaign.db_file.endswith(".grasa.sqlite3"))
+        rows = [["a@example.com", " grasa "], ["b@example.com", "Seca"], [], ["c@example.com"], ["d@example.com", "Mixta"]]
+        self.assertEqual(campaign.select(rows), [["a@example.com"], [], [], [], ["d@example.com"]])
+
+    @patch('bbbot.SUBSCRIBERS_CACHE_TTL', 0)
+    def test_segmented_list_reads_its_own_tab_and_snapshot(self):
+        worksheet = FakeWorksheet(["a@example.com", "b@example.com", "c@example.com"], row_count=4,
+                                  segments=["Grasa", "Seca", "Grasa"])
+        client = MagicMock()
+        client.open_by_key.return_value.worksheet.return_value = worksheet
+        campaign = bbbot.Campaign("grasa", sheet_key="otra", worksheet="Socios", segment_column="C",
+                                  segment_values=["grasa"])
+        with patch('bbbot.SUBSCRIBERS_DB_FILE', os.path.join(self.tmpdir, 's.sqlite3')), \
+                patch('bbbot._sheets_client', return_value=client):
+            self.assertEqual(list(bbbot.iter_subscribers(campaign)), ["a@example.com", "c@example.com"])
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 's.grasa.sqlite3')))
+
+        client.open_by_key.assert_called_once_with("otra")
+        client.open_by_key.return_value.worksheet.assert_called_once_with("Socios")
+        self.assertEqual(worksheet.calls, ["B2:C1001"])
+
+    def test_campaign_scheduler_shares_turns_by_weight(self):
+        scheduler = bbbot.CampaignScheduler()
+        big, small = scheduler.add(weight=2), scheduler.add()
+        for i in range(8):
+            big.put(f'big{i}@example.com')
+        for i in range(4):
+            small.put(f'small{i}@example.com')
+        big.close()
+        small.close()
+
+        order = []
+        while (item := scheduler.get()) is not None:
+            index, batch = item
+            order.append(index)
+            for recipient in batch:
+                scheduler.lanes[index].complete(recipient)
+        # Dos turnos de la lista grande por cada uno de la pequeña, hasta agotarlas
+        self.assertEqual(order, [0, 1, 0, 0, 1, 0, 0, 1, 0, 0, 1, 0])
+
+    def test_campaigns_share_domain_rate(self):
+        scheduler = bbbot.CampaignScheduler(domain_rates={'gmail.com': 2})
+        lanes = [scheduler.add(), scheduler.add()]
+        for lane_index, lane in enumerate(lanes):
+            for i in range(2):
+                lane.put(f'{lane_index}-{i}@gmail.com')
+            lane.close()
+
+        start = time.monotonic()
+        while (item := scheduler.get()) is not None:
+            index, batch = item
+            scheduler.lanes[index].complete(batch[0])
+        # 4 correos a gmail.com en total: ráfaga de 2 y luego 1 cada 0,5 s, sin importar la campaña
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+    @patch('bbbot.EMAIL_SENDER', 'sender@example.com')
+    def test_send_campaigns_delivers_each_address_once(self):
+        backend = bbbot.NullBackend()
+        lists = [(bbbot.Campaign("a"), iter(["x@example.com", "y@example.com"])),
+                 (bbbot.Campaign("b"), iter(["y@example.com", "z@example.com"])),
+                 (bbbot.Campaign("c"), iter(["x@example.com"]))]
+        with patch('bbbot.metrics', bbbot.RunMetrics()) as metrics, \
+                bbbot.DeliveryJournal("Asunto", directory=self.tmpdir) as journal:
+            bbbot.send_campaigns("Asunto", "<p>Hola</p>", "#", lists, journal, backend)
+
+            self.assertEqual(metrics.counter("emails_sent"), 3)
+            self.assertEqual(metrics.counter("emails_skipped"), 2)
+            self.assertTrue(all(journal.already_delivered(r) for r in ["x@example.com", "y@example.com", "z@example.com"]))
+        self.assertEqual(backend.messages, 3)
+
+class TestNewsletterLayout(unittest.TestCase):
+
+    def test_styles_are_inlined_without_external_resources(self):
+        html = bbbot.render_newsletter('<h2 style="color:red">Título</h2>\n    <ul>\n<li>Uno</li></ul>', '#')
+
+        self.assertNotIn('<style', html)
+        self.assertNotIn('fonts.googleapis.com', html)
+        self.assertIn(f'<h2 style="{bbbot._BODY_TAG_STYLES["h2"]}color:red">Título</h2>', html)
+        self.assertIn(f'<li style="margin-bottom:10px;">{bbbot._BULLET}Uno</li>', html)
+        # Sin botón si no hay URL de producto
+        self.assertNotIn('Descubrir el Secreto', html)
+
+    def test_output_is_minified_and_body_is_not_interpreted(self):
+        html = bbbot.render_newsletter('<p>Precio: $80 {oferta}</p>\n\n   <p>Fin</p>',
+                                       'https://example.com/p?a=1&b=2')
+
+        self.assertNotIn('\n', html)
+        self.assertNotIn('  ', html)
+        self.assertIn('Precio: $80 {oferta}</p><p', html)
+        self.assertIn('href="https://example.com/p?a=1&amp;b=2"', html)
+
+    def test_body_is_quoted_printable(self):
+        message = bbbot.PreparedMessage("Asunto", bbbot.render_newsletter("<p>Análisis ✨</p>", "#"), "a@example.com")
+        msg = email.message_from_bytes(message.render("b@example.com"))
+        part = msg.get_payload()[0]
+
+        self.assertEqual(part['Content-Transfer-Encoding'], 'quoted-printable')
+        self.assertIn('Análisis ✨', part.get_payload(decode=True).decode('utf-8'))
+
+class TestPreparedMessage(unittest.TestCase):
+
+    def test_render_matches_per_recipient_message(self):
+        message = bbbot.PreparedMessage("Tu Dosis del Miércoles ✨", "<h1>Niacinamida ñ</h1>", "bot@example.com")
+        raw = message.render("ana@example.com", {"List-Unsubscribe": "<mailto:baja@example.com>"})
+
+        parsed = email.message_from_bytes(raw)
+        self.assertEqual(parsed['To'], "ana@example.com")
+        self.assertEqual(parsed['List-Unsubscribe'], "<mailto:baja@example.com>")
+        self.assertEqual(str(email.header.make_header(email.header.decode_header(parsed['Subject']))),
+                         "Tu Dosis del Miércoles ✨")
+        self.assertEqual(parsed.get_payload()[0].get_payload(decode=True).decode('utf-8'), "<h1>Niacinamida ñ</h1>")
+
+    def test_render_shares_encoded_body(self):
+        message = bbbot.PreparedMessage("Asunto", "<p>Hola</p>", "bot@example.com")
+        first = message.render("a@example.com")
+        second = message.render("b@example.com")
+        self.assertTrue(first.endswith(message.body))
+        self.assertEqual(first.replace(b"a@example.com", b"b@example.com"), second)
 
 if __name__ == '__main__':
     unittest.main()